@@ -5361,6 +5361,36 @@ std::vector<Option> get_global_options() {
     .set_default(1.0)
     .set_description("Time to wait during shutdown to deregister service with mgr"),
 
+    Option("mgr_osdmap_change_history", Option::TYPE_UINT, Option::LEVEL_ADVANCED)
+    .set_default(500)
+    .add_service("mgr")
+    .set_description("Number of OSDMap epochs with changes whose deltas are "
+                     "kept for manager modules")
+    .set_long_description("Modules asking for OSDMap changes since an older "
+                          "epoch have to fall back to comparing full maps."),
+
+    Option("mgr_pgmap_change_history", Option::TYPE_UINT, Option::LEVEL_ADVANCED)
+    .set_default(500)
+    .add_service("mgr")
+    .set_description("Number of PGMap versions with PG state or mapping "
+                     "changes whose deltas are kept for manager modules")
+    .set_long_description("Modules asking for PG changes since an older "
+                          "version have to fall back to a full pg dump."),
+
+    Option("mgr_module_notify_queue_max", Option::TYPE_UINT, Option::LEVEL_ADVANCED)
+    .set_default(1000)
+    .set_min(1)
+    .add_service("mgr")
+    .set_description("Maximum number of notifications queued for each "
+                     "manager module")
+    .set_long_description("Map and summary notifications that are already "
+                          "queued for a module are coalesced rather than "
+                          "queued again.  When a slow module still has more "
+                          "notifications than this pending, the oldest "
+                          "cluster log entries, then the oldest command and "
+                          "perf schema notifications, are dropped.  Map and "
+                          "summary notifications are never dropped."),
+
     Option("mgr_debug_aggressive_pg_num_changes", Option::TYPE_BOOL, Option::LEVEL_DEV)
     .set_default(false)
     .set_description("Bypass most throttling and safety checks in pg[p]_num controller")
@@ -17,12 +17,132 @@
 
 #include "ActivePyModule.h"
 
+#include <algorithm>
+
 
 #define dout_context g_ceph_context
 #define dout_subsys ceph_subsys_mgr
 #undef dout_prefix
 #define dout_prefix *_dout << "mgr " << __func__ << " "
 
+// Rows of the notify latency histogram.  Any other notification type
+// lands in the last (overflow) row.
+static const std::vector<std::string> notify_types = {
+  "clog",
+  "command",
+  "fs_map",
+  "health",
+  "mon_map",
+  "mon_status",
+  "osd_map",
+  "perf_schema_update",
+  "pg_summary",
+  "service_map",
+};
+
+static int64_t notify_type_index(const std::string &notify_type)
+{
+  return std::find(notify_types.begin(), notify_types.end(), notify_type) -
+    notify_types.begin();
+}
+
+/**
+ * Account one call from the mgr into the module: the time it waited
+ * for the GIL, the time it then ran, and its overall latency.
+ */
+class ActivePyModule::CallTimer
+{
+  PerfCounters *perfcounter;
+  const int lat_idx;
+  const int64_t notify_type;
+  const ceph::mono_time start;
+  ceph::mono_time acquired;
+
+public:
+  CallTimer(PerfCounters *perfcounter_, int lat_idx_,
+	    int64_t notify_type_ = -1)
+    : perfcounter(perfcounter_), lat_idx(lat_idx_),
+      notify_type(notify_type_), start(ceph::mono_clock::now()),
+      acquired(start)
+  {}
+
+  // Call once the GIL has been taken
+  void gil_acquired()
+  {
+    acquired = ceph::mono_clock::now();
+    perfcounter->tinc(l_pym_gil_wait, acquired - start);
+  }
+
+  ~CallTimer()
+  {
+    const auto end = ceph::mono_clock::now();
+    perfcounter->tinc(l_pym_busy, end - acquired);
+    perfcounter->tinc(lat_idx, end - start);
+    if (notify_type >= 0) {
+      perfcounter->hinc(l_pym_notify_lat_histogram,
+			std::chrono::duration_cast<std::chrono::nanoseconds>(
+			  end - start).count(),
+			notify_type);
+    }
+  }
+};
+
+ActivePyModule::ActivePyModule(const PyModuleRef &py_module_,
+			       LogChannelRef clog_)
+  : PyModuleRunner(py_module_, clog_)
+{
+  PerfHistogramCommon::axis_config_d lat_axis_config{
+    "Latency (nsec)",
+    PerfHistogramCommon::SCALE_LOG2,
+    0,
+    100000,
+    32,
+  };
+  PerfHistogramCommon::axis_config_d type_axis_config{
+    "Notification type",
+    PerfHistogramCommon::SCALE_LINEAR,
+    0,
+    1,
+    static_cast<int32_t>(notify_types.size() + 2),
+  };
+
+  PerfCountersBuilder plb(g_ceph_context, "mgr-module-" + get_name(),
+			  l_pym_first, l_pym_last);
+  plb.set_prio_default(PerfCountersBuilder::PRIO_USEFUL);
+  plb.add_u64_counter(l_pym_notify, "notify", "Notifications delivered");
+  plb.add_time_avg(l_pym_notify_lat, "notify_latency",
+		   "Latency of notifications (including waiting for the GIL)");
+  plb.add_u64_counter_histogram(
+    l_pym_notify_lat_histogram, "notify_latency_histogram",
+    lat_axis_config, type_axis_config,
+    "Histogram of notification latency by notification type");
+  plb.add_u64(l_pym_notify_queue, "notify_queue",
+	      "Notifications waiting to be delivered");
+  plb.add_u64_counter(l_pym_notify_coalesced, "notify_coalesced",
+		      "Notifications merged into one already queued");
+  plb.add_u64_counter(l_pym_notify_dropped, "notify_dropped",
+		      "Notifications dropped because the queue was full");
+  plb.add_u64_counter(l_pym_command, "command", "Commands handled");
+  plb.add_time_avg(l_pym_command_lat, "command_latency",
+		   "Latency of commands");
+  plb.add_u64_counter(l_pym_remote, "remote",
+		      "Calls from other modules");
+  plb.add_time_avg(l_pym_remote_lat, "remote_latency",
+		   "Latency of calls from other modules");
+  plb.add_time_avg(l_pym_gil_wait, "gil_wait",
+		   "Time waiting for the GIL before calling into the module");
+  plb.add_time(l_pym_busy, "busy",
+	       "Time spent in module code called by the mgr");
+  perfcounter = plb.create_perf_counters();
+  g_ceph_context->get_perfcounters_collection()->add(perfcounter);
+}
+
+ActivePyModule::~ActivePyModule()
+{
+  g_ceph_context->get_perfcounters_collection()->remove(perfcounter);
+  delete perfcounter;
+}
+
 int ActivePyModule::load(ActivePyModules *py_modules)
 {
   ceph_assert(py_modules);
@@ -49,11 +169,115 @@ int ActivePyModule::load(ActivePyModules *py_modules)
   return 0;
 }
 
+bool ActivePyModule::_queued_notify()
+{
+  ceph_assert(notify_lock.is_locked_by_me());
+
+  // Over the limit, shed the oldest cluster log entries first: they
+  // are the bulk of a backlog and the least useful once stale.  Then
+  // the oldest notifications with an id (command completions, perf
+  // schema updates), which are not coalesced.  Map and summary
+  // notifications are never dropped: there is at most one of each type
+  // queued, and dropping one would leave the module with a stale map.
+  const auto max = g_conf().get_val<uint64_t>("mgr_module_notify_queue_max");
+  while (notify_queue.size() > max) {
+    auto victim = std::find_if(
+      notify_queue.begin(), notify_queue.end(),
+      [](const QueuedNotify &n) { return n.log_entry.has_value(); });
+    if (victim == notify_queue.end()) {
+      victim = std::find_if(
+	notify_queue.begin(), notify_queue.end(),
+	[](const QueuedNotify &n) { return !n.id.empty(); });
+      if (victim == notify_queue.end()) {
+	break;
+      }
+      notify_pending.erase(std::make_pair(victim->type, victim->id));
+    }
+    notify_dropped[victim->type]++;
+    notify_queue.erase(victim);
+    perfcounter->inc(l_pym_notify_dropped);
+  }
+  perfcounter->set(l_pym_notify_queue, notify_queue.size());
+
+  if (notify_scheduled) {
+    return false;
+  }
+  notify_scheduled = true;
+  return true;
+}
+
+bool ActivePyModule::queue_notify(const std::string &notify_type,
+				  const std::string &notify_id)
+{
+  std::lock_guard l(notify_lock);
+  auto key = std::make_pair(notify_type, notify_id);
+  if (!notify_pending.insert(key).second) {
+    perfcounter->inc(l_pym_notify_coalesced);
+    return false;
+  }
+  notify_queue.push_back(QueuedNotify{notify_type, notify_id, {}});
+  return _queued_notify();
+}
+
+bool ActivePyModule::queue_notify_clog(const LogEntry &log_entry)
+{
+  std::lock_guard l(notify_lock);
+  notify_queue.push_back(QueuedNotify{"clog", "", log_entry});
+  return _queued_notify();
+}
+
+bool ActivePyModule::deliver_notify()
+{
+  std::list<QueuedNotify> notifies;
+  std::map<std::string, uint64_t> dropped;
+  {
+    std::lock_guard l(notify_lock);
+    notifies.swap(notify_queue);
+    notify_pending.clear();
+    dropped.swap(notify_dropped);
+    perfcounter->set(l_pym_notify_queue, 0);
+  }
+
+  for (const auto &i : dropped) {
+    dout(1) << get_name() << " fell behind, dropped " << i.second
+	    << " " << i.first << " notifications" << dendl;
+  }
+
+  // in the order they arrived, consecutive cluster log entries in one
+  // batch
+  std::list<LogEntry> log_entries;
+  for (auto &i : notifies) {
+    if (i.log_entry) {
+      log_entries.push_back(std::move(*i.log_entry));
+      continue;
+    }
+    if (!log_entries.empty()) {
+      notify_clog(log_entries);
+      log_entries.clear();
+    }
+    notify(i.type, i.id);
+  }
+  if (!log_entries.empty()) {
+    notify_clog(log_entries);
+  }
+
+  std::lock_guard l(notify_lock);
+  if (notify_queue.empty()) {
+    notify_scheduled = false;
+    return false;
+  }
+  return true;
+}
+
 void ActivePyModule::notify(const std::string &notify_type, const std::string &notify_id)
 {
   ceph_assert(pClassInstance != nullptr);
 
+  perfcounter->inc(l_pym_notify);
+  CallTimer timer(perfcounter, l_pym_notify_lat,
+		  notify_type_index(notify_type));
   Gil gil(py_module->pMyThreadState, true);
+  timer.gil_acquired();
 
   // Execute
   auto pValue = PyObject_CallMethod(pClassInstance,
@@ -72,31 +296,37 @@ void ActivePyModule::notify(const std::string &notify_type, const std::string &n
   }
 }
 
-void ActivePyModule::notify_clog(const LogEntry &log_entry)
+void ActivePyModule::notify_clog(const std::list<LogEntry> &log_entries)
 {
   ceph_assert(pClassInstance != nullptr);
 
+  // The whole batch is delivered under one acquisition of the GIL
+  perfcounter->inc(l_pym_notify, log_entries.size());
+  CallTimer timer(perfcounter, l_pym_notify_lat, notify_type_index("clog"));
   Gil gil(py_module->pMyThreadState, true);
+  timer.gil_acquired();
 
-  // Construct python-ized LogEntry
-  PyFormatter f;
-  log_entry.dump(&f);
-  auto py_log_entry = f.get();
+  for (const auto &log_entry : log_entries) {
+    // Construct python-ized LogEntry
+    PyFormatter f;
+    log_entry.dump(&f);
+    auto py_log_entry = f.get();
 
-  // Execute
-  auto pValue = PyObject_CallMethod(pClassInstance,
-       const_cast<char*>("notify"), const_cast<char*>("(sN)"),
-       "clog", py_log_entry);
+    // Execute
+    auto pValue = PyObject_CallMethod(pClassInstance,
+	 const_cast<char*>("notify"), const_cast<char*>("(sN)"),
+	 "clog", py_log_entry);
 
-  if (pValue != NULL) {
-    Py_DECREF(pValue);
-  } else {
-    derr << get_name() << ".notify_clog:" << dendl;
-    derr << handle_pyerror() << dendl;
-    // FIXME: callers can't be expected to handle a python module
-    // that has spontaneously broken, but Mgr() should provide
-    // a hook to unload misbehaving modules when they have an
-    // error somewhere like this
+    if (pValue != NULL) {
+      Py_DECREF(pValue);
+    } else {
+      derr << get_name() << ".notify_clog:" << dendl;
+      derr << handle_pyerror() << dendl;
+      // FIXME: callers can't be expected to handle a python module
+      // that has spontaneously broken, but Mgr() should provide
+      // a hook to unload misbehaving modules when they have an
+      // error somewhere like this
+    }
   }
 }
 
@@ -128,7 +358,10 @@ PyObject *ActivePyModule::dispatch_remote(
   // But in future this might involve serialization to support a CSP-aware
   // future Python interpreter a la PEP554
 
+  perfcounter->inc(l_pym_remote);
+  CallTimer timer(perfcounter, l_pym_remote_lat);
   Gil gil(py_module->pMyThreadState, true);
+  timer.gil_acquired();
 
   // Fire the receiving method
   auto boundMethod = PyObject_GetAttrString(pClassInstance, method.c_str());
@@ -184,7 +417,10 @@ int ActivePyModule::handle_command(
     return -EINVAL;
   }
 
+  perfcounter->inc(l_pym_command);
+  CallTimer timer(perfcounter, l_pym_command_lat);
   Gil gil(py_module->pMyThreadState, true);
+  timer.gil_acquired();
 
   PyFormatter f;
   cmdmap_dump(cmdmap, &f);
@@ -227,3 +463,94 @@ void ActivePyModule::get_health_checks(health_check_map_t *checks)
   checks->merge(health_checks);
 }
 
+
+void ActivePyModule::dump_profile(Formatter *f) const
+{
+  f->dump_string("module", get_name());
+  {
+    std::lock_guard l(notify_lock);
+    f->dump_unsigned("notify_queue", notify_queue.size());
+  }
+  f->open_array_section("notify_types");
+  for (const auto &notify_type : notify_types) {
+    f->dump_string("notify_type", notify_type);
+  }
+  f->close_section();
+  f->open_object_section("counters");
+  perfcounter->dump_formatted(f, false);
+  f->close_section();
+  f->open_object_section("histograms");
+  perfcounter->dump_formatted_histograms(f, false);
+  f->close_section();
+}
+
+void ActivePyModule::reset_profile()
+{
+  std::lock_guard l(notify_lock);
+  perfcounter->reset();
+  perfcounter->set(l_pym_notify_queue, notify_queue.size());
+}
+
+int ActivePyModule::handle_profiler_result(
+  PyObject *pResult,
+  std::stringstream *ds,
+  std::stringstream *ss)
+{
+  if (pResult == nullptr) {
+    *ss << handle_pyerror();
+    return -EINVAL;
+  }
+  *ds << PyString_AsString(pResult);
+  Py_DECREF(pResult);
+  return 0;
+}
+
+int ActivePyModule::start_profiler(double interval, std::stringstream *ss)
+{
+  if (pClassInstance == nullptr) {
+    *ss << "Module not instantiated";
+    return -EINVAL;
+  }
+  Gil gil(py_module->pMyThreadState, true);
+  std::stringstream ds;
+  int r = handle_profiler_result(
+    PyObject_CallMethod(pClassInstance,
+			const_cast<char*>("_profiler_start"),
+			const_cast<char*>("(d)"), interval),
+    &ds, ss);
+  *ss << ds.str();
+  return r;
+}
+
+int ActivePyModule::stop_profiler(std::stringstream *ss)
+{
+  if (pClassInstance == nullptr) {
+    *ss << "Module not instantiated";
+    return -EINVAL;
+  }
+  Gil gil(py_module->pMyThreadState, true);
+  std::stringstream ds;
+  int r = handle_profiler_result(
+    PyObject_CallMethod(pClassInstance,
+			const_cast<char*>("_profiler_stop"), nullptr),
+    &ds, ss);
+  *ss << ds.str();
+  return r;
+}
+
+int ActivePyModule::dump_profiler_stacks(
+  int count,
+  std::stringstream *ds,
+  std::stringstream *ss)
+{
+  if (pClassInstance == nullptr) {
+    *ss << "Module not instantiated";
+    return -EINVAL;
+  }
+  Gil gil(py_module->pMyThreadState, true);
+  return handle_profiler_result(
+    PyObject_CallMethod(pClassInstance,
+			const_cast<char*>("_profiler_stacks"),
+			const_cast<char*>("(i)"), count),
+    ds, ss);
+}
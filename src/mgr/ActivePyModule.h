@@ -22,11 +22,16 @@
 #include "common/LogEntry.h"
 #include "common/Mutex.h"
 #include "common/Thread.h"
+#include "common/perf_counters.h"
 #include "mon/health_check.h"
 #include "mgr/Gil.h"
 
 #include "PyModuleRunner.h"
 
+#include <list>
+#include <map>
+#include <optional>
+#include <set>
 #include <vector>
 #include <string>
 
@@ -34,6 +39,23 @@
 class ActivePyModule;
 class ActivePyModules;
 
+enum {
+  l_pym_first = 80000,
+  l_pym_notify,
+  l_pym_notify_lat,
+  l_pym_notify_lat_histogram,
+  l_pym_notify_queue,
+  l_pym_notify_coalesced,
+  l_pym_notify_dropped,
+  l_pym_command,
+  l_pym_command_lat,
+  l_pym_remote,
+  l_pym_remote_lat,
+  l_pym_gil_wait,
+  l_pym_busy,
+  l_pym_last,
+};
+
 class ActivePyModule : public PyModuleRunner
 {
 private:
@@ -42,15 +64,67 @@ private:
   // Optional, URI exposed by plugins that implement serve()
   std::string uri;
 
+  // Counters for the calls the mgr makes into the module, registered
+  // as "mgr-module-<name>"
+  PerfCounters *perfcounter = nullptr;
+
+  // A notification waiting to be delivered: a cluster log entry, or
+  // a (type, id) pair
+  struct QueuedNotify {
+    std::string type;
+    std::string id;
+    std::optional<LogEntry> log_entry;
+  };
+
+  // Notifications waiting to be delivered, in the order they arrived.
+  // A (type, id) pair that is already pending is not queued again, which
+  // makes map and summary notifications (whose id is empty) latest-wins;
+  // runs of cluster log entries are delivered in batches.  At most one
+  // deliver_notify() is scheduled at a time.
+  mutable Mutex notify_lock{"ActivePyModule::notify_lock"};
+  std::list<QueuedNotify> notify_queue;
+  std::set<std::pair<std::string, std::string>> notify_pending;
+  // notifications dropped since the last delivery, by type
+  std::map<std::string, uint64_t> notify_dropped;
+  bool notify_scheduled = false;
+
+  bool _queued_notify();
+
+  class CallTimer;
+
+  void notify(const std::string &notify_type, const std::string &notify_id);
+  void notify_clog(const std::list<LogEntry> &log_entries);
+
+  int handle_profiler_result(PyObject *pResult, std::stringstream *ds,
+			     std::stringstream *ss);
+
 public:
   ActivePyModule(const PyModuleRef &py_module_,
-      LogChannelRef clog_)
-    : PyModuleRunner(py_module_, clog_)
-  {}
+      LogChannelRef clog_);
+  ~ActivePyModule();
 
   int load(ActivePyModules *py_modules);
-  void notify(const std::string &notify_type, const std::string &notify_id);
-  void notify_clog(const LogEntry &le);
+
+  /**
+   * Queue a notification for the module.  Returns true if the caller
+   * must schedule a call to deliver_notify().
+   */
+  bool queue_notify(const std::string &notify_type,
+		    const std::string &notify_id);
+  bool queue_notify_clog(const LogEntry &le);
+
+  /**
+   * Deliver the notifications queued so far.  Returns true if more
+   * arrived meanwhile and another call must be scheduled.
+   */
+  bool deliver_notify();
+
+  void dump_profile(Formatter *f) const;
+  void reset_profile();
+  int start_profiler(double interval, std::stringstream *ss);
+  int stop_profiler(std::stringstream *ss);
+  int dump_profiler_stacks(int count, std::stringstream *ds,
+			   std::stringstream *ss);
 
   bool method_exists(const std::string &method) const;
 
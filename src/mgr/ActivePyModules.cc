@@ -384,6 +384,185 @@ PyObject *ActivePyModules::get_python(const std::string &what)
   }
 }
 
+PyObject *ActivePyModules::get_data_version_python(const std::string &what)
+{
+  // Cheap probe of the map epoch and/or PGMap version that the result of
+  // get_python(what) would be built from, so that callers can tell whether
+  // a previously fetched copy is still current without re-serializing it.
+  // Data that is not tied to a versioned map yields None.
+  epoch_t epoch = 0;
+  version_t version = 0;
+  bool versioned = true;
+
+  PyThreadState *tstate = PyEval_SaveThread();
+  if (what == "osdmap_crush_map_text" || what.substr(0, 7) == "osd_map") {
+    epoch = cluster_state.with_osdmap([](const OSDMap &osd_map) {
+      return osd_map.get_epoch();
+    });
+  } else if (what == "pg_summary" || what == "pg_status" ||
+	     what == "pg_dump" || what == "io_rate" || what == "osd_stats") {
+    version = cluster_state.with_pgmap([](const PGMap &pg_map) {
+      return pg_map.version;
+    });
+  } else if (what == "df" || what == "osd_pool_stats") {
+    cluster_state.with_osdmap_and_pgmap(
+      [&epoch, &version](const OSDMap &osd_map, const PGMap &pg_map) {
+	epoch = osd_map.get_epoch();
+	version = pg_map.version;
+      });
+  } else if (what == "fs_map") {
+    cluster_state.with_fsmap([&epoch](const FSMap &fsmap) {
+      epoch = fsmap.get_epoch();
+    });
+  } else if (what == "mon_map") {
+    cluster_state.with_monmap([&epoch](const MonMap &monmap) {
+      epoch = monmap.get_epoch();
+    });
+  } else if (what == "service_map") {
+    cluster_state.with_servicemap([&epoch](const ServiceMap &service_map) {
+      epoch = service_map.epoch;
+    });
+  } else if (what == "mgr_map") {
+    cluster_state.with_mgrmap([&epoch](const MgrMap &mgr_map) {
+      epoch = mgr_map.get_epoch();
+    });
+  } else if (what == "osd_metadata") {
+    version = daemon_state.get_metadata_version();
+  } else {
+    versioned = false;
+  }
+  PyEval_RestoreThread(tstate);
+
+  if (!versioned) {
+    Py_RETURN_NONE;
+  }
+  return Py_BuildValue("(KK)", (unsigned long long)epoch,
+		       (unsigned long long)version);
+}
+
+PyObject *ActivePyModules::get_osdmap_changes_python(epoch_t since,
+							epoch_t until)
+{
+  PyFormatter f;
+  PyThreadState *tstate = PyEval_SaveThread();
+  cluster_state.with_pgmap([&](const PGMap &) {
+    PyEval_RestoreThread(tstate);
+    cluster_state.dump_osdmap_changes(since, until, &f);
+  });
+  return f.get();
+}
+
+PyObject *ActivePyModules::get_pgmap_changes_python(version_t since)
+{
+  PyFormatter f;
+  PyThreadState *tstate = PyEval_SaveThread();
+  cluster_state.with_pgmap([&](const PGMap &) {
+    PyEval_RestoreThread(tstate);
+    cluster_state.dump_pgmap_changes(since, &f);
+  });
+  return f.get();
+}
+
+PyObject *ActivePyModules::get_pg_stats_columns_python(
+    const std::vector<std::string> &fields)
+{
+  typedef std::function<int64_t(const pg_t&, const pg_stat_t&)> scalar_t;
+  static const std::map<std::string, scalar_t> scalars = {
+    {"pool", [](const pg_t &pgid, const pg_stat_t &) {
+	return (int64_t)pgid.pool(); }},
+    {"ps", [](const pg_t &pgid, const pg_stat_t &) {
+	return (int64_t)pgid.ps(); }},
+    {"state", [](const pg_t &, const pg_stat_t &s) {
+	return (int64_t)s.state; }},
+    {"reported_epoch", [](const pg_t &, const pg_stat_t &s) {
+	return (int64_t)s.reported_epoch; }},
+    {"log_size", [](const pg_t &, const pg_stat_t &s) {
+	return (int64_t)s.log_size; }},
+    {"ondisk_log_size", [](const pg_t &, const pg_stat_t &s) {
+	return (int64_t)s.ondisk_log_size; }},
+    {"up_primary", [](const pg_t &, const pg_stat_t &s) {
+	return (int64_t)s.up_primary; }},
+    {"acting_primary", [](const pg_t &, const pg_stat_t &s) {
+	return (int64_t)s.acting_primary; }},
+#define STAT_SUM_COLUMN(name) \
+    {#name, [](const pg_t &, const pg_stat_t &s) { \
+	return (int64_t)s.stats.sum.name; }}
+    STAT_SUM_COLUMN(num_bytes),
+    STAT_SUM_COLUMN(num_objects),
+    STAT_SUM_COLUMN(num_object_clones),
+    STAT_SUM_COLUMN(num_object_copies),
+    STAT_SUM_COLUMN(num_objects_missing_on_primary),
+    STAT_SUM_COLUMN(num_objects_degraded),
+    STAT_SUM_COLUMN(num_objects_misplaced),
+    STAT_SUM_COLUMN(num_objects_unfound),
+    STAT_SUM_COLUMN(num_rd),
+    STAT_SUM_COLUMN(num_rd_kb),
+    STAT_SUM_COLUMN(num_wr),
+    STAT_SUM_COLUMN(num_wr_kb),
+    STAT_SUM_COLUMN(num_objects_recovered),
+    STAT_SUM_COLUMN(num_bytes_recovered),
+    STAT_SUM_COLUMN(num_keys_recovered),
+    STAT_SUM_COLUMN(num_omap_bytes),
+    STAT_SUM_COLUMN(num_omap_keys),
+#undef STAT_SUM_COLUMN
+  };
+  // Variable length fields are flattened; "<field>_offsets" holds the
+  // start of each PG's entries (plus a final end offset).
+  static const std::map<std::string, std::vector<int32_t> pg_stat_t::*>
+    lists = {
+    {"up", &pg_stat_t::up},
+    {"acting", &pg_stat_t::acting},
+  };
+
+  for (const auto &field : fields) {
+    if (scalars.count(field) == 0 && lists.count(field) == 0) {
+      PyErr_Format(PyExc_ValueError, "unknown pg stat field '%s'",
+		   field.c_str());
+      return nullptr;
+    }
+  }
+
+  const std::set<std::string> wanted(fields.begin(), fields.end());
+  std::map<std::string, std::vector<int64_t>> columns;
+  PyThreadState *tstate = PyEval_SaveThread();
+  cluster_state.with_pgmap([&](const PGMap &pg_map) {
+    // Every column is filled from the same PGMap iteration, so row i of
+    // one column describes the same PG as row i of any other.
+    const size_t num_pgs = pg_map.pg_stat.size();
+    for (const auto &field : wanted) {
+      auto &column = columns[field];
+      auto s = scalars.find(field);
+      if (s != scalars.end()) {
+	column.reserve(num_pgs);
+	for (const auto &p : pg_map.pg_stat) {
+	  column.push_back(s->second(p.first, p.second));
+	}
+      } else {
+	auto member = lists.at(field);
+	auto &offsets = columns[field + "_offsets"];
+	offsets.reserve(num_pgs + 1);
+	offsets.push_back(0);
+	for (const auto &p : pg_map.pg_stat) {
+	  const auto &osds = p.second.*member;
+	  column.insert(column.end(), osds.begin(), osds.end());
+	  offsets.push_back(column.size());
+	}
+      }
+    }
+  });
+  PyEval_RestoreThread(tstate);
+
+  PyObject *result = PyDict_New();
+  for (const auto &i : columns) {
+    PyObject *buf = PyBytes_FromStringAndSize(
+      reinterpret_cast<const char*>(i.second.data()),
+      i.second.size() * sizeof(int64_t));
+    PyDict_SetItemString(result, i.first.c_str(), buf);
+    Py_DECREF(buf);
+  }
+  return result;
+}
+
 void ActivePyModules::start_one(PyModuleRef py_module)
 {
   std::lock_guard l(lock);
@@ -442,6 +621,20 @@ void ActivePyModules::shutdown()
   modules.clear();
 }
 
+void ActivePyModules::schedule_notify(ActivePyModule *module)
+{
+  // Send all python calls down a Finisher to avoid blocking
+  // C++ code, and avoid any potential lock cycles.  Each delivery
+  // drains what the module has queued so far and then goes to the
+  // back of the finisher queue, so one slow module does not starve
+  // the others.
+  finisher.queue(new FunctionContext([this, module](int r){
+    if (module->deliver_notify()) {
+      schedule_notify(module);
+    }
+  }));
+}
+
 void ActivePyModules::notify_all(const std::string &notify_type,
                      const std::string &notify_id)
 {
@@ -450,11 +643,9 @@ void ActivePyModules::notify_all(const std::string &notify_type,
   dout(10) << __func__ << ": notify_all " << notify_type << dendl;
   for (auto& i : modules) {
     auto module = i.second.get();
-    // Send all python calls down a Finisher to avoid blocking
-    // C++ code, and avoid any potential lock cycles.
-    finisher.queue(new FunctionContext([module, notify_type, notify_id](int r){
-      module->notify(notify_type, notify_id);
-    }));
+    if (module->queue_notify(notify_type, notify_id)) {
+      schedule_notify(module);
+    }
   }
 }
 
@@ -465,15 +656,9 @@ void ActivePyModules::notify_all(const LogEntry &log_entry)
   dout(10) << __func__ << ": notify_all (clog)" << dendl;
   for (auto& i : modules) {
     auto module = i.second.get();
-    // Send all python calls down a Finisher to avoid blocking
-    // C++ code, and avoid any potential lock cycles.
-    //
-    // Note intentional use of non-reference lambda binding on
-    // log_entry: we take a copy because caller's instance is
-    // probably ephemeral.
-    finisher.queue(new FunctionContext([module, log_entry](int r){
-      module->notify_clog(log_entry);
-    }));
+    if (module->queue_notify_clog(log_entry)) {
+      schedule_notify(module);
+    }
   }
 }
 
@@ -632,6 +817,74 @@ void ActivePyModules::set_store(const std::string &module_name,
   }
 }
 
+void ActivePyModules::set_store_batch(const std::string &module_name,
+    const std::map<std::string, boost::optional<std::string>> &changes,
+    const std::set<std::string> &rm_prefixes,
+    bufferlist *outbl, std::string *outs, Context *on_finish)
+{
+  const std::string module_prefix = PyModule::config_prefix
+                                    + module_name + "/";
+
+  JSONFormatter jf;
+  jf.open_object_section("batch");
+  jf.open_array_section("set");
+  for (const auto &i : changes) {
+    if (i.second) {
+      jf.open_object_section("kv");
+      jf.dump_string("key", module_prefix + i.first);
+      jf.dump_string("val", *i.second);
+      jf.close_section();
+    }
+  }
+  jf.close_section();
+  jf.open_array_section("rm");
+  for (const auto &i : changes) {
+    if (!i.second) {
+      jf.dump_string("key", module_prefix + i.first);
+    }
+  }
+  jf.close_section();
+  jf.open_array_section("rm_prefix");
+  for (const auto &prefix : rm_prefixes) {
+    jf.dump_string("prefix", module_prefix + prefix);
+  }
+  jf.close_section();
+  jf.close_section();
+  bufferlist inbl;
+  jf.flush(inbl);
+
+  std::ostringstream cmd_json;
+  JSONFormatter cf;
+  cf.open_object_section("cmd");
+  cf.dump_string("prefix", "config-key batch");
+  cf.close_section();
+  cf.flush(cmd_json);
+
+  std::lock_guard l(lock);
+  // Same order as the mon applies the batch: prefixes, then keys
+  for (const auto &prefix : rm_prefixes) {
+    const std::string global_prefix = module_prefix + prefix;
+    auto i = store_cache.lower_bound(global_prefix);
+    while (i != store_cache.end() &&
+	   i->first.compare(0, global_prefix.size(), global_prefix) == 0) {
+      i = store_cache.erase(i);
+    }
+  }
+  for (const auto &i : changes) {
+    if (i.second) {
+      store_cache[module_prefix + i.first] = *i.second;
+    } else {
+      store_cache.erase(module_prefix + i.first);
+    }
+  }
+
+  dout(4) << __func__ << " " << module_name << ": " << changes.size()
+	  << " keys, " << rm_prefixes.size() << " prefixes" << dendl;
+  // Sent under the lock, like set_store(), so that a module's updates
+  // reach the mon in the order the cache saw them
+  monc.start_mon_command({cmd_json.str()}, inbl, outbl, outs, on_finish);
+}
+
 void ActivePyModules::set_config(const std::string &module_name,
     const std::string &key, const boost::optional<std::string>& val)
 {
@@ -801,6 +1054,129 @@ PyObject* ActivePyModules::get_perf_schema_python(
   return f.get();
 }
 
+static bool same_perf_counter_schema(
+    const PerfCounterType &a,
+    const PerfCounterType &b)
+{
+  return a.description == b.description &&
+    a.nick == b.nick &&
+    a.type == b.type &&
+    a.priority == b.priority &&
+    a.unit == b.unit;
+}
+
+PyObject* ActivePyModules::get_perf_counters_bulk_python(
+    const std::set<std::string> &svc_types,
+    int prio_limit)
+{
+  // One column per counter path and schema: the daemons that have the
+  // counter (as indices into `daemons`) and their latest values.  Daemons
+  // of different versions may describe the same path differently, those
+  // get a column of their own.
+  struct column_t {
+    PerfCounterType type;
+    std::vector<uint64_t> daemons;
+    std::vector<uint64_t> values;
+    std::vector<uint64_t> counts;
+  };
+  std::vector<std::string> daemons;
+  std::map<std::string, std::vector<column_t>> columns;
+
+  // Collect everything with the GIL dropped, and only build the python
+  // objects once all the daemon locks have been released.
+  PyThreadState *tstate = PyEval_SaveThread();
+  {
+    std::lock_guard l(lock);
+    for (const auto &statepair : daemon_state.get_all()) {
+      const auto &key = statepair.first;
+      const auto &state = statepair.second;
+      if (!svc_types.count(key.first)) {
+	continue;
+      }
+
+      const uint64_t index = daemons.size();
+      daemons.push_back(key.first + "." + key.second);
+
+      std::lock_guard l2(state->lock);
+      for (const auto &i : state->perf_counters.instances) {
+	auto type = state->perf_counters.types.find(i.first);
+	if (type == state->perf_counters.types.end() ||
+	    type->second.priority < prio_limit) {
+	  continue;
+	}
+	// a counter without data points yet reads as 0, as get_latest()
+	// and get_latest_avg() report it
+	uint64_t value = 0, count = 0;
+	if (type->second.type & PERFCOUNTER_LONGRUNAVG) {
+	  if (!i.second.get_data_avg().empty()) {
+	    const auto &datapoint = i.second.get_latest_data_avg();
+	    value = datapoint.s;
+	    count = datapoint.c;
+	  }
+	} else if (!i.second.get_data().empty()) {
+	  value = i.second.get_latest_data().v;
+	}
+	auto &path_columns = columns[i.first];
+	auto column = std::find_if(
+	  path_columns.begin(), path_columns.end(),
+	  [&type](const column_t &c) {
+	    return same_perf_counter_schema(c.type, type->second);
+	  });
+	if (column == path_columns.end()) {
+	  column = path_columns.emplace(path_columns.end());
+	  column->type = type->second;
+	}
+	column->daemons.push_back(index);
+	column->values.push_back(value);
+	column->counts.push_back(count);
+      }
+    }
+  }
+  PyEval_RestoreThread(tstate);
+
+  PyFormatter f;
+  f.open_array_section("daemons");
+  for (const auto &name : daemons) {
+    f.dump_string("daemon", name);
+  }
+  f.close_section();
+  f.open_object_section("counters");
+  for (const auto &i : columns) {
+    f.open_array_section(i.first.c_str());
+    for (const auto &column : i.second) {
+      f.open_object_section("column");
+      f.dump_string("description", column.type.description);
+      if (!column.type.nick.empty()) {
+	f.dump_string("nick", column.type.nick);
+      }
+      f.dump_unsigned("type", column.type.type);
+      f.dump_unsigned("priority", column.type.priority);
+      f.dump_unsigned("units", column.type.unit);
+      f.open_array_section("daemons");
+      for (auto index : column.daemons) {
+	f.dump_unsigned("index", index);
+      }
+      f.close_section();
+      f.open_array_section("values");
+      for (auto value : column.values) {
+	f.dump_unsigned("value", value);
+      }
+      f.close_section();
+      if (column.type.type & PERFCOUNTER_LONGRUNAVG) {
+	f.open_array_section("counts");
+	for (auto count : column.counts) {
+	  f.dump_unsigned("count", count);
+	}
+	f.close_section();
+      }
+      f.close_section();
+    }
+    f.close_section();
+  }
+  f.close_section();
+  return f.get();
+}
+
 PyObject *ActivePyModules::get_context()
 {
   PyThreadState *tstate = PyEval_SaveThread();
@@ -922,6 +1298,53 @@ int ActivePyModules::handle_command(
   return mod_iter->second->handle_command(cmdmap, inbuf, ds, ss);
 }
 
+int ActivePyModules::handle_profile_command(
+  const std::string &module_name,
+  const std::string &action,
+  const cmdmap_t &cmdmap,
+  Formatter *f,
+  std::stringstream *ds,
+  std::stringstream *ss)
+{
+  lock.Lock();
+  auto mod_iter = modules.find(module_name);
+  if (mod_iter == modules.end()) {
+    *ss << "Module '" << module_name << "' is not available";
+    lock.Unlock();
+    return -ENOENT;
+  }
+  lock.Unlock();
+
+  auto module = mod_iter->second.get();
+  if (action == "dump") {
+    f->open_object_section("profile");
+    module->dump_profile(f);
+    f->close_section();
+    f->flush(*ds);
+    return 0;
+  } else if (action == "reset") {
+    module->reset_profile();
+    return 0;
+  } else if (action == "start") {
+    double interval = 0.01;
+    cmd_getval(g_ceph_context, cmdmap, "interval", interval);
+    if (interval <= 0) {
+      *ss << "interval must be positive";
+      return -EINVAL;
+    }
+    return module->start_profiler(interval, ss);
+  } else if (action == "stop") {
+    return module->stop_profiler(ss);
+  } else if (action == "stacks") {
+    int64_t count = 20;
+    cmd_getval(g_ceph_context, cmdmap, "count", count);
+    return module->dump_profiler_stacks(count, ds, ss);
+  }
+
+  *ss << "Unknown profile action '" << action << "'";
+  return -EINVAL;
+}
+
 void ActivePyModules::get_health_checks(health_check_map_t *checks)
 {
   std::lock_guard l(lock);
@@ -57,6 +57,8 @@ private:
 
   mutable Mutex lock{"ActivePyModules::lock"};
 
+  void schedule_notify(ActivePyModule *module);
+
 public:
   ActivePyModules(PyModuleConfig &module_config,
             std::map<std::string, std::string> store_data,
@@ -71,6 +73,11 @@ public:
   Objecter  &get_objecter() {return objecter;}
   Client    &get_client() {return client;}
   PyObject *get_python(const std::string &what);
+  PyObject *get_data_version_python(const std::string &what);
+  PyObject *get_osdmap_changes_python(epoch_t since, epoch_t until);
+  PyObject *get_pgmap_changes_python(version_t since);
+  PyObject *get_pg_stats_columns_python(
+    const std::vector<std::string> &fields);
   PyObject *get_server_python(const std::string &hostname);
   PyObject *list_servers_python();
   PyObject *get_metadata_python(
@@ -88,6 +95,9 @@ public:
   PyObject *get_perf_schema_python(
      const std::string &svc_type,
      const std::string &svc_id);
+  PyObject *get_perf_counters_bulk_python(
+     const std::set<std::string> &svc_types,
+     int prio_limit);
   PyObject *get_context();
   PyObject *get_osdmap();
   PyObject *with_perf_counters(
@@ -111,6 +121,10 @@ public:
 			      const std::string &prefix) const;
   void set_store(const std::string &module_name,
       const std::string &key, const boost::optional<std::string> &val);
+  void set_store_batch(const std::string &module_name,
+      const std::map<std::string, boost::optional<std::string>> &changes,
+      const std::set<std::string> &rm_prefixes,
+      bufferlist *outbl, std::string *outs, Context *on_finish);
 
   bool get_config(const std::string &module_name,
       const std::string &key, std::string *val) const;
@@ -143,6 +157,14 @@ public:
     std::stringstream *ds,
     std::stringstream *ss);
 
+  int handle_profile_command(
+    const std::string &module_name,
+    const std::string &action,
+    const cmdmap_t &cmdmap,
+    Formatter *f,
+    std::stringstream *ds,
+    std::stringstream *ss);
+
   std::map<std::string, std::string> get_services() const;
 
   // Public so that MonCommandCompletion can use it
@@ -353,6 +353,78 @@ ceph_state_get(BaseMgrModule *self, PyObject *args)
   return self->py_modules->get_python(what);
 }
 
+static PyObject*
+ceph_state_get_version(BaseMgrModule *self, PyObject *args)
+{
+  char *what = NULL;
+  if (!PyArg_ParseTuple(args, "s:ceph_state_get_version", &what)) {
+    return NULL;
+  }
+
+  return self->py_modules->get_data_version_python(what);
+}
+
+static PyObject*
+ceph_get_osdmap_changes(BaseMgrModule *self, PyObject *args)
+{
+  unsigned int since = 0;
+  unsigned int until = 0;
+  if (!PyArg_ParseTuple(args, "I|I:ceph_get_osdmap_changes", &since, &until)) {
+    return nullptr;
+  }
+
+  return self->py_modules->get_osdmap_changes_python(since, until);
+}
+
+static PyObject*
+ceph_get_pgmap_changes(BaseMgrModule *self, PyObject *args)
+{
+  unsigned long long since = 0;
+  if (!PyArg_ParseTuple(args, "K:ceph_get_pgmap_changes", &since)) {
+    return nullptr;
+  }
+
+  return self->py_modules->get_pgmap_changes_python(since);
+}
+
+static PyObject*
+ceph_get_pg_stats_columns(BaseMgrModule *self, PyObject *args)
+{
+  PyObject *py_fields = nullptr;
+  if (!PyArg_ParseTuple(args, "O:ceph_get_pg_stats_columns", &py_fields)) {
+    return nullptr;
+  }
+  if (!PyList_Check(py_fields)) {
+    PyErr_SetString(PyExc_TypeError, "fields must be a list");
+    return nullptr;
+  }
+
+  std::vector<std::string> fields;
+  for (int i = 0; i < PyList_Size(py_fields); ++i) {
+    PyObject *py_field = PyList_GET_ITEM(py_fields, i);
+    if (!PyString_Check(py_field)) {
+      PyErr_SetString(PyExc_TypeError, "fields must be strings");
+      return nullptr;
+    }
+    fields.push_back(PyString_AsString(py_field));
+  }
+
+  return self->py_modules->get_pg_stats_columns_python(fields);
+}
+
+static PyObject*
+ceph_get_pg_state_bits(BaseMgrModule *self, PyObject *args)
+{
+  PyFormatter f;
+  for (unsigned bit = 0; bit < 64; ++bit) {
+    const std::string name = pg_state_string(1ull << bit);
+    if (name != "unknown") {
+      f.dump_unsigned(name.c_str(), 1ull << bit);
+    }
+  }
+  return f.get();
+}
+
 
 static PyObject*
 ceph_get_server(BaseMgrModule *self, PyObject *args)
@@ -450,6 +522,72 @@ ceph_set_module_option(BaseMgrModule *self, PyObject *args)
   Py_RETURN_NONE;
 }
 
+static PyObject*
+ceph_store_set_batch(BaseMgrModule *self, PyObject *args)
+{
+  PyObject *py_changes = nullptr;
+  PyObject *py_rm_prefixes = nullptr;
+  PyObject *completion = nullptr;
+  char *tag = nullptr;
+  if (!PyArg_ParseTuple(args, "OOOs:ceph_store_set_batch",
+			&py_changes, &py_rm_prefixes, &completion, &tag)) {
+    return nullptr;
+  }
+  if (!PyDict_Check(py_changes)) {
+    PyErr_SetString(PyExc_TypeError, "changes must be a dict");
+    return nullptr;
+  }
+  if (!PyList_Check(py_rm_prefixes)) {
+    PyErr_SetString(PyExc_TypeError, "prefixes must be a list");
+    return nullptr;
+  }
+
+  std::map<std::string, boost::optional<std::string>> changes;
+  PyObject *key, *value;
+  Py_ssize_t pos = 0;
+  while (PyDict_Next(py_changes, &pos, &key, &value)) {
+    if (!PyString_Check(key) ||
+	(value != Py_None && !PyString_Check(value))) {
+      PyErr_SetString(PyExc_TypeError,
+		      "changes must map strings to strings or None");
+      return nullptr;
+    }
+    boost::optional<std::string> val;
+    if (value != Py_None) {
+      val = PyString_AsString(value);
+    }
+    changes[PyString_AsString(key)] = val;
+  }
+
+  std::set<std::string> rm_prefixes;
+  for (int i = 0; i < PyList_Size(py_rm_prefixes); ++i) {
+    PyObject *py_prefix = PyList_GET_ITEM(py_rm_prefixes, i);
+    if (!PyString_Check(py_prefix)) {
+      PyErr_SetString(PyExc_TypeError, "prefixes must be strings");
+      return nullptr;
+    }
+    rm_prefixes.insert(PyString_AsString(py_prefix));
+  }
+
+  auto set_fn = PyObject_GetAttrString(completion, "complete");
+  if (set_fn == nullptr) {
+    return nullptr;
+  }
+  Py_DECREF(set_fn);
+
+  MonCommandCompletion *command_c = new MonCommandCompletion(self->py_modules,
+      completion, tag, PyThreadState_Get());
+
+  PyThreadState *tstate = PyEval_SaveThread();
+  self->py_modules->set_store_batch(
+    self->this_module->get_name(), changes, rm_prefixes,
+    &command_c->outbl, &command_c->outs,
+    new C_OnFinisher(command_c, &self->py_modules->cmd_finisher));
+  PyEval_RestoreThread(tstate);
+
+  Py_RETURN_NONE;
+}
+
 static PyObject*
 ceph_store_get(BaseMgrModule *self, PyObject *args)
 {
@@ -608,6 +746,34 @@ get_perf_schema(BaseMgrModule *self, PyObject *args)
   return self->py_modules->get_perf_schema_python(type_str, svc_id);
 }
 
+static PyObject*
+get_perf_counters_bulk(BaseMgrModule *self, PyObject *args)
+{
+  PyObject *py_svc_types = nullptr;
+  int prio_limit = 0;
+  if (!PyArg_ParseTuple(args, "Oi:get_perf_counters_bulk", &py_svc_types,
+			&prio_limit)) {
+    return nullptr;
+  }
+  if (!PyList_Check(py_svc_types)) {
+    PyErr_SetString(PyExc_TypeError, "service types must be a list");
+    return nullptr;
+  }
+
+  std::set<std::string> svc_types;
+  for (int i = 0; i < PyList_Size(py_svc_types); ++i) {
+    PyObject *py_svc_type = PyList_GET_ITEM(py_svc_types, i);
+    if (!PyString_Check(py_svc_type)) {
+      PyErr_SetString(PyExc_TypeError, "service types must be strings");
+      return nullptr;
+    }
+    svc_types.insert(PyString_AsString(py_svc_type));
+  }
+
+  return self->py_modules->get_perf_counters_bulk_python(svc_types,
+							  prio_limit);
+}
+
 static PyObject *
 ceph_get_osdmap(BaseMgrModule *self, PyObject *args)
 {
@@ -1005,6 +1171,21 @@ PyMethodDef BaseMgrModule_methods[] = {
   {"_ceph_get", (PyCFunction)ceph_state_get, METH_VARARGS,
    "Get a cluster object"},
 
+  {"_ceph_get_data_version", (PyCFunction)ceph_state_get_version, METH_VARARGS,
+   "Get the map epoch/version a cluster object is built from"},
+
+  {"_ceph_get_osdmap_changes", (PyCFunction)ceph_get_osdmap_changes,
+   METH_VARARGS, "Get OSDs and pools changed since an OSDMap epoch"},
+
+  {"_ceph_get_pgmap_changes", (PyCFunction)ceph_get_pgmap_changes,
+   METH_VARARGS, "Get PGs changed since a PGMap version"},
+
+  {"_ceph_get_pg_stats_columns", (PyCFunction)ceph_get_pg_stats_columns,
+   METH_VARARGS, "Get PG stats as packed int64 columns"},
+
+  {"_ceph_get_pg_state_bits", (PyCFunction)ceph_get_pg_state_bits,
+   METH_NOARGS, "Get the bit value of each PG state name"},
+
   {"_ceph_get_server", (PyCFunction)ceph_get_server, METH_VARARGS,
    "Get a server object"},
 
@@ -1041,6 +1222,9 @@ PyMethodDef BaseMgrModule_methods[] = {
   {"_ceph_set_store", (PyCFunction)ceph_store_set, METH_VARARGS,
    "Set a stored field"},
 
+  {"_ceph_set_store_batch", (PyCFunction)ceph_store_set_batch, METH_VARARGS,
+   "Apply several changes to the module's KV store in one transaction"},
+
   {"_ceph_get_counter", (PyCFunction)get_counter, METH_VARARGS,
     "Get a performance counter"},
 
@@ -1050,6 +1234,9 @@ PyMethodDef BaseMgrModule_methods[] = {
   {"_ceph_get_perf_schema", (PyCFunction)get_perf_schema, METH_VARARGS,
     "Get the performance counter schema"},
 
+  {"_ceph_get_perf_counters_bulk", (PyCFunction)get_perf_counters_bulk,
+    METH_VARARGS, "Get the schema and latest values of all perf counters"},
+
   {"_ceph_log", (PyCFunction)ceph_log, METH_VARARGS,
    "Emit a (local) log message"},
 
@@ -130,6 +130,7 @@ void ClusterState::update_delta_stats()
   jf.dump_object("pending_inc", pending_inc);
   jf.flush(*_dout);
   *_dout << dendl;
+  record_pgmap_delta(pending_inc);
   pg_map.apply_incremental(g_ceph_context, pending_inc);
   pending_inc = PGMap::Incremental();
 }
@@ -168,9 +169,249 @@ void ClusterState::notify_osdmap(const OSDMap &osd_map)
   jf.flush(*_dout);
   *_dout << dendl;
 
+  record_pgmap_delta(pending_inc);
   pg_map.apply_incremental(g_ceph_context, pending_inc);
   pending_inc = PGMap::Incremental();
+  record_osdmap_delta(osd_map);
   // TODO: Complete the separation of PG state handling so
   // that a cut-down set of functionality remains in PGMonitor
   // while the full-blown PGMap lives only here.
 }
+
+void ClusterState::osd_brief_t::dump(Formatter *f) const
+{
+  f->dump_bool("exists", exists);
+  f->dump_int("up", up);
+  f->dump_int("in", weight != CEPH_OSD_OUT);
+  f->dump_float("weight", (float)weight / (float)CEPH_OSD_IN);
+}
+
+void ClusterState::record_osdmap_delta(const OSDMap &osd_map)
+{
+  ceph_assert(ceph_mutex_is_locked(lock));
+
+  const epoch_t epoch = osd_map.get_epoch();
+  const bool first = osdmap_deltas_last == 0;
+  if (!first && epoch <= osdmap_deltas_last) {
+    return;
+  }
+
+  osdmap_delta_t delta;
+  delta.epoch = epoch;
+
+  int max_osd = osd_map.get_max_osd();
+  if (!osd_briefs.empty()) {
+    max_osd = std::max(max_osd, osd_briefs.rbegin()->first + 1);
+  }
+  for (int osd = 0; osd < max_osd; ++osd) {
+    osd_brief_t now;
+    if (osd_map.exists(osd)) {
+      now.exists = true;
+      now.up = osd_map.is_up(osd);
+      now.weight = osd_map.get_weight(osd);
+    }
+    auto p = osd_briefs.find(osd);
+    const osd_brief_t before = p == osd_briefs.end() ? osd_brief_t() : p->second;
+    if (now == before) {
+      continue;
+    }
+    delta.osds[osd] = std::make_pair(before, now);
+    if (now.exists) {
+      osd_briefs[osd] = now;
+    } else {
+      osd_briefs.erase(osd);
+    }
+  }
+
+  for (const auto &p : osd_map.get_pools()) {
+    auto q = pool_last_change.find(p.first);
+    if (q == pool_last_change.end()) {
+      delta.pools_created.insert(p.first);
+      pool_last_change[p.first] = p.second.get_last_change();
+    } else if (q->second != p.second.get_last_change()) {
+      delta.pools_modified.insert(p.first);
+      q->second = p.second.get_last_change();
+    }
+  }
+  for (auto q = pool_last_change.begin(); q != pool_last_change.end(); ) {
+    if (osd_map.have_pg_pool(q->first)) {
+      ++q;
+    } else {
+      delta.pools_removed.insert(q->first);
+      q = pool_last_change.erase(q);
+    }
+  }
+
+  osdmap_deltas_last = epoch;
+  if (first) {
+    // Nothing to compare the first map with: history starts here.
+    osdmap_deltas_from = epoch;
+    return;
+  }
+  if (!delta.empty()) {
+    osdmap_deltas.push_back(std::move(delta));
+  }
+  const auto max = g_conf().get_val<uint64_t>("mgr_osdmap_change_history");
+  while (osdmap_deltas.size() > max) {
+    osdmap_deltas_from = osdmap_deltas.front().epoch;
+    osdmap_deltas.pop_front();
+  }
+}
+
+void ClusterState::record_pgmap_delta(const PGMap::Incremental &inc)
+{
+  ceph_assert(ceph_mutex_is_locked(lock));
+
+  pgmap_delta_t delta;
+  delta.version = inc.version;
+  for (const auto &p : inc.pg_stat_updates) {
+    auto q = pg_map.pg_stat.find(p.first);
+    if (q == pg_map.pg_stat.end() ||
+	q->second.state != p.second.state ||
+	q->second.up != p.second.up ||
+	q->second.acting != p.second.acting) {
+      delta.changed.insert(p.first);
+    }
+  }
+  for (const auto &pgid : inc.pg_remove) {
+    if (pg_map.pg_stat.count(pgid)) {
+      delta.removed.insert(pgid);
+    }
+  }
+
+  if (!delta.empty()) {
+    pgmap_deltas.push_back(std::move(delta));
+  }
+  const auto max = g_conf().get_val<uint64_t>("mgr_pgmap_change_history");
+  while (pgmap_deltas.size() > max) {
+    pgmap_deltas_from = pgmap_deltas.front().version;
+    pgmap_deltas.pop_front();
+  }
+}
+
+void ClusterState::dump_osdmap_changes(epoch_t since, epoch_t until,
+				       Formatter *f) const
+{
+  ceph_assert(ceph_mutex_is_locked(lock));
+
+  if (until == 0 || until > osdmap_deltas_last) {
+    until = osdmap_deltas_last;
+  }
+
+  std::map<int32_t, std::pair<osd_brief_t, osd_brief_t>> osds;
+  std::set<int64_t> created, modified, removed;
+  for (const auto &delta : osdmap_deltas) {
+    if (delta.epoch <= since) {
+      continue;
+    }
+    if (delta.epoch > until) {
+      break;
+    }
+    for (const auto &p : delta.osds) {
+      auto r = osds.emplace(p.first, p.second);
+      if (!r.second) {
+	r.first->second.second = p.second.second;
+      }
+    }
+    for (auto pool : delta.pools_created) {
+      created.insert(pool);
+    }
+    for (auto pool : delta.pools_modified) {
+      if (!created.count(pool)) {
+	modified.insert(pool);
+      }
+    }
+    for (auto pool : delta.pools_removed) {
+      modified.erase(pool);
+      if (!created.erase(pool)) {
+	removed.insert(pool);
+      }
+    }
+  }
+
+  f->dump_unsigned("from_epoch", since);
+  f->dump_unsigned("to_epoch", std::max(since, until));
+  f->dump_bool("complete", osdmap_deltas_last && since >= osdmap_deltas_from);
+  f->open_array_section("osds");
+  for (const auto &p : osds) {
+    if (p.second.first == p.second.second) {
+      continue;
+    }
+    f->open_object_section("osd");
+    f->dump_int("osd", p.first);
+    f->open_object_section("old");
+    p.second.first.dump(f);
+    f->close_section();
+    f->open_object_section("new");
+    p.second.second.dump(f);
+    f->close_section();
+    f->close_section();
+  }
+  f->close_section();
+  f->open_array_section("pools_created");
+  for (auto pool : created) {
+    f->dump_int("pool", pool);
+  }
+  f->close_section();
+  f->open_array_section("pools_modified");
+  for (auto pool : modified) {
+    f->dump_int("pool", pool);
+  }
+  f->close_section();
+  f->open_array_section("pools_removed");
+  for (auto pool : removed) {
+    f->dump_int("pool", pool);
+  }
+  f->close_section();
+}
+
+void ClusterState::dump_pgmap_changes(version_t since, Formatter *f) const
+{
+  ceph_assert(ceph_mutex_is_locked(lock));
+
+  std::set<pg_t> changed, removed;
+  for (const auto &delta : pgmap_deltas) {
+    if (delta.version <= since) {
+      continue;
+    }
+    for (const auto &pgid : delta.changed) {
+      changed.insert(pgid);
+      removed.erase(pgid);
+    }
+    for (const auto &pgid : delta.removed) {
+      changed.erase(pgid);
+      removed.insert(pgid);
+    }
+  }
+
+  f->dump_unsigned("from_version", since);
+  f->dump_unsigned("to_version", std::max(since, pg_map.version));
+  f->dump_bool("complete", since >= pgmap_deltas_from);
+  f->open_array_section("pgs");
+  for (const auto &pgid : changed) {
+    auto p = pg_map.pg_stat.find(pgid);
+    if (p == pg_map.pg_stat.end()) {
+      continue;
+    }
+    f->open_object_section("pg");
+    f->dump_stream("pgid") << pgid;
+    f->dump_string("state", pg_state_string(p->second.state));
+    f->open_array_section("up");
+    for (auto osd : p->second.up) {
+      f->dump_int("osd", osd);
+    }
+    f->close_section();
+    f->open_array_section("acting");
+    for (auto osd : p->second.acting) {
+      f->dump_int("osd", osd);
+    }
+    f->close_section();
+    f->close_section();
+  }
+  f->close_section();
+  f->open_array_section("pgs_removed");
+  for (const auto &pgid : removed) {
+    f->dump_stream("pgid") << pgid;
+  }
+  f->close_section();
+}
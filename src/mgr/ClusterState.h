@@ -23,6 +23,8 @@
 #include "mon/PGMap.h"
 #include "mgr/ServiceMap.h"
 
+#include <deque>
+
 class MMgrDigest;
 class MMonMgrReport;
 class MPGStats;
@@ -50,6 +52,55 @@ protected:
   bufferlist health_json;
   bufferlist mon_status_json;
 
+  /// the OSD fields reported by dump_osdmap_changes()
+  struct osd_brief_t {
+    bool exists = false;
+    bool up = false;
+    uint32_t weight = 0;
+
+    bool operator==(const osd_brief_t& o) const {
+      return exists == o.exists && up == o.up && weight == o.weight;
+    }
+    bool operator!=(const osd_brief_t& o) const {
+      return !(*this == o);
+    }
+    void dump(Formatter *f) const;
+  };
+
+  struct osdmap_delta_t {
+    epoch_t epoch = 0;
+    std::map<int32_t, std::pair<osd_brief_t, osd_brief_t>> osds; ///< old, new
+    std::set<int64_t> pools_created, pools_modified, pools_removed;
+
+    bool empty() const {
+      return osds.empty() && pools_created.empty() &&
+	pools_modified.empty() && pools_removed.empty();
+    }
+  };
+
+  struct pgmap_delta_t {
+    version_t version = 0;
+    std::set<pg_t> changed; ///< state, up or acting changed
+    std::set<pg_t> removed;
+
+    bool empty() const {
+      return changed.empty() && removed.empty();
+    }
+  };
+
+  // Bounded history of what changed between the maps we have seen, so
+  // that python modules can ask for deltas instead of diffing full dumps.
+  std::map<int32_t, osd_brief_t> osd_briefs;
+  std::map<int64_t, epoch_t> pool_last_change;
+  std::deque<osdmap_delta_t> osdmap_deltas;
+  epoch_t osdmap_deltas_from = 0; ///< history is complete after this epoch
+  epoch_t osdmap_deltas_last = 0;
+  std::deque<pgmap_delta_t> pgmap_deltas;
+  version_t pgmap_deltas_from = 0;
+
+  void record_osdmap_delta(const OSDMap &osd_map);
+  void record_pgmap_delta(const PGMap::Incremental &inc);
+
 public:
 
   void load_digest(MMgrDigest *m);
@@ -69,6 +120,12 @@ public:
 
   void notify_osdmap(const OSDMap &osd_map);
 
+  // Dump what changed after `since` (and up to `until`, if non-zero).
+  // Callers must hold `lock`, e.g. by calling these from within
+  // with_pgmap().
+  void dump_osdmap_changes(epoch_t since, epoch_t until, Formatter *f) const;
+  void dump_pgmap_changes(version_t since, Formatter *f) const;
+
   bool have_fsmap() const {
     std::lock_guard l(lock);
     return fsmap.get_epoch() > 0;
@@ -418,6 +418,7 @@ bool DaemonServer::handle_open(const ref_t<MMgrOpen>& m)
 
     if (m->service_daemon) {
       daemon->set_metadata(m->daemon_metadata);
+      daemon_state.metadata_changed();
       daemon->service_status = m->daemon_status;
 
       utime_t now = ceph_clock_now();
@@ -2090,6 +2091,26 @@ bool DaemonServer::_handle_command(
       monc->start_mon_command({cmd}, json, nullptr, nullptr, on_finish);
     }
     return true;
+  } else if (prefix == "mgr module profile dump" ||
+	     prefix == "mgr module profile reset" ||
+	     prefix == "mgr module profile start" ||
+	     prefix == "mgr module profile stop" ||
+	     prefix == "mgr module profile stacks") {
+    string module_name;
+    cmd_getval(g_ceph_context, cmdctx->cmdmap, "module", module_name);
+    string action = prefix.substr(prefix.rfind(' ') + 1);
+    // these may call into the module, which means waiting for its GIL
+    finisher.queue(new FunctionContext(
+      [this, cmdctx, module_name, action, format](int r_) {
+	std::stringstream ss, ds;
+	std::unique_ptr<Formatter> f(
+	  Formatter::create(format, "json-pretty", "json-pretty"));
+	int r = py_modules.handle_profile_command(
+	  module_name, action, cmdctx->cmdmap, f.get(), &ds, &ss);
+	cmdctx->odata.append(ds);
+	cmdctx->reply(r, ss);
+      }));
+    return true;
   } else if (prefix == "device rm-life-expectancy") {
     string devid;
     cmd_getval(g_ceph_context, cmdctx->cmdmap, "devid", devid);
@@ -146,6 +146,7 @@ void DaemonStateIndex::_insert(DaemonStatePtr dm)
 
   by_server[dm->hostname][dm->key] = dm;
   all[dm->key] = dm;
+  ++metadata_version;
 
   for (auto& i : dm->devices) {
     auto d = _get_or_create_device(i.first);
@@ -179,6 +180,7 @@ void DaemonStateIndex::_erase(const DaemonKey& dmk)
   }
 
   all.erase(to_erase);
+  ++metadata_version;
 }
 
 DaemonStateCollection DaemonStateIndex::get_by_service(
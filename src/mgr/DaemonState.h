@@ -14,6 +14,7 @@
 #ifndef DAEMON_STATE_H_
 #define DAEMON_STATE_H_
 
+#include <atomic>
 #include <map>
 #include <string>
 #include <memory>
@@ -248,6 +249,9 @@ private:
 
   std::map<std::string,DeviceStateRef> devices;
 
+  /// bumped whenever a daemon is added, removed or its metadata changes
+  std::atomic<version_t> metadata_version = {0};
+
   void _erase(const DaemonKey& dmk);
 
   DeviceStateRef _get_or_create_device(const std::string& dev) {
@@ -356,6 +360,14 @@ public:
     }
   }
 
+  version_t get_metadata_version() const {
+    return metadata_version;
+  }
+  /// call after updating the metadata of an indexed DaemonState in place
+  void metadata_changed() {
+    ++metadata_version;
+  }
+
   void notify_updating(const DaemonKey &k) {
     RWLock::WLocker l(lock);
     updating.insert(k);
@@ -208,3 +208,21 @@ COMMAND("device set-life-expectancy name=devid,type=CephString "\
 COMMAND("device rm-life-expectancy name=devid,type=CephString",
 	"Clear predicted device life expectancy",
 	"mgr", "rw")
+
+COMMAND("mgr module profile dump name=module,type=CephString",
+	"Show call latencies and notification backlog of an active mgr module",
+	"mgr", "r")
+COMMAND("mgr module profile reset name=module,type=CephString",
+	"Reset the call latency counters of an active mgr module",
+	"mgr", "rw")
+COMMAND("mgr module profile start name=module,type=CephString "\
+	"name=interval,type=CephFloat,range=0.001,req=false",
+	"Start sampling the stacks of an active mgr module every <interval> seconds",
+	"mgr", "rw")
+COMMAND("mgr module profile stop name=module,type=CephString",
+	"Stop sampling the stacks of an active mgr module",
+	"mgr", "rw")
+COMMAND("mgr module profile stacks name=module,type=CephString "\
+	"name=count,type=CephInt,range=1,req=false",
+	"Show the most frequently sampled stacks of an active mgr module",
+	"mgr", "r")
@@ -300,6 +300,22 @@ int PyModuleRegistry::handle_command(
   }
 }
 
+int PyModuleRegistry::handle_profile_command(
+  const std::string &module_name,
+  const std::string &action,
+  const cmdmap_t &cmdmap,
+  Formatter *f,
+  std::stringstream *ds,
+  std::stringstream *ss)
+{
+  if (active_modules) {
+    return active_modules->handle_profile_command(module_name, action, cmdmap,
+						  f, ds, ss);
+  } else {
+    return -EAGAIN;
+  }
+}
+
 std::vector<ModuleCommand> PyModuleRegistry::get_py_commands() const
 {
   std::lock_guard l(lock);
@@ -144,6 +144,19 @@ public:
     std::stringstream *ds,
     std::stringstream *ss);
 
+  /**
+   * Report the call latency counters of an active module, or control
+   * its sampling profiler.  `action` is one of dump, reset, start, stop
+   * or stacks.
+   */
+  int handle_profile_command(
+    const std::string &module_name,
+    const std::string &action,
+    const cmdmap_t &cmdmap,
+    Formatter *f,
+    std::stringstream *ds,
+    std::stringstream *ss);
+
   /**
    * Pass through health checks reported by modules, and report any
    * modules that have failed (i.e. unhandled exceptions in serve())
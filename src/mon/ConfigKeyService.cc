@@ -22,6 +22,7 @@
 #include "mon/OSDMonitor.h"
 #include "common/errno.h"
 #include "include/stringify.h"
+#include "json_spirit/json_spirit.h"
 
 #include "include/ceph_assert.h" // re-clobber ceph_assert()
 #define dout_subsys ceph_subsys_mon
@@ -273,6 +274,90 @@ bool ConfigKeyService::service_dispatch(MonOpRequestRef op)
     // return for now; we'll put the message once it's done
     return true;
 
+  } else if (prefix == "config-key batch") {
+    if (!mon->is_leader()) {
+      mon->forward_request_leader(op);
+      return true;
+    }
+
+    // The batch comes in the input buffer:
+    //   {"set": [{"key": <key>, "val": <val>}, ...],
+    //    "rm": [<key>, ...], "rm_prefix": [<prefix>, ...]}
+    // and is applied in a single transaction: prefixes are removed
+    // first, then keys, then the new values are set.
+    json_spirit::mValue json_value;
+    if (!json_spirit::read(cmd->get_data().to_str(), json_value) ||
+	json_value.type() != json_spirit::obj_type) {
+      ret = -EINVAL;
+      ss << "batch must be a JSON object";
+      goto out;
+    }
+
+    map<string, bufferlist> to_set;
+    set<string> to_rm, to_rm_prefix;
+    try {
+      const auto &batch = json_value.get_obj();
+      auto p = batch.find("set");
+      if (p != batch.end()) {
+	for (const auto &i : p->second.get_array()) {
+	  const auto &kv = i.get_obj();
+	  bufferlist data;
+	  data.append(kv.at("val").get_str());
+	  to_set[kv.at("key").get_str()] = data;
+	}
+      }
+      p = batch.find("rm");
+      if (p != batch.end()) {
+	for (const auto &i : p->second.get_array()) {
+	  to_rm.insert(i.get_str());
+	}
+      }
+      p = batch.find("rm_prefix");
+      if (p != batch.end()) {
+	for (const auto &i : p->second.get_array()) {
+	  to_rm_prefix.insert(i.get_str());
+	}
+      }
+    } catch (const std::exception &e) {
+      ret = -EINVAL;
+      ss << "malformed batch: " << e.what();
+      goto out;
+    }
+
+    for (const auto &i : to_set) {
+      if (i.second.length() > (size_t) g_conf()->mon_config_key_max_entry_size) {
+	ret = -EFBIG;
+	ss << "error: '" << i.first << "': entry size limited to "
+	   << g_conf()->mon_config_key_max_entry_size << " bytes. "
+	   << "Use 'mon config key max entry size' to manually adjust";
+	goto out;
+      }
+    }
+    if (to_rm_prefix.count(string())) {
+      ret = -EINVAL;
+      ss << "refusing to remove the empty prefix";
+      goto out;
+    }
+
+    MonitorDBStore::TransactionRef t = paxos->get_pending_transaction();
+    for (const auto &prefix : to_rm_prefix) {
+      store_delete_prefix(t, prefix);
+    }
+    for (const auto &key : to_rm) {
+      store_delete(t, key);
+    }
+    for (auto &i : to_set) {
+      t->put(CONFIG_PREFIX, i.first, i.second);
+    }
+    ss << "set " << to_set.size() << " keys, removed " << to_rm.size()
+       << " keys and " << to_rm_prefix.size() << " prefixes";
+
+    // we'll reply to the message once the proposal has been handled
+    paxos->queue_pending_finisher(
+      new Monitor::C_Command(mon, op, 0, ss.str(), 0));
+    paxos->trigger_propose();
+    return true;
+
   } else if (prefix == "config-key exists") {
     bool exists = store_exists(key);
     ss << "key '" << key << "'";
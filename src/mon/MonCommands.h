@@ -1136,6 +1136,9 @@ COMMAND_WITH_FLAG("config-key del " \
 COMMAND("config-key rm " \
 	"name=key,type=CephString", \
 	"rm <key>", "config-key", "rw")
+COMMAND("config-key batch",
+	"apply the JSON batch of sets and removals given with -i in one "
+	"transaction", "config-key", "rw")
 COMMAND("config-key exists " \
 	"name=key,type=CephString", \
 	"check for <key>'s existence", "config-key", "r")
@@ -1 +1,4 @@
-from .module import Module
+import os
+
+if 'UNITTEST' not in os.environ:
+    from .module import Module
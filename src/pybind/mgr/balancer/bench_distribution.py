@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Benchmark the per-OSD accounting of the balancer's evaluation on a
+synthetic cluster, comparing the original per-PG dict walk with
+distribution.pool_distribution(), and check that they agree.
+
+Usage: bench_distribution.py [--osds N] [--pgs N] [--pools N] [--roots N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# simulate stands in for ceph_module, which mgr_module needs
+import simulate  # noqa: E402,F401
+import distribution  # noqa: E402
+
+
+def synthetic_cluster(osds, pgs, pools, roots, size=3, seed=0):
+    rng = random.Random(seed)
+    root_osds = [list(range(r, osds, roots)) for r in range(roots)]
+    target_by_root = {}
+    for r, members in enumerate(root_osds):
+        target_by_root['root%d' % r] = dict(
+            (osd, 1.0 / len(members)) for osd in members)
+    pool_roots = {}
+    pool_pgs = {}
+    for p in range(pools):
+        members = root_osds[p % roots]
+        pool_roots['pool%d' % p] = ['root%d' % (p % roots)]
+        ups = [rng.sample(members, min(size, len(members)))
+               for _ in range(pgs // pools)]
+        objects = [rng.randint(0, 10000) for _ in ups]
+        nbytes = [o * rng.randint(4096, 4 << 20) for o in objects]
+        pool_pgs['pool%d' % p] = (ups, objects, nbytes)
+    return target_by_root, pool_roots, pool_pgs
+
+
+def by_dict_walk(target_by_root, pool_roots, pool_pgs):
+    # the accounting calc_eval did before distribution.py, minus the
+    # pg_stat lookups by pgid
+    actual_by_root = {}
+    total_by_root = {}
+    for root, target in target_by_root.items():
+        actual_by_root[root] = {
+            'pgs': dict((osd, 0) for osd in target),
+            'objects': dict((osd, 0) for osd in target),
+            'bytes': dict((osd, 0) for osd in target),
+        }
+        total_by_root[root] = {'pgs': 0, 'objects': 0, 'bytes': 0}
+    count_by_pool = {}
+    for pool, (ups, objects, nbytes) in pool_pgs.items():
+        pgs_by_osd = {}
+        objects_by_osd = {}
+        bytes_by_osd = {}
+        for root in pool_roots[pool]:
+            for osd in target_by_root[root]:
+                pgs_by_osd[osd] = 0
+                objects_by_osd[osd] = 0
+                bytes_by_osd[osd] = 0
+        for pgid, up in enumerate(ups):
+            for osd in [int(osd) for osd in up]:
+                if osd == distribution.ITEM_NONE:
+                    continue
+                pgs_by_osd[osd] += 1
+                objects_by_osd[osd] += objects[pgid]
+                bytes_by_osd[osd] += nbytes[pgid]
+                for root in pool_roots[pool]:
+                    if osd in target_by_root[root]:
+                        actual_by_root[root]['pgs'][osd] += 1
+                        actual_by_root[root]['objects'][osd] += objects[pgid]
+                        actual_by_root[root]['bytes'][osd] += nbytes[pgid]
+                        total_by_root[root]['pgs'] += 1
+                        total_by_root[root]['objects'] += objects[pgid]
+                        total_by_root[root]['bytes'] += nbytes[pgid]
+                        break
+        count_by_pool[pool] = {
+            'pgs': pgs_by_osd,
+            'objects': objects_by_osd,
+            'bytes': bytes_by_osd,
+        }
+    return count_by_pool, actual_by_root, total_by_root
+
+
+def by_distribution(target_by_root, pool_roots, pool_pgs, max_osd,
+                    use_numpy):
+    actual_by_root = {}
+    total_by_root = {}
+    for root, target in target_by_root.items():
+        actual_by_root[root] = {
+            'pgs': dict((osd, 0) for osd in target),
+            'objects': dict((osd, 0) for osd in target),
+            'bytes': dict((osd, 0) for osd in target),
+        }
+        total_by_root[root] = {'pgs': 0, 'objects': 0, 'bytes': 0}
+    count_by_pool = {}
+    for pool, (ups, objects, nbytes) in pool_pgs.items():
+        by_osd, by_root = distribution.pool_distribution(
+            ups, objects, nbytes, max_osd,
+            [(root, target_by_root[root]) for root in pool_roots[pool]],
+            use_numpy)
+        for root, counts in by_root.items():
+            for t in ('pgs', 'objects', 'bytes'):
+                for osd, v in counts[t].items():
+                    actual_by_root[root][t][osd] += v
+                total_by_root[root][t] += sum(counts[t].values())
+        count_by_pool[pool] = by_osd
+    return count_by_pool, actual_by_root, total_by_root
+
+
+def best_of(repeat, fn, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = fn(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--osds', type=int, default=1000)
+    parser.add_argument('--pgs', type=int, default=200000)
+    parser.add_argument('--pools', type=int, default=8)
+    parser.add_argument('--roots', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    cluster = synthetic_cluster(args.osds, args.pgs, args.pools, args.roots)
+    print('%d osds, %d pgs in %d pools under %d roots' %
+          (args.osds, args.pgs, args.pools, args.roots))
+
+    base, expected = best_of(args.repeat, by_dict_walk, *cluster)
+    print('%-12s %8.3fs' % ('dict walk', base))
+    variants = [('array', False)]
+    if distribution.np is not None:
+        variants.append(('numpy', True))
+    failed = False
+    for name, use_numpy in variants:
+        elapsed, result = best_of(args.repeat, by_distribution,
+                                  *(cluster + (args.osds, use_numpy)))
+        ok = result == expected
+        failed = failed or not ok
+        print('%-12s %8.3fs  %5.1fx  %s' %
+              (name, elapsed, base / elapsed, 'ok' if ok else 'MISMATCH'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Per-OSD accounting of the PGs, objects and bytes of a pool, for the
+balancer's evaluation of a mapping.
+
+The counts are accumulated in arrays indexed by OSD id, which are dense
+(0 to max_osd - 1), with NumPy when it is available and the array module
+otherwise, in the same type as the PG stats columns they add up.  Nothing
+here calls into the mgr, so it can be benchmarked outside of it, see
+bench_distribution.py.
+"""
+
+import array
+import itertools
+
+from mgr_module import CRUSHMap, PG_STATS_COLUMN_TYPECODE
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# a hole in an up set
+ITEM_NONE = CRUSHMap.ITEM_NONE
+
+
+def _count_numpy(ups, objects, nbytes, size):
+    lengths = np.fromiter((len(up) for up in ups), dtype=np.int64,
+                          count=len(ups))
+    osds = np.fromiter(itertools.chain.from_iterable(ups), dtype=np.int64,
+                       count=int(lengths.sum()))
+    pg_objects = np.repeat(np.asarray(objects, dtype=np.int64), lengths)
+    pg_bytes = np.repeat(np.asarray(nbytes, dtype=np.int64), lengths)
+    keep = (osds >= 0) & (osds < size)
+    osds = osds[keep]
+    pgs_by_osd = np.bincount(osds, minlength=size)
+    # np.add.at rather than bincount weights, which would sum as floats
+    objects_by_osd = np.zeros(size, dtype=np.int64)
+    np.add.at(objects_by_osd, osds, pg_objects[keep])
+    bytes_by_osd = np.zeros(size, dtype=np.int64)
+    np.add.at(bytes_by_osd, osds, pg_bytes[keep])
+    return (pgs_by_osd.tolist(), objects_by_osd.tolist(),
+            bytes_by_osd.tolist())
+
+
+def _count_array(ups, objects, nbytes, size):
+    pgs_by_osd = array.array(PG_STATS_COLUMN_TYPECODE, [0]) * size
+    objects_by_osd = array.array(PG_STATS_COLUMN_TYPECODE, [0]) * size
+    bytes_by_osd = array.array(PG_STATS_COLUMN_TYPECODE, [0]) * size
+    for up, pg_objects, pg_bytes in zip(ups, objects, nbytes):
+        for osd in up:
+            # also skips ITEM_NONE
+            if 0 <= osd < size:
+                pgs_by_osd[osd] += 1
+                objects_by_osd[osd] += pg_objects
+                bytes_by_osd[osd] += pg_bytes
+    return pgs_by_osd, objects_by_osd, bytes_by_osd
+
+
+def count_by_osd(ups, objects, nbytes, size, use_numpy=True):
+    """
+    Count the PG instances, objects and bytes of a pool on each OSD.
+
+    :param ups: up set (list of OSD ids) of each PG
+    :param objects: number of objects of each PG, in the order of ``ups``
+    :param nbytes: number of bytes of each PG, in the order of ``ups``
+    :param size: number of OSD ids, i.e. max_osd
+    :param use_numpy: use NumPy if it is available
+    :return: ``(pgs, objects, bytes)``, each indexed by OSD id
+    """
+    if use_numpy and np is not None and ups:
+        return _count_numpy(ups, objects, nbytes, size)
+    return _count_array(ups, objects, nbytes, size)
+
+
+def pool_distribution(ups, objects, nbytes, size, roots, use_numpy=True):
+    """
+    Work out where the PGs of a pool are, per OSD and per CRUSH root.
+
+    An OSD under several of the pool's roots is accounted for under the
+    first one only.
+
+    :param roots: ``(root name, target weight by OSD)`` of each root the
+        pool maps to, in order
+    :return: ``(by_osd, by_root)``, where ``by_osd`` maps ``pgs``,
+        ``objects`` and ``bytes`` to dicts of count by OSD, for the OSDs
+        under any of ``roots``, and ``by_root`` maps each root name to the
+        same for the OSDs accounted for under it
+    """
+    pgs, objs, byts = count_by_osd(ups, objects, nbytes, size, use_numpy)
+    by_osd = {
+        'pgs': {},
+        'objects': {},
+        'bytes': {},
+    }
+    by_root = {}
+    for root, target in roots:
+        counts = {
+            'pgs': {},
+            'objects': {},
+            'bytes': {},
+        }
+        for osd in target:
+            if osd in by_osd['pgs']:
+                continue
+            if 0 <= osd < size:
+                p, o, b = pgs[osd], objs[osd], byts[osd]
+            else:
+                p, o, b = 0, 0, 0
+            by_osd['pgs'][osd] = counts['pgs'][osd] = p
+            by_osd['objects'][osd] = counts['objects'][osd] = o
+            by_osd['bytes'][osd] = counts['bytes'][osd] = b
+        by_root[root] = counts
+    return by_osd, by_root
@@ -3,6 +3,8 @@
 Balance PG distribution across OSDs.
 """
 
+import array
+import collections
 import copy
 import errno
 import json
@@ -12,37 +14,141 @@ import six
 import time
 from mgr_module import MgrModule, CommandResult
 from threading import Event
-from mgr_module import CRUSHMap
+from mgr_module import CRUSHMap, PG_STATS_COLUMN_TYPECODE
+from .distribution import pool_distribution
 
 TIME_FORMAT = '%Y-%m-%d_%H:%M:%S'
 
+class PGStats:
+    """
+    The object and byte counts of every PG, as one array per pool indexed
+    by placement seed, from the columns of get_pg_stats_columns().
+    """
+    FIELDS = ['pool', 'ps', 'num_objects', 'num_bytes']
+
+    def __init__(self, columns):
+        self.by_poolid = {}  # pool id -> (objects, bytes)
+        pg_num = {}
+        for poolid, ps in zip(columns['pool'], columns['ps']):
+            if ps >= pg_num.get(poolid, 0):
+                pg_num[poolid] = ps + 1
+        for poolid, n in six.iteritems(pg_num):
+            self.by_poolid[poolid] = (
+                array.array(PG_STATS_COLUMN_TYPECODE, [0]) * n,
+                array.array(PG_STATS_COLUMN_TYPECODE, [0]) * n,
+            )
+        for poolid, ps, objects, nbytes in zip(columns['pool'],
+                                               columns['ps'],
+                                               columns['num_objects'],
+                                               columns['num_bytes']):
+            pool_objects, pool_bytes = self.by_poolid[poolid]
+            pool_objects[ps] = objects
+            pool_bytes[ps] = nbytes
+
+    def objects(self, pgid):
+        """
+        :return: the number of objects in a PG, 0 if it is not reported
+        """
+        poolid, ps = pgid.split('.')
+        pool_objects = self.by_poolid.get(int(poolid), ((), ()))[0]
+        ps = int(ps, 16)
+        return pool_objects[ps] if ps < len(pool_objects) else 0
+
 class MappingState:
-    def __init__(self, osdmap, pg_dump, desc=''):
+    def __init__(self, osdmap, pg_stats, desc=''):
         self.desc = desc
         self.osdmap = osdmap
         self.osdmap_dump = self.osdmap.dump()
         self.crush = osdmap.get_crush()
         self.crush_dump = self.crush.dump()
-        self.pg_dump = pg_dump
-        self.pg_stat = {
-            i['pgid']: i['stat_sum'] for i in pg_dump.get('pg_stats', [])
-        }
+        self.pg_stats = pg_stats
         osd_poolids = [p['pool'] for p in self.osdmap_dump.get('pools', [])]
-        pg_poolids = [p['poolid'] for p in pg_dump.get('pool_stats', [])]
-        self.poolids = set(osd_poolids) & set(pg_poolids)
-        self.pg_up = {}
+        self.poolids = set(osd_poolids) & set(pg_stats.by_poolid)
         self.pg_up_by_poolid = {}
         for poolid in self.poolids:
             self.pg_up_by_poolid[poolid] = osdmap.map_pool_pgs_up(poolid)
-            for a,b in six.iteritems(self.pg_up_by_poolid[poolid]):
-                self.pg_up[a] = b
+        self.misplaced_by_poolid = {}  # pool id -> (up sets before, count)
+        self.evals = {}  # (pools, metrics) -> Eval, see Module.calc_eval()
+
+    def with_pg_stats(self, pg_stats):
+        """
+        Derive the MappingState of the same osdmap with newer PG stats.
+        The up sets are shared with us; only pools which gained or lost
+        their stats are mapped or dropped.
+        """
+        ms = copy.copy(self)
+        ms.pg_stats = pg_stats
+        osd_poolids = [p['pool'] for p in self.osdmap_dump.get('pools', [])]
+        ms.poolids = set(osd_poolids) & set(pg_stats.by_poolid)
+        ms.pg_up_by_poolid = {}
+        for poolid in ms.poolids:
+            if poolid in self.pg_up_by_poolid:
+                ms.pg_up_by_poolid[poolid] = self.pg_up_by_poolid[poolid]
+            else:
+                ms.pg_up_by_poolid[poolid] = \
+                    self.osdmap.map_pool_pgs_up(poolid)
+        ms.misplaced_by_poolid = dict(self.misplaced_by_poolid)
+        ms.evals = {}
+        return ms
+
+    def remap(self, osdmap, poolids, desc=''):
+        """
+        Derive the MappingState of osdmap, which must differ from ours in
+        its CRUSH weights only, by mapping the PGs of poolids again.  The
+        up sets of the other pools, and the osdmap dump, are shared with us.
+        """
+        ms = copy.copy(self)
+        ms.desc = desc
+        ms.osdmap = osdmap
+        ms.crush = osdmap.get_crush()
+        ms.crush_dump = ms.crush.dump()
+        ms.pg_up_by_poolid = dict(self.pg_up_by_poolid)
+        ms.misplaced_by_poolid = dict(self.misplaced_by_poolid)
+        ms.evals = {}
+        for poolid in poolids:
+            if poolid in ms.poolids:
+                ms.pg_up_by_poolid[poolid] = osdmap.map_pool_pgs_up(poolid)
+                ms.misplaced_by_poolid.pop(poolid, None)
+        return ms
+
+    def pool_pgs(self, poolid):
+        """
+        :return: ``(ups, objects, bytes)``: the up set, object count and
+            byte count of each PG of a pool, in the same order
+        """
+        pool_objects, pool_bytes = self.pg_stats.by_poolid[poolid]
+        ups = []
+        objects = []
+        nbytes = []
+        for pgid, up in six.iteritems(self.pg_up_by_poolid[poolid]):
+            ps = int(pgid[pgid.index('.') + 1:], 16)
+            ups.append(up)
+            if ps < len(pool_objects):
+                objects.append(pool_objects[ps])
+                nbytes.append(pool_bytes[ps])
+            else:
+                # not reported yet, e.g. just split
+                objects.append(0)
+                nbytes.append(0)
+        return ups, objects, nbytes
 
     def calc_misplaced_from(self, other_ms):
-        num = len(other_ms.pg_up)
+        num = 0
         misplaced = 0
-        for pgid, before in six.iteritems(other_ms.pg_up):
-            if before != self.pg_up.get(pgid, []):
-                misplaced += 1
+        for poolid, before_pgs in six.iteritems(other_ms.pg_up_by_poolid):
+            num += len(before_pgs)
+            # pools whose up sets we share with a remap()ed state keep
+            # their count
+            cached = self.misplaced_by_poolid.get(poolid)
+            if cached is None or cached[0] is not before_pgs:
+                after_pgs = self.pg_up_by_poolid.get(poolid, {})
+                count = 0
+                for pgid, before in six.iteritems(before_pgs):
+                    if before != after_pgs.get(pgid, []):
+                        count += 1
+                cached = (before_pgs, count)
+                self.misplaced_by_poolid[poolid] = cached
+            misplaced += cached[1]
         if num > 0:
             return float(misplaced) / float(num)
         return 0.0
@@ -58,12 +164,20 @@ class Plan:
         self.compat_ws = {}
         self.inc = ms.osdmap.new_incremental()
 
-    def final_state(self):
+    def final_state(self, remap_from=None, poolids=None):
+        """
+        :param remap_from: a MappingState this plan's differs from in the
+            compat weight-set only, see MappingState.remap()
+        :param poolids: the pools whose PGs may map differently from
+            remap_from's
+        """
         self.inc.set_osd_reweights(self.osd_weights)
         self.inc.set_crush_compat_weight_set_weights(self.compat_ws)
-        return MappingState(self.initial.osdmap.apply_incremental(self.inc),
-                            self.initial.pg_dump,
-                            'plan %s final' % self.name)
+        osdmap = self.initial.osdmap.apply_incremental(self.inc)
+        desc = 'plan %s final' % self.name
+        if remap_from is not None:
+            return remap_from.remap(osdmap, poolids, desc)
+        return MappingState(osdmap, self.initial.pg_stats, desc)
 
     def dump(self):
         return json.dumps(self.inc.dump(), indent=4)
@@ -94,6 +208,52 @@ class Plan:
         return '\n'.join(ls)
 
 
+class UpmapExecution:
+    """
+    The upmap changes of an executed plan, which serve() submits in
+    batches that keep the misplaced objects under
+    target_max_misplaced_ratio, one batch after the PGs of the previous
+    one have reported stats from the osdmap epoch it made.
+    """
+    def __init__(self, plan_name, changes, automatic, upmaps):
+        self.plan_name = plan_name
+        self.automatic = automatic
+        self.pending = collections.deque(changes)  # (pgid, objects, commands)
+        self.upmaps = upmaps      # pgid -> pg_upmap_items the plan started from
+        self.submitted = 0
+        self.failed = 0
+        self.dropped = 0          # changes whose PG's upmap changed since
+        self.batches = 0
+        self.objects = 0          # objects moved by the submitted changes
+        self.started = time.time()
+        self.last_batch = None    # time, changes, objects
+        self.epoch = None         # osdmap epoch made by the last batch
+        self.pgids = []           # of the last batch's, those not reported
+        self.pg_version = None    # PG stats version last checked
+        self.waiting = ''         # why the next batch is held back
+
+    def dump(self):
+        elapsed = time.time() - self.started
+        r = {
+            'plan': self.plan_name,
+            'pending': len(self.pending),
+            'submitted': self.submitted,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'objects': self.objects,
+            'elapsed': elapsed,
+            'changes_per_second': self.submitted / elapsed if elapsed else 0.0,
+            'waiting': self.waiting,
+        }
+        if self.last_batch:
+            r['last_batch'] = {
+                'age': time.time() - self.last_batch[0],
+                'changes': self.last_batch[1],
+                'objects': self.last_batch[2],
+            }
+        return r
+
 class Eval:
     def __init__(self, ms):
         self.ms = ms
@@ -111,6 +271,8 @@ class Eval:
         self.total_by_root = {}   # root -> by_* -> total
         self.stats_by_pool = {}   # pool -> by_* -> stddev or avg -> value
         self.stats_by_root = {}   # root -> by_* -> stddev or avg -> value
+        # pool -> (up sets, targets, by_osd, by_root), for calc_eval(prev=)
+        self.pool_counts = {}
 
         self.score_by_pool = {}
         self.score_by_root = {}
@@ -306,6 +468,32 @@ class Module(MgrModule):
             'long_desc': 'If the ratio between the fullest and least-full OSD is below this value then we stop trying to optimize placement.',
             'runtime': True,
         },
+        {
+            'name': 'upmap_max_batch',
+            'type': 'uint',
+            'default': 100,
+            'min': 1,
+            'desc': 'maximum number of upmap changes submitted at once',
+            'long_desc': 'The upmap changes of a plan are submitted in batches, each as large as the misplaced objects budget (target_max_misplaced_ratio) allows, up to this many changes.',
+            'runtime': True,
+        },
+        {
+            'name': 'upmap_batch_interval',
+            'type': 'secs',
+            'default': 5,
+            'min': 1,
+            'desc': 'how often to check whether the next batch of upmap changes can be submitted',
+            'runtime': True,
+        },
+        {
+            'name': 'upmap_batch_timeout',
+            'type': 'secs',
+            'default': 600,
+            'min': 1,
+            'desc': 'how long to wait for the PGs of a batch of upmap changes to report stats before submitting the next batch anyway',
+            'long_desc': 'PGs which have not reported stats from the osdmap epoch of the last batch after this long, e.g. stale or stuck peering ones, are logged and no longer waited for.',
+            'runtime': True,
+        },
         {
             'name': 'pool_ids',
             'type': 'str',
@@ -399,10 +587,14 @@ class Module(MgrModule):
             "perm": "rw",
         },
     ]
+    DATA_CACHE = True
     active = False
     run = True
     plans = {}
     mode = ''
+    upmap_execution = None
+    mapping_state = None  # (osdmap epoch, PG stats version, MappingState)
+    upmap_idle = None     # what do_upmap() last found nothing to do for
 
     def __init__(self, *args, **kwargs):
         super(Module, self).__init__(*args, **kwargs)
@@ -416,6 +608,8 @@ class Module(MgrModule):
                 'active': self.active,
                 'mode': self.get_module_option('mode'),
             }
+            if self.upmap_execution:
+                s['upmap_execution'] = self.upmap_execution.dump()
             return (0, json.dumps(s, indent=4), '')
         elif command['prefix'] == 'balancer mode':
             if command['mode'] == 'upmap':
@@ -446,7 +640,7 @@ class Module(MgrModule):
                 return (0, '', '')
             pool_ids = pool_ids.split(',')
             pool_ids = [int(p) for p in pool_ids]
-            pool_name_by_id = dict((p['pool'], p['pool_name']) for p in self.get_osdmap().dump().get('pools', []))
+            pool_name_by_id = dict((p, v['pool_name']) for p, v in six.iteritems(self.get_osdmap().get_pools()))
             should_prune = False
             final_ids = []
             final_names = []
@@ -461,7 +655,7 @@ class Module(MgrModule):
             return (0, json.dumps(final_names, indent=4), '')
         elif command['prefix'] == 'balancer pool add':
             raw_names = command['pools']
-            pool_id_by_name = dict((p['pool_name'], p['pool']) for p in self.get_osdmap().dump().get('pools', []))
+            pool_id_by_name = dict((p, v['pool']) for p, v in six.iteritems(self.get_osdmap().get_pools_by_name()))
             invalid_names = [p for p in raw_names if p not in pool_id_by_name]
             if invalid_names:
                 return (-errno.EINVAL, '', 'pool(s) %s not found' % invalid_names)
@@ -500,14 +694,13 @@ class Module(MgrModule):
                     if option not in valid_pool_names:
                          return (-errno.EINVAL, '', 'option "%s" not a plan or a pool' % option)
                     pools.append(option)
-                    ms = MappingState(osdmap, self.get("pg_dump"), 'pool "%s"' % option)
+                    ms = self.get_mapping_state(osdmap, 'pool "%s"' % option)
                 else:
                     pools = plan.pools
                     ms = plan.final_state()
             else:
-                ms = MappingState(self.get_osdmap(),
-                                  self.get("pg_dump"),
-                                  'current cluster')
+                ms = self.get_mapping_state(self.get_osdmap(),
+                                            'current cluster')
             return (0, self.evaluate(ms, pools, verbose=verbose), '')
         elif command['prefix'] == 'balancer optimize':
             pools = []
@@ -533,6 +726,7 @@ class Module(MgrModule):
             return (0, '', '')
         elif command['prefix'] == 'balancer reset':
             self.plans = {}
+            self.upmap_execution = None
             return (0, '', '')
         elif command['prefix'] == 'balancer ls':
             return (0, json.dumps([p for p in self.plans], indent=4), '')
@@ -600,7 +794,9 @@ class Module(MgrModule):
             self.log.debug('Waking up [%s, now %s]',
                            "active" if self.active else "inactive",
                            time.strftime(TIME_FORMAT, time.localtime()))
-            if self.active and self.time_permit():
+            if self.execute_upmap_batch():
+                sleep_interval = self.get_module_option('upmap_batch_interval')
+            elif self.active and self.time_permit():
                 self.log.debug('Running')
                 name = 'auto_%s' % time.strftime(TIME_FORMAT, time.gmtime())
                 osdmap = self.get_osdmap()
@@ -618,7 +814,7 @@ class Module(MgrModule):
                 plan = self.plan_create(name, osdmap, final)
                 r, detail = self.optimize(plan)
                 if r == 0:
-                    self.execute(plan)
+                    self.execute(plan, automatic=True)
                 self.plan_rm(name)
             self.log.debug('Sleeping for %d', sleep_interval)
             self.event.wait(sleep_interval)
@@ -626,18 +822,62 @@ class Module(MgrModule):
 
     def plan_create(self, name, osdmap, pools):
         plan = Plan(name,
-                    MappingState(osdmap,
-                                 self.get("pg_dump"),
-                                 'plan %s initial' % name),
+                    self.get_mapping_state(osdmap, 'plan %s initial' % name),
                     pools)
         self.plans[name] = plan
         return plan
 
+    def get_pg_stats(self):
+        return PGStats(self.get_pg_stats_columns(PGStats.FIELDS))
+
+    def get_mapping_state(self, osdmap, desc):
+        """
+        :param osdmap: the cluster's current map, from get_osdmap()
+        :return: a MappingState of osdmap.  The last one built is kept and
+            reused as long as the osdmap epoch does not change, with only
+            the PG stats refreshed when their version does, so that an
+            idle balancer does not map every PG on each wake-up.  Nothing
+            is kept if the PG stats are not versioned.
+        """
+        epoch = osdmap.get_epoch()
+        version = self.get_data_version('pg_dump')
+        if version is None:
+            self.mapping_state = None
+            return MappingState(osdmap, self.get_pg_stats(), desc)
+        pg_version = version[1]
+        cached = self.mapping_state
+        if cached is None or cached[0] != epoch:
+            ms = MappingState(osdmap, self.get_pg_stats(), desc)
+        elif cached[1] != pg_version:
+            self.log.debug('reusing the mapping of epoch %d' % epoch)
+            ms = cached[2].with_pg_stats(self.get_pg_stats())
+        else:
+            self.log.debug('reusing the mapping state of epoch %d' % epoch)
+            ms = cached[2]
+        self.mapping_state = (epoch, pg_version, ms)
+        if ms.desc != desc:
+            # shares the evals of the cached one
+            ms = copy.copy(ms)
+            ms.desc = desc
+        return ms
+
     def plan_rm(self, name):
         if name in self.plans:
             del self.plans[name]
 
-    def calc_eval(self, ms, pools):
+    def calc_eval(self, ms, pools, prev=None):
+        """
+        :param prev: an Eval of a state ms was remap()ed from (or vice
+            versa), whose counts are reused for the pools with the same up
+            sets, and whose stats are reused for the roots of those only
+        """
+        # get the list of score metrics, comma separated
+        metrics = self.get_module_option('crush_compat_metrics').split(',')
+        key = (tuple(sorted(pools)), tuple(metrics))
+        if key in ms.evals:
+            pe = copy.copy(ms.evals[key])
+            pe.ms = ms
+            return pe
         pe = Eval(ms)
         pool_rule = {}
         pool_info = {}
@@ -710,77 +950,61 @@ class Module(MgrModule):
         self.log.debug('target_by_root %s' % pe.target_by_root)
 
         # pool and root actual
+        if prev is not None and prev.ms.pg_stats is not ms.pg_stats:
+            prev = None
+        max_osd = ms.osdmap_dump.get('max_osd', 0)
+        recounted_roots = set()
         for pool, pi in six.iteritems(pool_info):
-            poolid = pi['pool']
-            pm = ms.pg_up_by_poolid[poolid]
-            pgs = 0
-            objects = 0
-            bytes = 0
-            pgs_by_osd = {}
-            objects_by_osd = {}
-            bytes_by_osd = {}
-            for root in pe.pool_roots[pool]:
-                for osd in pe.target_by_root[root]:
-                    pgs_by_osd[osd] = 0
-                    objects_by_osd[osd] = 0
-                    bytes_by_osd[osd] = 0
-            for pgid, up in six.iteritems(pm):
-                for osd in [int(osd) for osd in up]:
-                    if osd == CRUSHMap.ITEM_NONE:
-                        continue
-                    pgs_by_osd[osd] += 1
-                    objects_by_osd[osd] += ms.pg_stat[pgid]['num_objects']
-                    bytes_by_osd[osd] += ms.pg_stat[pgid]['num_bytes']
-                    # pick a root to associate this pg instance with.
-                    # note that this is imprecise if the roots have
-                    # overlapping children.
-                    # FIXME: divide bytes by k for EC pools.
-                    for root in pe.pool_roots[pool]:
-                        if osd in pe.target_by_root[root]:
-                            actual_by_root[root]['pgs'][osd] += 1
-                            actual_by_root[root]['objects'][osd] += ms.pg_stat[pgid]['num_objects']
-                            actual_by_root[root]['bytes'][osd] += ms.pg_stat[pgid]['num_bytes']
-                            pgs += 1
-                            objects += ms.pg_stat[pgid]['num_objects']
-                            bytes += ms.pg_stat[pgid]['num_bytes']
-                            pe.total_by_root[root]['pgs'] += 1
-                            pe.total_by_root[root]['objects'] += ms.pg_stat[pgid]['num_objects']
-                            pe.total_by_root[root]['bytes'] += ms.pg_stat[pgid]['num_bytes']
-                            break
-            pe.count_by_pool[pool] = {
-                'pgs': {
-                    k: v
-                    for k, v in six.iteritems(pgs_by_osd)
-                },
-                'objects': {
-                    k: v
-                    for k, v in six.iteritems(objects_by_osd)
-                },
-                'bytes': {
-                    k: v
-                    for k, v in six.iteritems(bytes_by_osd)
-                },
+            pgs = ms.pg_up_by_poolid[pi['pool']]
+            targets = [(root, pe.target_by_root[root])
+                       for root in pe.pool_roots[pool]]
+            cached = prev.pool_counts.get(pool) if prev is not None else None
+            if cached is not None and cached[0] is pgs and \
+               cached[1] == targets:
+                # same up sets and targets as prev's
+                pe.pool_counts[pool] = cached
+                pe.count_by_pool[pool] = prev.count_by_pool[pool]
+                pe.actual_by_pool[pool] = prev.actual_by_pool[pool]
+                pe.total_by_pool[pool] = prev.total_by_pool[pool]
+                continue
+            ups, objects, nbytes = ms.pool_pgs(pi['pool'])
+            # FIXME: divide bytes by k for EC pools.
+            by_osd, by_root = pool_distribution(ups, objects, nbytes,
+                                                max_osd, targets)
+            pe.pool_counts[pool] = (pgs, targets, by_osd, by_root)
+            recounted_roots.update(pe.pool_roots[pool])
+            total = {
+                'pgs': 0,
+                'objects': 0,
+                'bytes': 0,
             }
+            for counts in by_root.values():
+                for t in ('pgs', 'objects', 'bytes'):
+                    total[t] += sum(counts[t].values())
+            pe.count_by_pool[pool] = by_osd
             pe.actual_by_pool[pool] = {
-                'pgs': {
-                    k: float(v) / float(max(pgs, 1))
-                    for k, v in six.iteritems(pgs_by_osd)
-                },
-                'objects': {
-                    k: float(v) / float(max(objects, 1))
-                    for k, v in six.iteritems(objects_by_osd)
-                },
-                'bytes': {
-                    k: float(v) / float(max(bytes, 1))
-                    for k, v in six.iteritems(bytes_by_osd)
-                },
-            }
-            pe.total_by_pool[pool] = {
-                'pgs': pgs,
-                'objects': objects,
-                'bytes': bytes,
+                t: {
+                    k: float(v) / float(max(total[t], 1))
+                    for k, v in six.iteritems(by_osd[t])
+                } for t in ('pgs', 'objects', 'bytes')
             }
+            pe.total_by_pool[pool] = total
+        reused_roots = set()
         for root in pe.total_by_root:
+            if prev is not None and root not in recounted_roots and \
+               prev.root_pools.get(root) == pe.root_pools[root]:
+                reused_roots.add(root)
+                pe.count_by_root[root] = prev.count_by_root[root]
+                pe.actual_by_root[root] = prev.actual_by_root[root]
+                pe.total_by_root[root] = prev.total_by_root[root]
+                continue
+            for pool in pe.root_pools[root]:
+                counts = pe.pool_counts[pool][3][root]
+                for t in ('pgs', 'objects', 'bytes'):
+                    actual = actual_by_root[root][t]
+                    for osd, v in six.iteritems(counts[t]):
+                        actual[osd] += v
+                    pe.total_by_root[root][t] += sum(counts[t].values())
             pe.count_by_root[root] = {
                 'pgs': {
                     k: float(v)
@@ -814,7 +1038,7 @@ class Module(MgrModule):
 
         # average and stddev and score
         pe.stats_by_root = {
-            a: pe.calc_stats(
+            a: prev.stats_by_root[a] if a in reused_roots else pe.calc_stats(
                 b,
                 pe.target_by_root[a],
                 pe.total_by_root[a]
@@ -832,9 +1056,6 @@ class Module(MgrModule):
         }
         self.log.debug('score_by_root %s' % pe.score_by_root)
 
-        # get the list of score metrics, comma separated
-        metrics = self.get_module_option('crush_compat_metrics').split(',')
-
         # total score is just average of normalized stddevs
         pe.score = 0.0
         for r, vs in six.iteritems(pe.score_by_root):
@@ -842,6 +1063,7 @@ class Module(MgrModule):
                 if k in metrics:
                     pe.score += v
         pe.score /= len(metrics) * len(roots)
+        ms.evals[key] = pe
         return pe
 
     def evaluate(self, ms, pools, verbose=False):
@@ -909,13 +1131,22 @@ class Module(MgrModule):
             self.log.info(detail)
             return -errno.ENOENT, detail
 
+        # nothing to do as long as the osdmap is the one we last gave up on
+        idle = (ms.osdmap.get_epoch(), tuple(sorted(pools)),
+                max_deviation, max_iterations)
+        if idle == self.upmap_idle:
+            detail = 'No change since the last attempt at osdmap epoch %d' % \
+                     idle[0]
+            self.log.info(detail)
+            return -errno.EALREADY, detail
+
         inc = plan.inc
         total_did = 0
         left = max_iterations
-        osdmap_dump = self.get_osdmap().dump()
-        pools_with_pg_merge = [p['pool_name'] for p in osdmap_dump.get('pools', [])
+        pools_by_name = self.get_osdmap().get_pools_by_name()
+        pools_with_pg_merge = [n for n, p in six.iteritems(pools_by_name)
                                if p['pg_num'] > p['pg_num_target']]
-        crush_rule_by_pool_name = dict((p['pool_name'], p['crush_rule']) for p in osdmap_dump.get('pools', []))
+        crush_rule_by_pool_name = dict((n, p['crush_rule']) for n, p in six.iteritems(pools_by_name))
         pools_by_crush_rule = {} # group pools by crush_rule
         for pool in pools:
             if pool not in crush_rule_by_pool_name:
@@ -939,6 +1170,7 @@ class Module(MgrModule):
                 break
         self.log.info('prepared %d/%d changes' % (total_did, max_iterations))
         if total_did == 0:
+            self.upmap_idle = idle
             return -errno.EALREADY, 'Unable to find further optimization, ' \
                                     'or pool(s)\' pg_num is decreasing, ' \
                                     'or distribution is already perfect'
@@ -983,7 +1215,7 @@ class Module(MgrModule):
 
         # Make sure roots don't overlap their devices.  If so, we
         # can't proceed.
-        roots = pe.target_by_root.keys()
+        roots = list(pe.target_by_root.keys())
         self.log.debug('roots %s', roots)
         visited = {}
         overlap = {}
@@ -1008,6 +1240,13 @@ class Module(MgrModule):
             self.log.warn("Invalid crush_compat balancing key %s. Using 'pgs'." % key)
             key = 'pgs'
 
+        # the OSDs under each take, and the pools whose PGs may move when
+        # their weights change
+        take_pools = []
+        for rootid in crush.find_takes():
+            take_pools.append((set(crush.get_take_weight_osd_map(rootid)),
+                               osdmap.get_pools_by_take(rootid)))
+
         # go
         best_ws = copy.deepcopy(orig_ws)
         best_ow = copy.deepcopy(orig_osd_weight)
@@ -1016,6 +1255,10 @@ class Module(MgrModule):
         bad_steps = 0
         next_ws = copy.deepcopy(best_ws)
         next_ow = copy.deepcopy(best_ow)
+        # each step's state is remapped from the last one's
+        last_ms = ms
+        last_pe = pe
+        last_ws = orig_ws
         while left > 0:
             # adjust
             self.log.debug('best_ws %s' % best_ws)
@@ -1076,10 +1319,21 @@ class Module(MgrModule):
                     for osd in actual.keys():
                         next_ws[osd] = next_ws[osd] / factor
 
-            # recalc
+            # recalc, for the pools under the weights that changed only
+            changed = set(osd for osd, w in six.iteritems(next_ws)
+                          if w != last_ws.get(osd))
+            poolids = set()
+            for osds, take_poolids in take_pools:
+                if not changed.isdisjoint(osds):
+                    poolids.update(take_poolids)
+            self.log.debug('Remapping pools %s for %d changed weights',
+                           sorted(poolids), len(changed))
             plan.compat_ws = copy.deepcopy(next_ws)
-            next_ms = plan.final_state()
-            next_pe = self.calc_eval(next_ms, plan.pools)
+            next_ms = plan.final_state(last_ms, poolids)
+            next_pe = self.calc_eval(next_ms, plan.pools, last_pe)
+            last_ms = next_ms
+            last_pe = next_pe
+            last_ws = plan.compat_ws
             next_misplaced = next_ms.calc_misplaced_from(ms)
             self.log.debug('Step result score %f -> %f, misplacing %f',
                            best_pe.score, next_pe.score, next_misplaced)
@@ -1190,9 +1444,17 @@ class Module(MgrModule):
     def do_osd_weight(self):
         self.log.info('do_osd_weight (not yet implemented)')
 
-    def execute(self, plan):
+    def execute(self, plan, automatic=False):
         self.log.info('Executing plan %s' % plan.name)
 
+        changes = self.upmap_changes(plan)
+        if changes and self.upmap_execution:
+            detail = 'Plan %s is still being executed, %d upmap changes ' \
+                     'pending' % (self.upmap_execution.plan_name,
+                                  len(self.upmap_execution.pending))
+            self.log.info(detail)
+            return -errno.EBUSY, detail
+
         commands = []
 
         # compat weight-set
@@ -1235,39 +1497,226 @@ class Module(MgrModule):
             }), '')
             commands.append(result)
 
-        # upmap
+        # wait for commands
+        self.log.debug('commands %s' % commands)
+        for result in commands:
+            r, outb, outs = result.wait()
+            if r != 0:
+                self.log.error('execute error: r = %d, detail = %s' % (r, outs))
+                return r, outs
+
+        # upmap, in batches from serve()
+        if changes:
+            self.log.info('Queueing %d upmap changes of plan %s',
+                          len(changes), plan.name)
+            upmaps = dict((i['pgid'], i['mappings']) for i in
+                          plan.initial.osdmap_dump.get('pg_upmap_items', []))
+            self.upmap_execution = UpmapExecution(plan.name, changes,
+                                                  automatic, upmaps)
+            self.event.set()
+        self.log.debug('done')
+        return 0, ''
+
+    def upmap_changes(self, plan):
+        """
+        :return: list of ``(pgid, objects, commands)``, the upmap changes of
+            a plan with the number of objects each would move
+        """
         incdump = plan.inc.dump()
+        upmapped = dict((i['pgid'], len(i['mappings'])) for i in
+                        plan.initial.osdmap_dump.get('pg_upmap_items', []))
+        pgids = []
+        changes = {}  # pgid -> [copies moved, commands]
         for pgid in incdump.get('old_pg_upmap_items', []):
-            self.log.info('ceph osd rm-pg-upmap-items %s', pgid)
-            result = CommandResult('foo')
-            self.send_command(result, 'mon', '', json.dumps({
+            if pgid not in changes:
+                pgids.append(pgid)
+                changes[pgid] = [0, []]
+            changes[pgid][0] += upmapped.get(pgid, 1)
+            changes[pgid][1].append({
                 'prefix': 'osd rm-pg-upmap-items',
                 'format': 'json',
                 'pgid': pgid,
-            }), 'foo')
-            commands.append(result)
-
+            })
         for item in incdump.get('new_pg_upmap_items', []):
-            self.log.info('ceph osd pg-upmap-items %s mappings %s', item['pgid'],
-                          item['mappings'])
+            pgid = item['pgid']
             osdlist = []
             for m in item['mappings']:
                 osdlist += [m['from'], m['to']]
-            result = CommandResult('foo')
-            self.send_command(result, 'mon', '', json.dumps({
+            if pgid not in changes:
+                pgids.append(pgid)
+                changes[pgid] = [0, []]
+            changes[pgid][0] += len(item['mappings'])
+            changes[pgid][1].append({
                 'prefix': 'osd pg-upmap-items',
                 'format': 'json',
-                'pgid': item['pgid'],
+                'pgid': pgid,
                 'id': osdlist,
-            }), 'foo')
-            commands.append(result)
+            })
+        return [(pgid,
+                 changes[pgid][0] * plan.initial.pg_stats.objects(pgid),
+                 changes[pgid][1]) for pgid in pgids]
+
+    def execute_upmap_batch(self):
+        """
+        Submit the next batch of upmap changes being executed, if the PGs
+        of the previous batch have reported stats from the osdmap epoch it
+        made, and the misplaced objects are within budget.  Changes to PGs
+        whose upmap items differ from those the plan was made from are
+        dropped.
+
+        :return: whether changes are still pending
+        """
+        ex = self.upmap_execution
+        if ex is None:
+            return False
+        if not ex.pending:
+            self.log.info('Executed plan %s: %d upmap changes in %d batches, '
+                          '%d failed', ex.plan_name, ex.submitted, ex.batches,
+                          ex.failed)
+            self.upmap_execution = None
+            return False
+        if ex.automatic and not (self.active and self.time_permit()):
+            ex.waiting = 'automatic balancing is off or not permitted now'
+            return True
+        if ex.epoch is not None:
+            timeout = self.get_module_option('upmap_batch_timeout')
+            timed_out = time.time() - ex.last_batch[0] >= timeout
+            if self.get_osdmap().get_epoch() < ex.epoch:
+                ex.waiting = 'osdmap epoch %d of the last batch not ' \
+                             'received' % ex.epoch
+                if not timed_out:
+                    return True
+            else:
+                version = self.get_data_version('pg_dump')
+                if version is not None and version[1] == ex.pg_version \
+                   and not timed_out:
+                    # no new PG stats since we last looked
+                    if not ex.waiting:
+                        ex.waiting = 'PG stats not updated since the last ' \
+                                     'batch'
+                    return True
+                ex.pg_version = version[1] if version is not None else None
+                ex.pgids = self.pgs_reported_before(ex.pgids, ex.epoch)
+                if ex.pgids and not timed_out:
+                    ex.waiting = '%d PGs of the last batch not reported ' \
+                                 'since osdmap epoch %d' % (len(ex.pgids),
+                                                            ex.epoch)
+                    return True
+            if timed_out:
+                self.log.warn('No stats from osdmap epoch %d of PGs %s '
+                              'after %d seconds, submitting the next batch '
+                              'of plan %s', ex.epoch, ', '.join(ex.pgids),
+                              timeout, ex.plan_name)
+            ex.epoch = None
+            ex.pgids = []
+        info = self.get('pg_status')
+        peering = sum(s['count'] for s in info.get('pgs_by_state', [])
+                      if 'peering' in s['state_name'] or
+                      'activating' in s['state_name'] or
+                      'unknown' in s['state_name'])
+        if peering:
+            ex.waiting = '%d PGs peering' % peering
+            return True
 
-        # wait for commands
-        self.log.debug('commands %s' % commands)
-        for result in commands:
+        max_misplaced = float(self.get_ceph_option('target_max_misplaced_ratio'))
+        misplaced = info.get('misplaced_objects', 0)
+        total = info.get('misplaced_total')
+        if not total:
+            total = sum(self.get_pg_stats_columns(
+                ['num_object_copies'])['num_object_copies'])
+        budget = max_misplaced * total - misplaced
+        max_batch = self.get_module_option('upmap_max_batch')
+        upmaps = dict((i['pgid'], i['mappings']) for i in
+                      self.get_osdmap().dump().get('pg_upmap_items', []))
+        batch = []
+        objects = 0
+        while ex.pending and len(batch) < max_batch:
+            pgid, cost, _ = ex.pending[0]
+            if upmaps.get(pgid) != ex.upmaps.get(pgid):
+                self.log.info('Dropping the upmap change of %s, whose '
+                              'upmap items changed since plan %s was made',
+                              pgid, ex.plan_name)
+                ex.pending.popleft()
+                ex.dropped += 1
+                continue
+            # a change larger than the whole budget still goes alone once
+            # nothing is misplaced
+            if objects + cost > budget and (batch or misplaced):
+                break
+            batch.append(ex.pending.popleft())
+            objects += cost
+        if not batch:
+            if not ex.pending:
+                # all dropped, the next call reports the plan done
+                return True
+            ex.waiting = '%d objects misplaced, budget %d' % (
+                misplaced, max_misplaced * total)
+            return True
+
+        self.log.info('Submitting %d upmap changes of plan %s moving %d '
+                      'objects, %d pending', len(batch), ex.plan_name,
+                      objects, len(ex.pending))
+        results = []
+        for pgid, _, commands in batch:
+            for command in commands:
+                self.log.debug('%s %s', command['prefix'], pgid)
+                result = CommandResult('')
+                self.send_command(result, 'mon', '', json.dumps(command), '')
+                results.append((pgid, result))
+        failed = set()
+        for pgid, result in results:
             r, outb, outs = result.wait()
             if r != 0:
-                self.log.error('execute error: r = %d, detail = %s' % (r, outs))
-                return r, outs
-        self.log.debug('done')
-        return 0, ''
+                self.log.error('execute error on %s: r = %d, detail = %s' %
+                               (pgid, r, outs))
+                failed.add(pgid)
+        ex.submitted += len(batch)
+        ex.failed += len(failed)
+        ex.batches += 1
+        ex.objects += objects
+        ex.last_batch = (time.time(), len(batch), objects)
+        ex.epoch = self.get_osdmap_epoch_after_commands()
+        ex.pgids = [pgid for pgid, _, _ in batch if pgid not in failed]
+        ex.pg_version = None
+        ex.waiting = ''
+        return True
+
+    def get_osdmap_epoch_after_commands(self):
+        """
+        :return: the monitors' osdmap epoch, which includes the changes of
+            the commands they have replied to, or the epoch after ours if
+            it cannot be had
+        """
+        result = CommandResult('')
+        self.send_command(result, 'mon', '', json.dumps({
+            'prefix': 'osd stat',
+            'format': 'json',
+        }), '')
+        r, outb, outs = result.wait()
+        if r == 0:
+            try:
+                stat = json.loads(outb)
+                return int(stat.get('osdmap', stat)['epoch'])
+            except (ValueError, KeyError, TypeError):
+                pass
+        self.log.warn('Cannot get the osdmap epoch: r = %d, detail = %s' %
+                      (r, outs))
+        return self.get_osdmap().get_epoch() + 1
+
+    def pgs_reported_before(self, pgids, epoch):
+        """
+        :return: those of the PGs which last reported stats from an osdmap
+            epoch older than epoch, that is before they peered in it
+        """
+        wanted = set(pgids)
+        if not wanted:
+            return []
+        columns = self.get_pg_stats_columns(['pool', 'ps', 'reported_epoch'])
+        behind = set()
+        for poolid, ps, reported in zip(columns['pool'], columns['ps'],
+                                        columns['reported_epoch']):
+            if reported < epoch:
+                pgid = '%d.%x' % (poolid, ps)
+                if pgid in wanted:
+                    behind.add(pgid)
+        return [pgid for pgid in pgids if pgid in behind]
@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+"""
+Try the balancer on a copy of a cluster's maps, without a running mgr.
+
+Takes an osdmap exported with ``ceph osd getmap -o FILE`` and the output
+of ``ceph pg dump --format json``, runs the balancer module's optimize()
+and calc_eval() on them in-process, and reports the score and the ratio
+of misplaced PGs the resulting plan would give, and how long it took.
+Module options can be swept, each combination being tried in a worker
+process, to pick settings before applying them to the cluster.
+
+The osdmap and CRUSH calculations the mgr does in C++ are done by
+running osdmaptool and crushtool, which must be in $PATH (or given with
+--osdmaptool and --crushtool).
+"""
+
+from __future__ import print_function
+
+import argparse
+import array
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import six
+
+
+class _Base(object):
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+# ceph_module only exists inside ceph-mgr: give mgr_module the base
+# classes it derives from, the Sim* classes below stand in for their
+# C++ methods.
+ceph_module = types.ModuleType('ceph_module')
+for _name in ('BaseMgrModule', 'BaseMgrStandbyModule', 'BasePyOSDMap',
+              'BasePyOSDMapIncremental', 'BasePyCRUSH'):
+    setattr(ceph_module, _name, type(_name, (_Base,), {}))
+sys.modules['ceph_module'] = ceph_module
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mgr_module import CRUSHMap, OSDMap, OSDMapIncremental  # noqa: E402
+from mgr_module import PG_STATS_COLUMN_TYPECODE  # noqa: E402
+from balancer.module import Module  # noqa: E402
+
+# the compat weight-set's choose_args id, as crushtool writes it
+COMPAT_CHOOSE_ARGS = '18446744073709551615'
+
+# a line of osdmaptool --test-map-pgs-dump-all
+PG_MAPPING_RE = re.compile(
+    r'^(?P<pgid>\d+\.[0-9a-f]+) raw \(\[[^\]]*\], p-?\d+\) '
+    r'up \(\[(?P<up>[^\]]*)\], p-?\d+\)')
+
+
+def warn(msg):
+    print(msg, file=sys.stderr)
+
+
+class Tools(object):
+    """
+    Runs osdmaptool and crushtool on map files in a scratch directory.
+    Input files are never modified: every change is made to a copy.
+    """
+
+    def __init__(self, workdir, osdmaptool='osdmaptool',
+                 crushtool='crushtool'):
+        self.workdir = workdir
+        self.osdmaptool = osdmaptool
+        self.crushtool = crushtool
+        self.files = 0
+        self.crush_sources = {}  # osdmap file -> crush source
+
+    def new_file(self, name):
+        self.files += 1
+        return os.path.join(self.workdir, '%d.%s' % (self.files, name))
+
+    def copy(self, path, name):
+        copy = self.new_file(name)
+        shutil.copyfile(path, copy)
+        return copy
+
+    def run(self, *args):
+        p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            raise RuntimeError('%s failed (%d): %s' %
+                               (' '.join(args), p.returncode,
+                                err.decode('utf-8', 'replace').strip()))
+        return out.decode('utf-8')
+
+    def osdmap_dump(self, osdmap):
+        return json.loads(self.run(self.osdmaptool, osdmap,
+                                   '--dump', 'json'))
+
+    def export_crush(self, osdmap):
+        crush = self.new_file('crush')
+        self.run(self.osdmaptool, osdmap, '--export-crush', crush)
+        return crush
+
+    def crush_dump(self, osdmap):
+        return json.loads(self.run(self.crushtool,
+                                   '-i', self.export_crush(osdmap), '--dump'))
+
+    def crush_source(self, osdmap):
+        source = self.crush_sources.get(osdmap)
+        if source is None:
+            out = self.new_file('crush.txt')
+            self.run(self.crushtool, '-d', self.export_crush(osdmap),
+                     '-o', out)
+            with open(out) as f:
+                source = self.crush_sources[osdmap] = f.read()
+        return source
+
+    def map_pgs_up(self, osdmap):
+        """
+        :return: dict of pool id to dict of pgid to up set
+        """
+        out = self.run(self.osdmaptool, osdmap, '--test-map-pgs-dump-all')
+        by_poolid = {}
+        for line in out.splitlines():
+            m = PG_MAPPING_RE.match(line)
+            if not m:
+                continue
+            pgid = m.group('pgid')
+            up = m.group('up')
+            by_poolid.setdefault(int(pgid.split('.')[0]), {})[pgid] = \
+                [int(osd) for osd in up.split(',')] if up else []
+        return by_poolid
+
+    def calc_pg_upmaps(self, osdmap, max_deviation, max_iterations, pools):
+        """
+        :return: ``(osdmap file with the upmaps applied, commands)``, or
+            ``(None, [])`` if no upmap was proposed
+        """
+        upmapped = self.copy(osdmap, 'osdmap')
+        out = self.new_file('upmap')
+        args = [self.osdmaptool, upmapped,
+                '--upmap', out, '--upmap-save', out,
+                '--upmap-deviation', str(max_deviation),
+                '--upmap-max', str(max_iterations)]
+        for pool in pools:
+            args += ['--upmap-pool', pool]
+        self.run(*args)
+        commands = []
+        if os.path.exists(out):
+            with open(out) as f:
+                commands = [l.strip() for l in f if l.strip()]
+        if not any(c.startswith('ceph osd pg-upmap') for c in commands):
+            return None, []
+        return upmapped, commands
+
+    def set_compat_weight_set(self, osdmap, crush_dump, weights):
+        """
+        :return: a copy of an osdmap file whose compat weight-set gives
+            the devices in weights those weights
+        """
+        lines = []
+        skip = False
+        for line in self.crush_source(osdmap).splitlines():
+            if line.startswith('choose_args '):
+                skip = line.split()[1] == COMPAT_CHOOSE_ARGS
+            if not skip and line != '# end crush map':
+                lines.append(line)
+            if skip and line == '}':
+                skip = False
+        lines.append(compat_weight_set_source(crush_dump, weights))
+        lines.append('# end crush map')
+        source = self.new_file('crush.txt')
+        with open(source, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        crush = self.new_file('crush')
+        self.run(self.crushtool, '-c', source, '-o', crush)
+        result = self.copy(osdmap, 'osdmap')
+        self.run(self.osdmaptool, result, '--import-crush', crush)
+        return result
+
+
+def compat_weight_set_source(crush_dump, weights):
+    """
+    :return: the crush map source of a compat weight-set where the devices
+        in weights have those weights, the others keep theirs (from the
+        current compat weight-set if there is one, else their CRUSH
+        weight), and each bucket weighs the sum of its items
+    """
+    buckets = dict((b['id'], b) for b in crush_dump['buckets'])
+    device_weights = {}
+    for b in crush_dump['buckets']:
+        for item in b['items']:
+            if item['id'] >= 0:
+                device_weights[item['id']] = item['weight'] / float(0x10000)
+    if CRUSHMap.have_default_choose_args(crush_dump):
+        for arg in CRUSHMap.get_default_choose_args(crush_dump):
+            items = buckets[arg['bucket_id']]['items']
+            for item, weight in zip(items, arg['weight_set'][0]):
+                if item['id'] >= 0:
+                    device_weights[item['id']] = weight
+    device_weights.update(weights)
+
+    bucket_weights = {}
+
+    def weigh(item):
+        if item >= 0:
+            return device_weights.get(item, 0.0)
+        if item not in bucket_weights:
+            bucket_weights[item] = sum(weigh(i['id'])
+                                       for i in buckets[item]['items'])
+        return bucket_weights[item]
+
+    lines = ['# choose_args', 'choose_args %s {' % COMPAT_CHOOSE_ARGS]
+    for bucket_id in sorted(buckets, reverse=True):
+        items = buckets[bucket_id]['items']
+        if not items:
+            continue
+        lines += [
+            '  {',
+            '    bucket_id %d' % bucket_id,
+            '    weight_set [',
+            '      [ %s ]' % ' '.join('%.5f' % weigh(i['id']) for i in items),
+            '    ]',
+            '  }',
+        ]
+    lines.append('}')
+    return '\n'.join(lines)
+
+
+class SimCRUSHMap(CRUSHMap):
+    def __init__(self, dump):
+        self._sim_dump = dump
+        self._buckets = dict((b['id'], b) for b in dump.get('buckets', []))
+        self._names = dict((d['id'], d['name'])
+                           for d in dump.get('devices', []))
+        self._names.update((b['id'], b['name'])
+                           for b in dump.get('buckets', []))
+
+    def _dump(self):
+        return self._sim_dump
+
+    def _get_item_weight(self, item):
+        if item in self._buckets:
+            return self._buckets[item]['weight'] / float(0x10000)
+        for b in self._buckets.values():
+            for i in b['items']:
+                if i['id'] == item:
+                    return i['weight'] / float(0x10000)
+        return None
+
+    def _get_item_name(self, item):
+        return self._names.get(item)
+
+    def _find_takes(self):
+        takes = set()
+        for rule in self._sim_dump.get('rules', []):
+            for step in rule['steps']:
+                if step['op'] == 'take':
+                    takes.add(step['item'])
+        return {'takes': sorted(takes)}
+
+    def _get_take_weight_osd_map(self, root):
+        weights = {}
+        queue = [root]
+        while queue:
+            for item in self._buckets[queue.pop(0)]['items']:
+                if item['id'] >= 0:
+                    weights[item['id']] = item['weight'] / float(0x10000)
+                else:
+                    queue.append(item['id'])
+        total = sum(weights.values())
+        return {'weights': dict((str(osd), w / total if total else 0.0)
+                                for osd, w in six.iteritems(weights))}
+
+
+class SimOSDMap(OSDMap):
+    def __init__(self, tools, path):
+        self._tools = tools
+        self._path = path
+        self._sim_dump = tools.osdmap_dump(path)
+        self._crush_dump = tools.crush_dump(path)
+        self._pgs_up = None
+
+    def _get_epoch(self):
+        return self._sim_dump['epoch']
+
+    def _get_crush_version(self):
+        return self._sim_dump.get('crush_version', 0)
+
+    def _dump(self):
+        return self._sim_dump
+
+    def _new_incremental(self):
+        return SimOSDMapIncremental(self)
+
+    def _apply_incremental(self, inc):
+        path = inc._upmapped or self._path
+        weights = dict((o['osd'], o['weight'])
+                       for o in self._sim_dump.get('osds', []))
+        reweighted = sorted(osd for osd, w in six.iteritems(inc._osd_weights)
+                            if weights.get(osd) != w)
+        if reweighted:
+            warn('osd reweights are not simulated, ignoring those of %s' %
+                 ', '.join('osd.%d' % osd for osd in reweighted))
+        if inc._compat_ws:
+            path = self._tools.set_compat_weight_set(path, self._crush_dump,
+                                                     inc._compat_ws)
+        return SimOSDMap(self._tools, path)
+
+    def _get_crush(self):
+        return SimCRUSHMap(self._crush_dump)
+
+    def _get_pools_by_take(self, take):
+        rules = set()
+        for rule in self._crush_dump.get('rules', []):
+            for step in rule['steps']:
+                if step['op'] == 'take' and step['item'] == take:
+                    rules.add(rule['rule_id'])
+        return {'pools': [p['pool'] for p in self._sim_dump.get('pools', [])
+                          if p['crush_rule'] in rules]}
+
+    def _calc_pg_upmaps(self, inc, max_deviation, max_iterations, pools):
+        upmapped, commands = self._tools.calc_pg_upmaps(
+            inc._upmapped or self._path,
+            max_deviation, max_iterations, pools)
+        if upmapped is None:
+            return 0
+        inc._upmapped = upmapped
+        inc._upmap_commands += commands
+        return len([c for c in commands if c.startswith('ceph osd pg-upmap')])
+
+    def _map_pool_pgs_up(self, poolid):
+        if self._pgs_up is None:
+            self._pgs_up = self._tools.map_pgs_up(self._path)
+        return self._pgs_up.get(poolid, {})
+
+
+class SimOSDMapIncremental(OSDMapIncremental):
+    def __init__(self, osdmap):
+        self._osdmap = osdmap
+        self._upmapped = None  # osdmap file with the upmaps so far
+        self._upmap_commands = []
+        self._osd_weights = {}
+        self._compat_ws = {}
+
+    def _get_epoch(self):
+        return self._osdmap.get_epoch() + 1
+
+    def _dump(self):
+        dump = {
+            'epoch': self._get_epoch(),
+            'new_pg_upmap': [],
+            'old_pg_upmap': [],
+            'new_pg_upmap_items': [],
+            'old_pg_upmap_items': [],
+        }
+        for command in self._upmap_commands:
+            args = command.split()[2:]
+            if args[0] == 'pg-upmap-items':
+                osds = [int(a) for a in args[2:]]
+                dump['new_pg_upmap_items'].append({
+                    'pgid': args[1],
+                    'mappings': [{'from': a, 'to': b}
+                                 for a, b in zip(osds[::2], osds[1::2])],
+                })
+            elif args[0] == 'pg-upmap':
+                dump['new_pg_upmap'].append({
+                    'pgid': args[1],
+                    'osds': [int(a) for a in args[2:]],
+                })
+            elif args[0] in ('rm-pg-upmap-items', 'rm-pg-upmap'):
+                dump['old_' + args[0][3:].replace('-', '_')].append(args[1])
+        return dump
+
+    def _set_osd_reweights(self, weightmap):
+        self._osd_weights = dict(weightmap)
+
+    def _set_crush_compat_weight_set_weights(self, weightmap):
+        self._compat_ws = dict(weightmap)
+
+
+class SimModule(Module):
+    """
+    The balancer module, with what it asks ceph-mgr for answered from the
+    exported maps.  PG states are not simulated: the cluster is assumed
+    to be healthy, with nothing misplaced.
+    """
+
+    def __init__(self, osdmap, pg_stats, options, max_misplaced,
+                 log_level=1):
+        self._sim_osdmap = osdmap
+        self._sim_pg_stats = pg_stats
+        self._sim_options = options
+        self._sim_max_misplaced = max_misplaced
+        self._sim_log_level = log_level
+        super(SimModule, self).__init__('balancer', None, None)
+
+    def _ceph_get_version(self):
+        return 'simulate'
+
+    def _ceph_log(self, level, msg):
+        if level <= self._sim_log_level:
+            print(msg, file=sys.stderr)
+
+    def _ceph_get_module_option(self, module, key, localized_prefix=''):
+        return self._sim_options.get(key)
+
+    def _ceph_get_option(self, key):
+        if key == 'target_max_misplaced_ratio':
+            return self._sim_max_misplaced
+        raise KeyError(key)
+
+    def _ceph_get(self, data_name):
+        if data_name == 'pg_status':
+            return {}
+        raise KeyError(data_name)
+
+    def _ceph_get_data_version(self, data_name):
+        if data_name == 'pg_dump':
+            # the PG stats never change
+            return (self._sim_osdmap.get_epoch(), 0)
+        return None
+
+    def _ceph_get_osdmap(self):
+        return self._sim_osdmap
+
+    def _ceph_get_pg_stats_columns(self, fields):
+        columns = dict((f, array.array(PG_STATS_COLUMN_TYPECODE))
+                       for f in fields)
+        for pg in self._sim_pg_stats:
+            pool, ps = pg['pgid'].split('.')
+            for f in fields:
+                if f == 'pool':
+                    v = int(pool)
+                elif f == 'ps':
+                    v = int(ps, 16)
+                elif f in pg['stat_sum']:
+                    v = pg['stat_sum'][f]
+                else:
+                    v = pg[f]
+                columns[f].append(v)
+        if six.PY3:
+            return dict((f, c.tobytes()) for f, c in six.iteritems(columns))
+        return dict((f, c.tostring()) for f, c in six.iteritems(columns))
+
+    def get_compat_weight_set_weights(self, ms):
+        if CRUSHMap.have_default_choose_args(ms.crush_dump):
+            return super(SimModule, self).get_compat_weight_set_weights(ms)
+        # what "osd crush weight-set create-compat" would start from
+        weight_set = {}
+        for b in ms.crush_dump['buckets']:
+            for item in b['items']:
+                weight_set[item['id']] = item['weight'] / float(0x10000)
+        return weight_set
+
+
+def load_pg_stats(path):
+    with open(path) as f:
+        dump = json.load(f)
+    if isinstance(dump, list):
+        return dump
+    return dump.get('pg_map', dump)['pg_stats']
+
+
+def option_types():
+    return dict((o['name'], o.get('type', 'str'))
+                for o in Module.MODULE_OPTIONS)
+
+
+def parse_option_value(name, value):
+    t = option_types()[name]
+    if t == 'float':
+        return float(value)
+    if t in ('int', 'uint', 'secs'):
+        return int(value)
+    if t == 'bool':
+        return value.lower() in ('true', 'yes', '1')
+    return value
+
+
+def simulate(osdmap, pg_dump, pools, options, max_misplaced, tools,
+             log_level):
+    """
+    Optimize a plan for a copy of the maps, with the given module options.
+
+    :return: dict with the options, the result of optimize() and, if it
+        succeeded, the plan, its score and the ratio of PGs it moves
+    """
+    workdir = tempfile.mkdtemp(prefix='balancer-simulate.')
+    try:
+        module = SimModule(SimOSDMap(Tools(workdir, *tools), osdmap),
+                           load_pg_stats(pg_dump), options, max_misplaced,
+                           log_level)
+        plan = module.plan_create('simulate', module.get_osdmap(), pools)
+        report = {
+            'options': options,
+            'initial_score': module.calc_eval(plan.initial, pools).score,
+        }
+        start = time.time()
+        r, detail = module.optimize(plan)
+        report['optimize_time'] = time.time() - start
+        report['result'] = r
+        report['detail'] = detail
+        if r == 0:
+            final = plan.final_state()
+            report['score'] = module.calc_eval(final, pools).score
+            report['misplaced'] = final.calc_misplaced_from(plan.initial)
+            report['plan'] = plan.show()
+            report['changes'] = len([l for l in report['plan'].splitlines()
+                                     if not l.startswith('#')])
+        return report
+    finally:
+        shutil.rmtree(workdir)
+
+
+def _simulate(args):
+    return simulate(*args)
+
+
+def best(reports, max_misplaced):
+    """
+    :return: the successful report with the lowest score among those
+        within max_misplaced, then the fewest misplaced PGs, or None
+    """
+    ok = [r for r in reports
+          if r['result'] == 0 and r['misplaced'] <= max_misplaced]
+    if not ok:
+        return None
+    return min(ok, key=lambda r: (r['score'], r['misplaced'],
+                                  r['optimize_time']))
+
+
+def show(reports, swept, max_misplaced, show_plan):
+    print('  '.join(['%-20s' % name for name in swept] +
+                    ['%6s' % 'result', '%10s' % 'before', '%10s' % 'after',
+                     '%9s' % 'misplaced', '%7s' % 'changes', '%8s' % 'time']))
+    for r in reports:
+        row = ['%-20s' % r['options'][name] for name in swept]
+        row += ['%6d' % r['result'], '%10.6f' % r['initial_score']]
+        if r['result'] == 0:
+            row += ['%10.6f' % r['score'], '%8.2f%%' % (100 * r['misplaced']),
+                    '%7d' % r['changes']]
+        else:
+            row += ['%10s' % '-', '%9s' % '-', '%7s' % '-']
+        row.append('%7.2fs' % r['optimize_time'])
+        print('  '.join(row))
+    for r in reports:
+        if r['result'] != 0 and r['detail']:
+            print('%s: %s' % (' '.join('%s=%s' % (n, r['options'][n])
+                                       for n in swept) or 'result',
+                              r['detail']))
+    b = best(reports, max_misplaced)
+    if b is None:
+        print('no plan within the misplaced ratio of %g' % max_misplaced)
+        return 1
+    if swept:
+        print('best: %s' % ' '.join('%s=%s' % (n, b['options'][n])
+                                    for n in swept))
+    if show_plan:
+        print(b['plan'])
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n\n')[0],
+        epilog='e.g. %(prog)s osdmap pg_dump.json --mode upmap '
+               '--sweep upmap_max_deviation=.01,.005,.001 '
+               '--sweep upmap_max_iterations=10,100')
+    parser.add_argument('osdmap', help='osdmap file (ceph osd getmap -o)')
+    parser.add_argument('pg_dump',
+                        help='JSON PG stats (ceph pg dump --format json)')
+    parser.add_argument('--mode', choices=['upmap', 'crush-compat'],
+                        default='upmap')
+    parser.add_argument('--pool', action='append', default=[],
+                        help='only balance this pool (repeatable)')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='OPTION=VALUE',
+                        help='balancer module option (repeatable)')
+    parser.add_argument('--sweep', action='append', default=[],
+                        metavar='OPTION=VALUE,...',
+                        help='try each value of a balancer module option, '
+                             'and each combination with other --sweep '
+                             'options (repeatable)')
+    parser.add_argument('--max-misplaced', type=float, default=.05,
+                        help='target_max_misplaced_ratio')
+    parser.add_argument('--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='worker processes for --sweep')
+    parser.add_argument('--format', choices=['plain', 'json'],
+                        default='plain')
+    parser.add_argument('--show', action='store_true',
+                        help='print the commands of the best plan')
+    parser.add_argument('--osdmaptool', default='osdmaptool')
+    parser.add_argument('--crushtool', default='crushtool')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='print the module\'s log, -vv for debug')
+    args = parser.parse_args()
+
+    types_by_name = option_types()
+    options = {'mode': args.mode}
+    for arg in args.set:
+        name, _, value = arg.partition('=')
+        if name not in types_by_name:
+            parser.error('unknown balancer option %s' % name)
+        options[name] = parse_option_value(name, value)
+    swept = []
+    sweeps = []
+    for arg in args.sweep:
+        name, _, values = arg.partition('=')
+        if name not in types_by_name:
+            parser.error('unknown balancer option %s' % name)
+        swept.append(name)
+        sweeps.append([parse_option_value(name, v)
+                       for v in values.split(',')])
+
+    log_level = [1, 4, 20][min(args.verbose, 2)]
+    runs = []
+    for values in itertools.product(*sweeps):
+        run_options = dict(options)
+        run_options.update(zip(swept, values))
+        runs.append((args.osdmap, args.pg_dump, args.pool, run_options,
+                     args.max_misplaced, (args.osdmaptool, args.crushtool),
+                     log_level))
+    if len(runs) > 1 and args.jobs > 1:
+        workers = multiprocessing.Pool(min(args.jobs, len(runs)))
+        try:
+            reports = workers.map(_simulate, runs)
+        finally:
+            workers.close()
+            workers.join()
+    else:
+        reports = [_simulate(run) for run in runs]
+
+    if args.format == 'json':
+        json.dump(reports, sys.stdout, indent=4, sort_keys=True)
+        print()
+        return 0 if best(reports, args.max_misplaced) else 1
+    return show(reports, swept, args.max_misplaced, args.show)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
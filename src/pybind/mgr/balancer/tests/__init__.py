@@ -0,0 +1,3 @@
+# ceph_module only exists inside ceph-mgr: simulate stands in for it, so
+# that the balancer can be imported here
+from .. import simulate  # noqa: F401
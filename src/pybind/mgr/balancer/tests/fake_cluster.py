@@ -0,0 +1,251 @@
+"""
+A small in-memory cluster for the balancer tests: osdmap and crush map
+dumps, PG stats, and a FakeTools that answers what simulate.Tools asks
+osdmaptool and crushtool, so that SimOSDMap and SimModule run without a
+Ceph build.
+
+PGs are mapped by a straw2-like weighted draw over the OSDs under the
+pool's CRUSH root, using the compat weight-set when there is one, then
+pg_upmap_items are applied.  calc_pg_upmaps() moves PGs from the OSD
+furthest above its weighted share of PG instances to the one furthest
+below it.
+"""
+
+import collections
+import copy
+import hashlib
+import math
+import random
+
+from mgr_module import CRUSHMap
+
+
+def cluster(roots, pools, epoch=10):
+    """
+    :param roots: list of ``(root name, crush weight of each OSD)``; OSD
+        ids are numbered across the roots, in order
+    :param pools: list of ``(pool name, root name, pg_num)``
+    :return: ``(osdmap dump, crush dump)``, each root having a rule of
+        the same name
+    """
+    devices = []
+    buckets = []
+    rules = []
+    rule_ids = {}
+    for i, (root, weights) in enumerate(roots):
+        items = []
+        for pos, weight in enumerate(weights):
+            osd = len(devices)
+            devices.append({'id': osd, 'name': 'osd.%d' % osd})
+            items.append({'id': osd, 'weight': int(weight * 0x10000),
+                          'pos': pos})
+        buckets.append({
+            'id': -1 - i,
+            'name': root,
+            'type_id': 10,
+            'type_name': 'root',
+            'weight': sum(item['weight'] for item in items),
+            'items': items,
+        })
+        rule_ids[root] = i
+        rules.append({
+            'rule_id': i,
+            'rule_name': root,
+            'ruleset': i,
+            'type': 1,
+            'steps': [
+                {'op': 'take', 'item': -1 - i, 'item_name': root},
+                {'op': 'chooseleaf_firstn', 'num': 0, 'type': 'osd'},
+                {'op': 'emit'},
+            ],
+        })
+    crush_dump = {
+        'devices': devices,
+        'buckets': buckets,
+        'rules': rules,
+        'choose_args': {},
+    }
+    osdmap_dump = {
+        'epoch': epoch,
+        'crush_version': 1,
+        'max_osd': len(devices),
+        'pools': [{
+            'pool': poolid,
+            'pool_name': name,
+            'crush_rule': rule_ids[root],
+            'size': 3,
+            'pg_num': pg_num,
+            'pg_num_target': pg_num,
+        } for poolid, (name, root, pg_num) in enumerate(pools, 1)],
+        'osds': [{'osd': d['id'], 'weight': 1.0, 'up': 1, 'in': 1}
+                 for d in devices],
+        'pg_upmap_items': [],
+        'erasure_code_profiles': {},
+    }
+    return osdmap_dump, crush_dump
+
+
+def pg_stats(osdmap_dump, seed=0):
+    """
+    :return: PG stats of every PG of the pools, as in ``ceph pg dump``
+    """
+    rng = random.Random(seed)
+    stats = []
+    for pool in osdmap_dump['pools']:
+        for ps in range(pool['pg_num']):
+            objects = rng.randint(0, 1000)
+            stats.append({
+                'pgid': '%d.%x' % (pool['pool'], ps),
+                'stat_sum': {
+                    'num_objects': objects,
+                    'num_bytes': objects * rng.randint(1, 4 << 20),
+                },
+            })
+    return stats
+
+
+def _draw(pgid, osd):
+    digest = hashlib.md5(('%s/%d' % (pgid, osd)).encode('utf-8')).hexdigest()
+    return (int(digest[:12], 16) + 1) / float(0x1000000000000 + 1)
+
+
+class FakeTools(object):
+    """
+    simulate.Tools on in-memory maps: a path is the name of a
+    ``(osdmap dump, crush dump)`` pair added with add().
+    """
+
+    def __init__(self):
+        self.maps = {}
+        self.mapped = 0  # map_pgs_up() calls
+
+    def add(self, osdmap_dump, crush_dump):
+        path = 'osdmap.%d' % len(self.maps)
+        self.maps[path] = (copy.deepcopy(osdmap_dump),
+                           copy.deepcopy(crush_dump))
+        return path
+
+    def osdmap_dump(self, path):
+        return copy.deepcopy(self.maps[path][0])
+
+    def crush_dump(self, path):
+        return copy.deepcopy(self.maps[path][1])
+
+    @staticmethod
+    def osd_weights(crush_dump):
+        """
+        :return: the weight of each OSD CRUSH picks with
+        """
+        weights = {}
+        for b in crush_dump['buckets']:
+            for item in b['items']:
+                if item['id'] >= 0:
+                    weights[item['id']] = item['weight'] / float(0x10000)
+        if CRUSHMap.have_default_choose_args(crush_dump):
+            buckets = dict((b['id'], b) for b in crush_dump['buckets'])
+            for arg in CRUSHMap.get_default_choose_args(crush_dump):
+                items = buckets[arg['bucket_id']]['items']
+                for item, weight in zip(items, arg['weight_set'][0]):
+                    if item['id'] >= 0:
+                        weights[item['id']] = weight
+        return weights
+
+    def map_pgs_up(self, path):
+        self.mapped += 1
+        osdmap_dump, crush_dump = self.maps[path]
+        weights = self.osd_weights(crush_dump)
+        buckets = dict((b['id'], b) for b in crush_dump['buckets'])
+        rules = dict((r['rule_id'], r) for r in crush_dump['rules'])
+        upmaps = dict((i['pgid'], i['mappings'])
+                      for i in osdmap_dump['pg_upmap_items'])
+        by_poolid = {}
+        for pool in osdmap_dump['pools']:
+            take = rules[pool['crush_rule']]['steps'][0]['item']
+            osds = [i['id'] for i in buckets[take]['items']
+                    if weights.get(i['id'], 0) > 0]
+            pgs = by_poolid[pool['pool']] = {}
+            for ps in range(pool['pg_num']):
+                pgid = '%d.%x' % (pool['pool'], ps)
+                up = sorted(osds, key=lambda osd: -math.log(
+                    _draw(pgid, osd)) / weights[osd])[:pool['size']]
+                for m in upmaps.get(pgid, []):
+                    if m['from'] in up and m['to'] not in up:
+                        up[up.index(m['from'])] = m['to']
+                pgs[pgid] = up
+        return by_poolid
+
+    def calc_pg_upmaps(self, path, max_deviation, max_iterations, pools):
+        osdmap_dump, crush_dump = self.maps[path]
+        osdmap_dump = copy.deepcopy(osdmap_dump)
+        weights = self.osd_weights(crush_dump)
+        by_name = dict((p['pool_name'], p) for p in osdmap_dump['pools'])
+        if not pools:
+            pools = list(by_name)
+        poolids = set(by_name[name]['pool'] for name in pools)
+        rules = dict((r['rule_id'], r) for r in crush_dump['rules'])
+        buckets = dict((b['id'], b) for b in crush_dump['buckets'])
+        takes = set(rules[by_name[name]['crush_rule']]['steps'][0]['item']
+                    for name in pools)
+        upmaps = dict((i['pgid'], i)
+                      for i in osdmap_dump['pg_upmap_items'])
+        ups = {}
+        for poolid, pgs in self.map_pgs_up(path).items():
+            if poolid in poolids:
+                ups.update(pgs)
+        changed = []
+        for _ in range(max_iterations):
+            count = collections.Counter()
+            for up in ups.values():
+                count.update(up)
+            # the OSDs furthest above and below their share of the PG
+            # instances under their root
+            moves = []
+            for take in sorted(takes):
+                osds = [i['id'] for i in buckets[take]['items']]
+                total = sum(count[osd] for osd in osds)
+                sum_w = sum(weights[osd] for osd in osds)
+                deviation = dict(
+                    (osd, count[osd] - total * weights[osd] / sum_w)
+                    for osd in osds)
+                fullest = max(osds, key=lambda osd: deviation[osd])
+                emptiest = min(osds, key=lambda osd: deviation[osd])
+                moves.append((deviation[fullest] - deviation[emptiest],
+                              fullest, emptiest))
+            spread, fullest, emptiest = max(moves)
+            if spread <= max(max_deviation, 1) + 1:
+                break
+            pgid = sorted(pgid for pgid, up in ups.items()
+                          if fullest in up and emptiest not in up)[0]
+            ups[pgid][ups[pgid].index(fullest)] = emptiest
+            item = upmaps.get(pgid)
+            if item is None:
+                item = upmaps[pgid] = {'pgid': pgid, 'mappings': []}
+                osdmap_dump['pg_upmap_items'].append(item)
+            item['mappings'].append({'from': fullest, 'to': emptiest})
+            if pgid not in changed:
+                changed.append(pgid)
+        if not changed:
+            return None, []
+        osdmap_dump['epoch'] += 1
+        commands = []
+        for pgid in changed:
+            osdlist = []
+            for m in upmaps[pgid]['mappings']:
+                osdlist += [m['from'], m['to']]
+            commands.append('ceph osd pg-upmap-items %s %s' %
+                            (pgid, ' '.join(str(osd) for osd in osdlist)))
+        return self.add(osdmap_dump, crush_dump), commands
+
+    def set_compat_weight_set(self, path, crush_dump, weights):
+        osdmap_dump, crush_dump = self.maps[path]
+        osdmap_dump = copy.deepcopy(osdmap_dump)
+        crush_dump = copy.deepcopy(crush_dump)
+        device_weights = self.osd_weights(crush_dump)
+        device_weights.update(weights)
+        crush_dump['choose_args'][CRUSHMap.DEFAULT_CHOOSE_ARGS] = [{
+            'bucket_id': b['id'],
+            'weight_set': [[device_weights[i['id']] for i in b['items']]],
+        } for b in crush_dump['buckets']]
+        osdmap_dump['epoch'] += 1
+        osdmap_dump['crush_version'] += 1
+        return self.add(osdmap_dump, crush_dump)
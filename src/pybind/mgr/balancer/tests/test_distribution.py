@@ -0,0 +1,149 @@
+import random
+import unittest
+
+from .. import distribution
+from ..distribution import ITEM_NONE, pool_distribution
+from ..module import MappingState, PGStats
+
+USE_NUMPY = [False, True] if distribution.np is not None else [False]
+
+
+def dict_walk(ups, objects, nbytes, roots):
+    """
+    The accounting calc_eval() did before distribution.py, one PG at a
+    time into dicts, for a single pool.
+
+    :return: ``(count by OSD, actual by root, total by root)``
+    """
+    count = {'pgs': {}, 'objects': {}, 'bytes': {}}
+    actual_by_root = {}
+    total_by_root = {}
+    for root, target in roots:
+        actual_by_root[root] = {'pgs': {}, 'objects': {}, 'bytes': {}}
+        total_by_root[root] = {'pgs': 0, 'objects': 0, 'bytes': 0}
+        for osd in target:
+            for t in ('pgs', 'objects', 'bytes'):
+                count[t][osd] = 0
+                actual_by_root[root][t][osd] = 0
+    for up, pg_objects, pg_bytes in zip(ups, objects, nbytes):
+        values = {'pgs': 1, 'objects': pg_objects, 'bytes': pg_bytes}
+        for osd in up:
+            if osd == ITEM_NONE:
+                continue
+            for t in ('pgs', 'objects', 'bytes'):
+                count[t][osd] += values[t]
+            for root, target in roots:
+                if osd in target:
+                    for t in ('pgs', 'objects', 'bytes'):
+                        actual_by_root[root][t][osd] += values[t]
+                        total_by_root[root][t] += values[t]
+                    break
+    return count, actual_by_root, total_by_root
+
+
+def by_distribution(ups, objects, nbytes, roots, size, use_numpy):
+    """
+    The same, the way calc_eval() builds it from pool_distribution().
+    """
+    by_osd, by_root = pool_distribution(ups, objects, nbytes, size, roots,
+                                        use_numpy)
+    actual_by_root = {}
+    total_by_root = {}
+    for root, target in roots:
+        actual_by_root[root] = {
+            t: dict((osd, 0) for osd in target)
+            for t in ('pgs', 'objects', 'bytes')
+        }
+        total_by_root[root] = {'pgs': 0, 'objects': 0, 'bytes': 0}
+    for root, counts in by_root.items():
+        for t in ('pgs', 'objects', 'bytes'):
+            for osd, v in counts[t].items():
+                actual_by_root[root][t][osd] += v
+            total_by_root[root][t] += sum(counts[t].values())
+    return by_osd, actual_by_root, total_by_root
+
+
+def targets(osds):
+    return dict((osd, 1.0 / len(osds)) for osd in osds)
+
+
+class PoolDistributionTest(unittest.TestCase):
+    def assert_same(self, ups, objects, nbytes, roots, size):
+        expected = dict_walk(ups, objects, nbytes, roots)
+        for use_numpy in USE_NUMPY:
+            self.assertEqual(
+                by_distribution(ups, objects, nbytes, roots, size,
+                                use_numpy),
+                expected)
+
+    def random_pgs(self, rng, osds, num_pgs, size=3):
+        ups = [rng.sample(osds, size) for _ in range(num_pgs)]
+        objects = [rng.randint(0, 1000) for _ in ups]
+        nbytes = [o * rng.randint(1, 4 << 20) for o in objects]
+        return ups, objects, nbytes
+
+    def test_single_root(self):
+        rng = random.Random(1)
+        osds = list(range(12))
+        ups, objects, nbytes = self.random_pgs(rng, osds, 256)
+        self.assert_same(ups, objects, nbytes,
+                         [('default', targets(osds))], 12)
+
+    def test_overlapping_roots(self):
+        # osds 4 and 5 are under both roots, and accounted for under the
+        # first one only
+        rng = random.Random(2)
+        ups, objects, nbytes = self.random_pgs(rng, list(range(10)), 256)
+        roots = [('a', targets(range(0, 6))), ('b', targets(range(4, 10)))]
+        self.assert_same(ups, objects, nbytes, roots, 10)
+        self.assert_same(ups, objects, nbytes, roots[::-1], 10)
+
+    def test_item_none(self):
+        rng = random.Random(3)
+        ups, objects, nbytes = self.random_pgs(rng, list(range(8)), 128)
+        for up in ups[::3]:
+            up[rng.randint(0, len(up) - 1)] = ITEM_NONE
+        ups.append([ITEM_NONE] * 3)
+        objects.append(7)
+        nbytes.append(7 << 20)
+        self.assert_same(ups, objects, nbytes,
+                         [('default', targets(range(8)))], 8)
+
+    def test_target_osds_beyond_max_osd(self):
+        # a target OSD without any PG, above the highest one mapped
+        ups = [[0, 1], [1, 2]]
+        self.assert_same(ups, [1, 2], [10, 20],
+                         [('default', targets(range(5)))], 3)
+
+    def test_empty_pool(self):
+        self.assert_same([], [], [], [('default', targets(range(4)))], 4)
+
+    def test_pgs_missing_from_stats(self):
+        # pool 1 has 8 PGs; 1.3 has not been reported, and 1.6 and 1.7
+        # (e.g. just split) are beyond the last reported one
+        columns = {'pool': [], 'ps': [], 'num_objects': [], 'num_bytes': []}
+        stat = {}
+        for ps in (0, 1, 2, 4, 5):
+            columns['pool'].append(1)
+            columns['ps'].append(ps)
+            columns['num_objects'].append(10 * (ps + 1))
+            columns['num_bytes'].append(1000 * (ps + 1))
+            stat['1.%x' % ps] = (10 * (ps + 1), 1000 * (ps + 1))
+        rng = random.Random(4)
+        ms = MappingState.__new__(MappingState)
+        ms.pg_stats = PGStats(columns)
+        ms.pg_up_by_poolid = {
+            1: dict(('1.%x' % ps, rng.sample(range(6), 3))
+                    for ps in range(8)),
+        }
+        ups, objects, nbytes = ms.pool_pgs(1)
+        pgids = list(ms.pg_up_by_poolid[1])
+        self.assertEqual(objects, [stat.get(pgid, (0, 0))[0]
+                                   for pgid in pgids])
+        self.assertEqual(nbytes, [stat.get(pgid, (0, 0))[1]
+                                  for pgid in pgids])
+        self.assertEqual(ms.pg_stats.objects('1.4'), 50)
+        self.assertEqual(ms.pg_stats.objects('1.3'), 0)
+        self.assertEqual(ms.pg_stats.objects('1.7'), 0)
+        self.assert_same(ups, objects, nbytes,
+                         [('default', targets(range(6)))], 6)
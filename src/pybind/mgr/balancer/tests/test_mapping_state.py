@@ -0,0 +1,141 @@
+import copy
+import random
+import unittest
+
+from ..module import MappingState, Plan
+from ..simulate import SimModule, SimOSDMap
+from .fake_cluster import FakeTools, cluster, pg_stats
+
+
+class TestRemap(unittest.TestCase):
+    """
+    The states do_crush_compat() remap()s from the last step's, and the
+    evals it derives from the last step's, against ones built from
+    scratch.
+    """
+
+    def setUp(self):
+        self.tools = FakeTools()
+        osdmap_dump, crush_dump = cluster(
+            [('default', [1.0, 1.0, 2.0, 1.0, 0.5, 1.0]),
+             ('ssd', [1.0, 1.0, 1.0, 1.0])],
+            [('rbd', 'default', 64),
+             ('data', 'default', 32),
+             ('fast', 'ssd', 32)])
+        osdmap = SimOSDMap(self.tools,
+                           self.tools.add(osdmap_dump, crush_dump))
+        self.module = SimModule(osdmap, pg_stats(osdmap_dump), {}, 0.05,
+                                log_level=0)
+        self.ms = MappingState(osdmap, self.module.get_pg_stats(), 'initial')
+        self.take_pools = []
+        self.take_pools_by_root = {}
+        crush = osdmap.get_crush()
+        for rootid in crush.find_takes():
+            take = (set(crush.get_take_weight_osd_map(rootid)),
+                    osdmap.get_pools_by_take(rootid))
+            self.take_pools.append(take)
+            self.take_pools_by_root[crush.get_item_name(rootid)] = take
+
+    def assert_same_eval(self, pe, fresh_pe):
+        self.assertAlmostEqual(pe.score, fresh_pe.score, places=12)
+        self.assertEqual(pe.count_by_root, fresh_pe.count_by_root)
+        self.assertEqual(pe.total_by_root, fresh_pe.total_by_root)
+        self.assertEqual(pe.count_by_pool, fresh_pe.count_by_pool)
+
+    def crush_compat_steps(self, pools, steps, seed):
+        """
+        :param steps: one letter per step: ``s`` reweights some OSDs,
+            ``b`` too and keeps the result as the best so far, ``r`` goes
+            back to the best weights, as a step misplacing too much, or
+            scoring worse, does
+        """
+        rng = random.Random(seed)
+        plan = Plan('test', self.ms, pools)
+        orig_ws = self.module.get_compat_weight_set_weights(self.ms)
+        orig_ws = dict((osd, w) for osd, w in orig_ws.items() if osd >= 0)
+        pe = self.module.calc_eval(self.ms, pools)
+        best_ws = copy.deepcopy(orig_ws)
+        last_ms = self.ms
+        last_pe = pe
+        last_ws = orig_ws
+        for step in steps:
+            if step == 'r':
+                next_ws = copy.deepcopy(best_ws)
+            else:
+                next_ws = copy.deepcopy(last_ws)
+                # reweight the OSDs of one root only, so that the pools
+                # of the other keep their up sets
+                osds = sorted(rng.choice(self.take_pools)[0])
+                for osd in rng.sample(osds, 2):
+                    next_ws[osd] *= rng.uniform(0.7, 1.3)
+                if step == 'b':
+                    best_ws = copy.deepcopy(next_ws)
+            changed = set(osd for osd, w in next_ws.items()
+                          if w != last_ws.get(osd))
+            poolids = set()
+            for osds, take_poolids in self.take_pools:
+                if not changed.isdisjoint(osds):
+                    poolids.update(take_poolids)
+            plan.compat_ws = copy.deepcopy(next_ws)
+            next_ms = plan.final_state(last_ms, poolids)
+            next_pe = self.module.calc_eval(next_ms, pools, last_pe)
+
+            fresh_ms = plan.final_state()
+            self.assertEqual(next_ms.pg_up_by_poolid,
+                             fresh_ms.pg_up_by_poolid)
+            self.assert_same_eval(next_pe,
+                                  self.module.calc_eval(fresh_ms, pools))
+            self.assertEqual(next_ms.calc_misplaced_from(self.ms),
+                             fresh_ms.calc_misplaced_from(self.ms))
+            # once more, from the counts cached by the first call
+            self.assertEqual(next_ms.calc_misplaced_from(self.ms),
+                             fresh_ms.calc_misplaced_from(self.ms))
+
+            last_ms = next_ms
+            last_pe = next_pe
+            last_ws = plan.compat_ws
+        return last_ms
+
+    def test_all_pools(self):
+        ms = self.crush_compat_steps([], 'sbrssbsr', 1)
+        self.assertGreater(ms.calc_misplaced_from(self.ms), 0)
+
+    def test_some_pools(self):
+        self.crush_compat_steps(['rbd', 'fast'], 'sbrbsrr', 2)
+
+    def test_one_root(self):
+        self.crush_compat_steps(['data'], 'bsrsbr', 3)
+
+    def test_reset_to_initial(self):
+        # no step is kept, so the resets go back to the initial weights,
+        # which misplace nothing
+        ms = self.crush_compat_steps([], 'ssrsr', 4)
+        self.assertEqual(ms.calc_misplaced_from(self.ms), 0.0)
+
+    def test_eval_of_unchanged_pools_is_reused(self):
+        pools = []
+        pe = self.module.calc_eval(self.ms, pools)
+        plan = Plan('test', self.ms, pools)
+        ws = dict((osd, w) for osd, w in
+                  self.module.get_compat_weight_set_weights(self.ms).items()
+                  if osd >= 0)
+        ssd_osds, ssd_poolids = self.take_pools_by_root['ssd']
+        for osd in ssd_osds:
+            ws[osd] *= 1.0 + osd / 10.0
+        plan.compat_ws = ws
+        mapped = self.tools.mapped
+        ms = plan.final_state(self.ms, ssd_poolids)
+        # one mapping for the new osdmap, of the ssd pool only
+        self.assertEqual(self.tools.mapped, mapped + 1)
+        remapped_pe = self.module.calc_eval(ms, pools, pe)
+        self.assertIs(remapped_pe.count_by_root['default'],
+                      pe.count_by_root['default'])
+        self.assertIsNot(remapped_pe.count_by_root['ssd'],
+                         pe.count_by_root['ssd'])
+        self.assert_same_eval(remapped_pe,
+                              self.module.calc_eval(plan.final_state(),
+                                                    pools))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import simulate
+from ..simulate import SimModule, SimOSDMap
+from .fake_cluster import FakeTools, cluster, pg_stats
+
+
+class TestSimulate(unittest.TestCase):
+    """
+    simulate() end to end, with FakeTools standing in for osdmaptool and
+    crushtool.
+    """
+
+    def setUp(self):
+        self.tools = FakeTools()
+        self.osdmap_dump, crush_dump = cluster(
+            [('default', [1.0, 1.0, 2.0, 1.0, 0.5, 1.0]),
+             ('ssd', [1.0, 1.0, 1.0, 1.0])],
+            [('rbd', 'default', 64),
+             ('data', 'default', 32),
+             ('fast', 'ssd', 32)])
+        self.osdmap = self.tools.add(self.osdmap_dump, crush_dump)
+        self.workdir = tempfile.mkdtemp(prefix='balancer-test.')
+        self.pg_dump = os.path.join(self.workdir, 'pg_dump.json')
+        with open(self.pg_dump, 'w') as f:
+            json.dump({'pg_map': {'pg_stats': pg_stats(self.osdmap_dump)}},
+                      f)
+        self.orig_tools = simulate.Tools
+        simulate.Tools = lambda workdir, *args: self.tools
+
+    def tearDown(self):
+        simulate.Tools = self.orig_tools
+        shutil.rmtree(self.workdir)
+
+    def simulate(self, options, pools=[]):
+        return simulate.simulate(self.osdmap, self.pg_dump, pools, options,
+                                 0.05, [], 0)
+
+    def test_upmap(self):
+        report = self.simulate({'mode': 'upmap', 'upmap_max_deviation': 1})
+        self.assertEqual(report['result'], 0, report['detail'])
+        self.assertLess(report['score'], report['initial_score'])
+        self.assertGreater(report['changes'], 0)
+        self.assertIn('ceph osd pg-upmap-items', report['plan'])
+        self.assertGreater(report['misplaced'], 0)
+
+    def test_upmap_pools(self):
+        report = self.simulate({'mode': 'upmap', 'upmap_max_deviation': 1},
+                               ['fast'])
+        self.assertEqual(report['result'], 0, report['detail'])
+        for line in report['plan'].splitlines():
+            if not line.startswith('#'):
+                self.assertTrue(line.split()[3].startswith('3.'), line)
+
+    def test_crush_compat(self):
+        report = self.simulate({'mode': 'crush-compat'})
+        self.assertEqual(report['result'], 0, report['detail'])
+        self.assertLess(report['score'], report['initial_score'])
+        self.assertIn('ceph osd crush weight-set create-compat',
+                      report['plan'])
+        self.assertLessEqual(report['misplaced'], 0.05)
+
+    def test_mapping_state_is_reused(self):
+        module = SimModule(SimOSDMap(self.tools, self.osdmap),
+                           pg_stats(self.osdmap_dump), {}, 0.05, 0)
+        osdmap = module.get_osdmap()
+        ms = module.plan_create('a', osdmap, []).initial
+        again = module.plan_create('b', osdmap, []).initial
+        self.assertIs(again.pg_up_by_poolid, ms.pg_up_by_poolid)
+        self.assertEqual(again.desc, 'plan b initial')
+
+    def test_unversioned_pg_stats(self):
+        module = SimModule(SimOSDMap(self.tools, self.osdmap),
+                           pg_stats(self.osdmap_dump), {}, 0.05, 0)
+        module._ceph_get_data_version = lambda data_name: None
+        osdmap = module.get_osdmap()
+        ms = module.plan_create('a', osdmap, []).initial
+        again = module.plan_create('b', osdmap, []).initial
+        self.assertIsNot(again, ms)
+        self.assertIsNot(again.pg_up_by_poolid, ms.pg_up_by_poolid)
+        self.assertEqual(again.pg_up_by_poolid, ms.pg_up_by_poolid)
+        self.assertIsNone(module.mapping_state)
+
+
+if __name__ == '__main__':
+    unittest.main()
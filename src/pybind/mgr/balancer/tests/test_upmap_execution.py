@@ -0,0 +1,202 @@
+import json
+import unittest
+
+from ..simulate import SimModule, SimOSDMap
+from .fake_cluster import FakeTools, cluster, pg_stats
+
+
+class FakeMonModule(SimModule):
+    """
+    A SimModule whose upmap commands change the monitors' osdmap, which
+    the module only sees once deliver() is called, and whose PGs report
+    stats when report() is.
+    """
+
+    def __init__(self, tools, path, options):
+        osdmap_dump = tools.osdmap_dump(path)
+        self.tools = tools
+        self.mon_osdmap = SimOSDMap(tools, path)
+        self.pg_version = 1
+        stats = pg_stats(osdmap_dump)
+        for pg in stats:
+            pg['reported_epoch'] = osdmap_dump['epoch']
+        super(FakeMonModule, self).__init__(self.mon_osdmap, stats, options,
+                                            0.05, log_level=0)
+
+    def set_upmap_items(self, pgid, mappings):
+        osdmap_dump = self.tools.osdmap_dump(self.mon_osdmap._path)
+        items = [i for i in osdmap_dump['pg_upmap_items']
+                 if i['pgid'] != pgid]
+        if mappings:
+            items.append({'pgid': pgid, 'mappings': mappings})
+        osdmap_dump['pg_upmap_items'] = items
+        osdmap_dump['epoch'] += 1
+        self.mon_osdmap = SimOSDMap(self.tools, self.tools.add(
+            osdmap_dump, self.tools.crush_dump(self.mon_osdmap._path)))
+
+    def deliver(self):
+        self._sim_osdmap = self.mon_osdmap
+
+    def report(self, pgids=None):
+        epoch = self._sim_osdmap.get_epoch()
+        for pg in self._sim_pg_stats:
+            if pgids is None or pg['pgid'] in pgids:
+                pg['reported_epoch'] = epoch
+        self.pg_version += 1
+
+    def _ceph_send_command(self, result, svc_type, svc_id, command, tag):
+        command = json.loads(command)
+        if command['prefix'] == 'osd stat':
+            result.complete(0, json.dumps({
+                'epoch': self.mon_osdmap.get_epoch()}), '')
+            return
+        if command['prefix'] == 'osd pg-upmap-items':
+            osds = command['id']
+            self.set_upmap_items(command['pgid'], [
+                {'from': a, 'to': b} for a, b in zip(osds[::2], osds[1::2])])
+        elif command['prefix'] == 'osd rm-pg-upmap-items':
+            self.set_upmap_items(command['pgid'], [])
+        else:
+            raise KeyError(command['prefix'])
+        result.complete(0, '', '')
+
+    def _ceph_get(self, data_name):
+        if data_name == 'pg_status':
+            return {'misplaced_objects': 0, 'misplaced_total': 1 << 40}
+        return super(FakeMonModule, self)._ceph_get(data_name)
+
+    def _ceph_get_data_version(self, data_name):
+        return (self._sim_osdmap.get_epoch(), self.pg_version)
+
+
+class TestUpmapExecution(unittest.TestCase):
+
+    def setUp(self):
+        tools = FakeTools()
+        osdmap_dump, crush_dump = cluster(
+            [('default', [1.0, 1.0, 2.0, 1.0, 0.5, 1.0])],
+            [('rbd', 'default', 64)])
+        self.module = FakeMonModule(tools, tools.add(osdmap_dump,
+                                                     crush_dump), {
+            'mode': 'upmap',
+            'upmap_max_deviation': 1,
+            'upmap_max_batch': 2,
+        })
+        plan = self.module.plan_create('test', self.module.get_osdmap(), [])
+        r, detail = self.module.optimize(plan)
+        self.assertEqual(r, 0, detail)
+        r, detail = self.module.execute(plan)
+        self.assertEqual(r, 0, detail)
+        self.ex = self.module.upmap_execution
+        self.assertGreater(len(self.ex.pending), 4)
+
+    def test_batch_waits_for_pgs_reported_from_its_epoch(self):
+        module = self.module
+        pending = len(self.ex.pending)
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertEqual(len(self.ex.pending), pending - 2)
+        self.assertEqual(self.ex.epoch, module.mon_osdmap.get_epoch())
+        first = list(self.ex.pgids)
+        self.assertEqual(len(first), 2)
+
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertIn('not received', self.ex.waiting)
+        # new PG stats alone, as after a pg_status version bump, are not
+        # enough
+        module.report()
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertIn('not received', self.ex.waiting)
+
+        module.deliver()
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertIn('2 PGs of the last batch', self.ex.waiting)
+        module.report(first[:1])
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertIn('1 PGs of the last batch', self.ex.waiting)
+        # nothing new reported, nothing rescanned
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertEqual(len(self.ex.pending), pending - 2)
+
+        module.report(first[1:])
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertEqual(len(self.ex.pending), pending - 4)
+        self.assertNotEqual(self.ex.pgids, first)
+        self.assertEqual(self.ex.submitted, 4)
+
+    def test_waiting_for_pg_stats(self):
+        module = self.module
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertEqual(self.ex.waiting, '')
+        module.deliver()
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertIn('2 PGs of the last batch', self.ex.waiting)
+        self.ex.waiting = ''
+        # PG stats version unchanged
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertIn('PG stats not updated', self.ex.waiting)
+
+    def test_pg_never_reporting(self):
+        module = self.module
+        pending = len(self.ex.pending)
+        self.assertTrue(module.execute_upmap_batch())
+        stuck, reporting = self.ex.pgids
+        module.deliver()
+        module.report([reporting])
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertEqual(self.ex.pgids, [stuck])
+        self.assertIn('1 PGs of the last batch', self.ex.waiting)
+        # the PG stats do not change any more
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertEqual(len(self.ex.pending), pending - 2)
+
+        when, changes, objects = self.ex.last_batch
+        self.ex.last_batch = (when - 600, changes, objects)
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertEqual(len(self.ex.pending), pending - 4)
+        self.assertNotIn(stuck, self.ex.pgids)
+        self.assertEqual(self.ex.batches, 2)
+
+    def test_osdmap_never_received(self):
+        module = self.module
+        pending = len(self.ex.pending)
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertIn('not received', self.ex.waiting)
+        when, changes, objects = self.ex.last_batch
+        self.ex.last_batch = (when - 600, changes, objects)
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertEqual(len(self.ex.pending), pending - 4)
+
+    def test_changes_of_changed_upmaps_are_dropped(self):
+        module = self.module
+        pending = len(self.ex.pending)
+        stale = self.ex.pending[0][0]
+        # changed by someone else since the plan was made
+        module.set_upmap_items(stale, [{'from': 0, 'to': 1}])
+        module.deliver()
+        module.report()
+        self.assertTrue(module.execute_upmap_batch())
+        self.assertEqual(self.ex.dropped, 1)
+        self.assertEqual(self.ex.submitted, 2)
+        self.assertNotIn(stale, self.ex.pgids)
+        self.assertEqual(len(self.ex.pending), pending - 3)
+        upmaps = dict((i['pgid'], i['mappings']) for i in
+                      module.mon_osdmap.dump()['pg_upmap_items'])
+        self.assertEqual(upmaps[stale], [{'from': 0, 'to': 1}])
+
+    def test_all_changes(self):
+        module = self.module
+        pending = len(self.ex.pending)
+        for _ in range(100):
+            if not module.execute_upmap_batch():
+                break
+            module.deliver()
+            module.report()
+        self.assertIsNone(module.upmap_execution)
+        self.assertEqual(self.ex.submitted, pending)
+        self.assertEqual(self.ex.failed, 0)
+        self.assertEqual(self.ex.batches, (pending + 1) // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
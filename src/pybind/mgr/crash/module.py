@@ -102,8 +102,12 @@ class Module(MgrModule):
 
         cutoff = now - datetime.timedelta(days=keep)
 
-        for key, _ in self.timestamp_filter(lambda ts: ts <= cutoff):
-            self.set_store(key, None)
+        keys = [key for key, _ in
+                self.timestamp_filter(lambda ts: ts <= cutoff)]
+        if keys:
+            r, _, outs = self.set_store_batch(dict.fromkeys(keys)).wait()
+            if r:
+                return r, '', outs
 
         return 0, '', ''
 
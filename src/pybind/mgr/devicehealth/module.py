@@ -81,6 +81,20 @@ class Module(MgrModule):
             'desc': 'how frequently to wake up and check device health',
             'runtime': True,
         },
+        {
+            'name': 'scrape_max_in_flight',
+            'default': 16,
+            'type': 'int',
+            'desc': 'maximum number of daemons to scrape concurrently',
+            'runtime': True,
+        },
+        {
+            'name': 'scrape_timeout',
+            'default': 300,
+            'type': 'secs',
+            'desc': 'how long to wait for a daemon to return health metrics',
+            'runtime': True,
+        },
     ]
 
     COMMANDS = [
@@ -329,8 +343,14 @@ class Module(MgrModule):
         monmap = self.get("mon_map")
         for mon in monmap['mons']:
             ids.append(('mon', mon['name']))
-        for daemon_type, daemon_id in ids:
-            raw_smart_data = self.do_scrape_daemon(daemon_type, daemon_id)
+        results = self.send_commands(
+            [(daemon_type, daemon_id, self._smart_command())
+             for daemon_type, daemon_id in ids],
+            max_in_flight=int(self.scrape_max_in_flight),
+            timeout=int(self.scrape_timeout))
+        for (daemon_type, daemon_id, _), r, outb, outs in results:
+            raw_smart_data = self._parse_scrape(daemon_type, daemon_id,
+                                                r, outb, outs)
             if not raw_smart_data:
                 continue
             for device, raw_data in raw_smart_data.items():
@@ -362,19 +382,18 @@ class Module(MgrModule):
         ioctx.close()
         return 0, "", ""
 
-    def do_scrape_daemon(self, daemon_type, daemon_id, devid=''):
-        """
-        :return: a dict, or None if the scrape failed.
-        """
-        self.log.debug('do_scrape_daemon %s.%s' % (daemon_type, daemon_id))
-        result = CommandResult('')
-        self.send_command(result, daemon_type, daemon_id, json.dumps({
+    def _smart_command(self, devid=''):
+        return {
             'prefix': 'smart',
             'format': 'json',
             'devid': devid,
-        }), '')
-        r, outb, outs = result.wait()
+        }
 
+    def _parse_scrape(self, daemon_type, daemon_id, r, outb, outs):
+        if r == -errno.ETIMEDOUT:
+            self.log.error('Timed out scraping daemon {0}.{1}: {2}'.format(
+                daemon_type, daemon_id, outs))
+            return None
         try:
             return json.loads(outb)
         except (IndexError, ValueError):
@@ -382,6 +401,17 @@ class Module(MgrModule):
                 "Fail to parse JSON result from daemon {0}.{1} ({2})".format(
                     daemon_type, daemon_id, outb))
 
+    def do_scrape_daemon(self, daemon_type, daemon_id, devid=''):
+        """
+        :return: a dict, or None if the scrape failed.
+        """
+        self.log.debug('do_scrape_daemon %s.%s' % (daemon_type, daemon_id))
+        result = CommandResult('')
+        self.send_command(result, daemon_type, daemon_id,
+                          json.dumps(self._smart_command(devid)), '')
+        r, outb, outs = result.wait()
+        return self._parse_scrape(daemon_type, daemon_id, r, outb, outs)
+
     def put_device_metrics(self, ioctx, devid, data):
         old_key = datetime.utcnow() - timedelta(
             seconds=int(self.retention_period))
@@ -417,15 +447,26 @@ class Module(MgrModule):
             ioctx.operate_write_op(op, devid)
 
     def show_device_metrics(self, devid, sample):
+        r, res, outs = self.get_device_metrics(devid, sample)
+        if r != 0:
+            return r, '', outs
+        return 0, json.dumps(res, indent=4), ''
+
+    def get_device_metrics(self, devid, sample=''):
+        """
+        Like ``show_device_metrics``, but return the metrics as a dict of
+        sample timestamp to metrics rather than as JSON, for other modules
+        calling through ``remote()``.
+        """
         # verify device exists
         r = self.get("device " + devid)
         if not r or 'device' not in r.keys():
-            return -errno.ENOENT, '', 'device ' + devid + ' not found'
+            return -errno.ENOENT, {}, 'device ' + devid + ' not found'
         # fetch metrics
         res = {}
         ioctx = self.open_connection(create_if_missing=False)
         if not ioctx:
-            return 0, json.dumps(res, indent=4), ''
+            return 0, res, ''
         with ioctx:
             with rados.ReadOpCtx() as op:
                 omap_iter, ret = ioctx.get_omap_vals(op, "", sample or '', 500)  # fixme
@@ -448,7 +489,7 @@ class Module(MgrModule):
                     self.log.exception("RADOS error reading omap: {0}".format(e))
                     raise
 
-        return 0, json.dumps(res, indent=4), ''
+        return 0, res, ''
 
     def check_health(self):
         self.log.info('Check health')
@@ -89,33 +89,29 @@ class CephClusterAgent(MetricsAgent):
         else:
             c_data.fields['osd_bytes_used_percentage'] = 0.0000
 
-        pg_stats = obj_api.module.get('pg_dump').get('pg_stats', [])
-        num_bytes = 0
-        num_object = 0
-        num_object_degraded = 0
-        num_object_misplaced = 0
-        num_object_unfound = 0
-        num_pg_active = 0
+        pg_stats = obj_api.module.get_pg_stats_columns([
+            'state', 'acting', 'num_bytes', 'num_objects',
+            'num_objects_degraded', 'num_objects_misplaced',
+            'num_objects_unfound'])
+        state_bits = obj_api.module.get_pg_state_bits()
+        active_clean = state_bits['active'] | state_bits['clean']
+        peering = state_bits['peering']
+        num_pg = len(pg_stats['state'])
+        num_bytes = sum(pg_stats['num_bytes'])
+        num_object = sum(pg_stats['num_objects'])
+        num_object_degraded = sum(pg_stats['num_objects_degraded'])
+        num_object_misplaced = sum(pg_stats['num_objects_misplaced'])
+        num_object_unfound = sum(pg_stats['num_objects_unfound'])
+        num_pg_active = len(pg_stats['acting'])
         num_pg_active_clean = 0
         num_pg_peering = 0
-        for pg_data in pg_stats:
-            num_pg_active = num_pg_active + len(pg_data.get('acting'))
-            if 'active+clean' in pg_data.get('state'):
+        for state in pg_stats['state']:
+            if state & active_clean == active_clean:
                 num_pg_active_clean = num_pg_active_clean + 1
-            if 'peering' in pg_data.get('state'):
+            if state & peering:
                 num_pg_peering = num_pg_peering + 1
 
-            stat_sum = pg_data.get('stat_sum', {})
-            num_object = num_object + stat_sum.get('num_objects', 0)
-            num_object_degraded = \
-                num_object_degraded + stat_sum.get('num_objects_degraded', 0)
-            num_object_misplaced = \
-                num_object_misplaced + stat_sum.get('num_objects_misplaced', 0)
-            num_object_unfound = \
-                num_object_unfound + stat_sum.get('num_objects_unfound', 0)
-            num_bytes = num_bytes + stat_sum.get('num_bytes', 0)
-
-        c_data.fields['num_pg'] = len(pg_stats)
+        c_data.fields['num_pg'] = num_pg
         c_data.fields['num_object'] = num_object
         c_data.fields['num_object_degraded'] = num_object_degraded
         c_data.fields['num_object_misplaced'] = num_object_misplaced
@@ -355,12 +355,10 @@ class ClusterAPI(object):
     def get_device_health(self, devid):
         health_data = {}
         try:
-            r, outb, outs = self.module.remote('devicehealth', 'show_device_metrics', devid=devid, sample='')
+            r, health_data, outs = self.module.remote('devicehealth', 'get_device_metrics', devid=devid)
             if r != 0:
                 self.module.log.error('failed to get device %s health', devid)
                 health_data = {}
-            else:
-                health_data = json.loads(outb)
         except Exception as e:
             self.module.log.error('failed to get device %s health data due to %s', devid, str(e))
         return health_data
@@ -127,12 +127,10 @@ class Module(MgrModule):
         health_data = {}
         predict_datas = []
         try:
-            r, outb, outs = self.remote('devicehealth', 'show_device_metrics', devid=devid, sample='')
+            r, health_data, outs = self.remote('devicehealth', 'get_device_metrics', devid=devid)
             if r != 0:
                 self.log.error('failed to get device %s health', devid)
                 health_data = {}
-            else:
-                health_data = json.loads(outb)
         except Exception as e:
             self.log.error('failed to get device %s health data due to %s', devid, str(e))
 
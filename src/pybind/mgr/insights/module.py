@@ -127,9 +127,11 @@ class Module(MgrModule):
     def _health_prune_history(self, hours):
         """Prune old health entries"""
         cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours = hours)
-        for key in self._health_filter(lambda ts: ts <= cutoff):
+        keys = list(self._health_filter(lambda ts: ts <= cutoff))
+        for key in keys:
             self.log.info("Removing old health slot key {}".format(key))
-            self.set_store(key, None)
+        if keys:
+            self.set_store_batch(dict.fromkeys(keys))
 
     def _health_report(self, hours):
         """
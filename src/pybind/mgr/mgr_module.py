@@ -1,10 +1,17 @@
 import ceph_module  # noqa
 
+import array
+import copy
+import errno
+import inspect
 import logging
 import json
+import os
 import six
+import sys
 import threading
 from collections import defaultdict, namedtuple
+from six.moves import queue
 import rados
 import time
 
@@ -40,6 +47,9 @@ PG_STATES = [
     "creating",
     "unknown"]
 
+# array.array typecode for the int64 columns of get_pg_stats_columns()
+PG_STATS_COLUMN_TYPECODE = 'q' if six.PY3 else 'l'
+
 
 class CPlusPlusHandler(logging.Handler):
     def __init__(self, module_inst):
@@ -133,6 +143,217 @@ class CommandResult(object):
         return self.r, self.outb, self.outs
 
 
+class _BatchCommandResult(CommandResult):
+    """
+    Completion used by MgrModule.send_commands: as well as recording
+    the result, it hands itself to the queue shared by the whole batch
+    so that the issuing thread can pick results up in completion order.
+    """
+
+    def __init__(self, request, done, tag=None):
+        super(_BatchCommandResult, self).__init__(tag)
+        self.request = request
+        self.done = done
+        self.deadline = None
+
+    def complete(self, r, outb, outs):
+        super(_BatchCommandResult, self).complete(r, outb, outs)
+        self.done.put(self)
+
+
+def _read_only(*args, **kwargs):
+    raise TypeError("cached cluster data is read-only; "
+                    "copy.deepcopy() it before modifying")
+
+
+class ReadOnlyDict(dict):
+    """
+    A ``dict`` that refuses modification.  Returned (nested) by
+    ``MgrModule.get`` when the data cache is enabled, because the same
+    object is handed out to every caller until the underlying map changes.
+
+    ``copy.copy`` and ``copy.deepcopy`` return plain, mutable objects.
+    """
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+    __ior__ = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict((copy.deepcopy(k, memo), copy.deepcopy(v, memo))
+                    for k, v in six.iteritems(self))
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class ReadOnlyList(list):
+    """
+    The ``list`` counterpart of ``ReadOnlyDict``.
+    """
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+    clear = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def freeze(obj):
+    """
+    Return a read-only copy of a tree of dicts and lists, as returned
+    by ``MgrModule.get``.  Leaves (strings, numbers) are shared.
+    """
+    if isinstance(obj, dict):
+        return ReadOnlyDict((k, freeze(v)) for k, v in six.iteritems(obj))
+    if isinstance(obj, list):
+        return ReadOnlyList(freeze(v) for v in obj)
+    return obj
+
+
+class DataCache(object):
+    """
+    Cache of ``MgrModule.get`` results, keyed by data name and by the
+    map epoch / PG stat version the data was built from.
+
+    Only the most recent version of each data name is kept.  Lookups
+    that find an older version count as misses and replace the entry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # data name -> (version, frozen data)
+        self._hits = defaultdict(int)
+        self._misses = defaultdict(int)
+
+    def get(self, data_name, version, fetch):
+        """
+        :param data_name: name as passed to ``MgrModule.get``
+        :param version: opaque version tuple; ``None`` bypasses the cache
+        :param fetch: callable building the data when it is not cached
+        """
+        if version is None:
+            return fetch()
+        with self._lock:
+            entry = self._entries.get(data_name)
+            if entry is not None and entry[0] == version:
+                self._hits[data_name] += 1
+                return entry[1]
+            self._misses[data_name] += 1
+
+        # Build outside the lock: concurrent misses on the same version
+        # may build twice, but never block each other behind a fetch.
+        data = freeze(fetch())
+        with self._lock:
+            entry = self._entries.get(data_name)
+            if entry is None or entry[0] <= version:
+                self._entries[data_name] = (version, data)
+        return data
+
+    def invalidate(self, data_name=None):
+        with self._lock:
+            if data_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(data_name, None)
+
+    def stats(self):
+        with self._lock:
+            names = set(self._hits) | set(self._misses)
+            return dict((name, {
+                'hits': self._hits[name],
+                'misses': self._misses[name],
+                'cached_version': list(self._entries[name][0])
+                if name in self._entries else None,
+            }) for name in names)
+
+
+class StackSampler(threading.Thread):
+    """
+    Sampling profiler behind ``ceph mgr module profile start``: every
+    ``interval`` seconds, record the stack of each thread that is
+    running code from the module's directory.
+    """
+
+    # distinct stacks kept; samples of any further stacks are only counted
+    MAX_STACKS = 10000
+
+    def __init__(self, module_path, interval):
+        super(StackSampler, self).__init__(name='profiler')
+        self.daemon = True
+        self.module_path = os.path.join(module_path, '')
+        self.interval = interval
+        self.started_at = time.time()
+        self.stopped_at = None
+        self._lock = threading.Lock()
+        self._stacks = defaultdict(int)
+        self._samples = 0
+        self._overflow = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_ident = threading.current_thread().ident
+        while not self._stop_event.wait(self.interval):
+            self._sample(own_ident)
+        self.stopped_at = time.time()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _sample(self, own_ident):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            ours = False
+            while frame is not None:
+                code = frame.f_code
+                ours = ours or code.co_filename.startswith(self.module_path)
+                stack.append((code.co_filename, frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            if not ours:
+                continue
+            stack = tuple(reversed(stack))
+            with self._lock:
+                self._samples += 1
+                if stack in self._stacks or \
+                        len(self._stacks) < self.MAX_STACKS:
+                    self._stacks[stack] += 1
+                else:
+                    self._overflow += 1
+
+    def format(self, count):
+        with self._lock:
+            samples = self._samples
+            overflow = self._overflow
+            stacks = sorted(six.iteritems(self._stacks),
+                            key=lambda s: s[1], reverse=True)[:count]
+        duration = (self.stopped_at or time.time()) - self.started_at
+        lines = ['{0} samples in {1:.1f}s, every {2}s ({3})'.format(
+            samples, duration, self.interval,
+            'running' if self.stopped_at is None else 'stopped')]
+        if overflow:
+            lines.append('{0} samples of further stacks not kept'.format(
+                overflow))
+        for stack, hits in stacks:
+            lines.append('')
+            lines.append('{0} samples ({1:.1f}%):'.format(
+                hits, 100.0 * hits / samples))
+            for filename, lineno, name in stack:
+                lines.append('  File "{0}", line {1}, in {2}'.format(
+                    filename, lineno, name))
+        return '\n'.join(lines)
+
+
 class HandleCommandResult(namedtuple('HandleCommandResult', ['retval', 'stdout', 'stderr'])):
     def __new__(cls, retval=0, stdout="", stderr=""):
         """
@@ -155,6 +376,92 @@ class HandleCommandResult(namedtuple('HandleCommandResult', ['retval', 'stdout',
         return super(HandleCommandResult, cls).__new__(cls, retval, stdout, stderr)
 
 
+class CRUSHMapIndex(object):
+    """
+    Lookup tables built from one dump of a CRUSH map, so that rule,
+    bucket and device queries do not each re-dump and scan the map.
+
+    The tables are frozen (see ``freeze``) because one index is shared
+    by every caller looking at the same OSDMap epoch.
+    """
+
+    def __init__(self, dump):
+        self.rules_by_id = {}
+        self.rules_by_name = {}
+        self.rule_roots = {}  # rule name -> item of first 'take' step
+        for rule in freeze(dump['rules']):
+            self.rules_by_id[rule['rule_id']] = rule
+            self.rules_by_name[rule['rule_name']] = rule
+            takes = [s for s in rule['steps'] if s['op'] == 'take']
+            if takes:
+                self.rule_roots[rule['rule_name']] = takes[0]['item']
+
+        self.buckets = dict((b['id'], b) for b in freeze(dump['buckets']))
+        children = set()
+        for b in six.itervalues(self.buckets):
+            children.update(i['id'] for i in b['items'] if i['id'] < 0)
+        # Device class shadow trees ("default~ssd") are roots too, but
+        # only the real hierarchy says which host an OSD lives in.
+        self.roots = set(self.buckets) - children
+
+        self._osds_under = {}
+        self.osd_host = {}
+        self.osd_roots = defaultdict(set)
+        for root in self.roots:
+            shadow = '~' in self.buckets[root]['name']
+            self._walk(root, root, not shadow)
+        self.osd_roots = dict(self.osd_roots)
+
+        counts = defaultdict(int)
+        for device in dump['devices']:
+            counts[device.get('class', None)] += 1
+        self.device_class_counts = dict(counts)
+
+    def _walk(self, bucket_id, root, find_hosts):
+        if bucket_id in self._osds_under:
+            osds = self._osds_under[bucket_id]
+        else:
+            osds = []
+            for item in self.buckets[bucket_id]['items']:
+                if item['id'] >= 0:
+                    osds.append(item['id'])
+                elif item['id'] in self.buckets:
+                    osds.extend(self._walk(item['id'], root, find_hosts))
+            osds = self._osds_under[bucket_id] = tuple(osds)
+        for osd in osds:
+            self.osd_roots[osd].add(root)
+        if find_hosts and self.buckets[bucket_id]['type_name'] == 'host':
+            for osd in osds:
+                self.osd_host[osd] = self.buckets[bucket_id]['name']
+        return osds
+
+    def get_osds_under(self, bucket_id):
+        """
+        :return: tuple of the OSD ids beneath a bucket, in the order a
+            depth-first walk of the bucket finds them
+        """
+        return self._osds_under[bucket_id]
+
+
+class OSDMapIndex(object):
+    """
+    Lookup tables built from one OSDMap epoch: pools by id and by name,
+    and a ``CRUSHMapIndex`` of its CRUSH map.
+
+    ``MgrModule.get_osdmap`` hands the same index to every OSDMap handle
+    of an epoch, so it is only built once per epoch per module.
+    """
+
+    def __init__(self, osdmap):
+        self.epoch = osdmap.get_epoch()
+        dump = osdmap.dump()
+        pools = freeze(dump['pools'])
+        self.pools_by_id = ReadOnlyDict((p['pool'], p) for p in pools)
+        self.pools_by_name = ReadOnlyDict((p['pool_name'], p) for p in pools)
+        self.erasure_code_profiles = freeze(dump['erasure_code_profiles'])
+        self.crush = CRUSHMapIndex(osdmap._get_crush().dump())
+
+
 class OSDMap(ceph_module.BasePyOSDMap):
     def get_epoch(self):
         return self._get_epoch()
@@ -165,15 +472,29 @@ class OSDMap(ceph_module.BasePyOSDMap):
     def dump(self):
         return self._dump()
 
+    def get_index(self):
+        """
+        :return: the ``OSDMapIndex`` for this map, built on first use
+        """
+        index = getattr(self, '_index', None)
+        if index is None:
+            index = self._index = OSDMapIndex(self)
+            publish = getattr(self, '_publish_index', None)
+            if publish is not None:
+                publish(index)
+        return index
+
     def get_pools(self):
-        # FIXME: efficient implementation
-        d = self._dump()
-        return dict([(p['pool'], p) for p in d['pools']])
+        """
+        :return: read-only dict of pool id to pool
+        """
+        return self.get_index().pools_by_id
 
     def get_pools_by_name(self):
-        # FIXME: efficient implementation
-        d = self._dump()
-        return dict([(p['pool_name'], p) for p in d['pools']])
+        """
+        :return: read-only dict of pool name to pool
+        """
+        return self.get_index().pools_by_name
 
     def new_incremental(self):
         return self._new_incremental()
@@ -182,7 +503,11 @@ class OSDMap(ceph_module.BasePyOSDMap):
         return self._apply_incremental(inc)
 
     def get_crush(self):
-        return self._get_crush()
+        crush = self._get_crush()
+        # The CRUSHMap points into this OSDMap; keeping a reference
+        # both keeps it alive and lets it share our index.
+        crush._osdmap = self
+        return crush
 
     def get_pools_by_take(self, take):
         return self._get_pools_by_take(take).get('pools', [])
@@ -205,9 +530,7 @@ class OSDMap(ceph_module.BasePyOSDMap):
         return self._pool_raw_used_rate(pool_id)
 
     def get_ec_profile(self, name):
-        # FIXME: efficient implementation
-        d = self._dump()
-        return d['erasure_code_profiles'].get(name, None)
+        return self.get_index().erasure_code_profiles.get(name, None)
 
 
 class OSDMapIncremental(ceph_module.BasePyOSDMapIncremental):
@@ -259,65 +582,56 @@ class CRUSHMap(ceph_module.BasePyCRUSH):
     def get_default_choose_args(dump):
         return dump.get('choose_args').get(CRUSHMap.DEFAULT_CHOOSE_ARGS, [])
 
-    def get_rule(self, rule_name):
-        # TODO efficient implementation
-        for rule in self.dump()['rules']:
-            if rule_name == rule['rule_name']:
-                return rule
+    def get_index(self):
+        """
+        :return: the ``CRUSHMapIndex`` for this map, built on first use
+        """
+        index = getattr(self, '_index', None)
+        if index is None:
+            osdmap = getattr(self, '_osdmap', None)
+            if osdmap is not None:
+                index = osdmap.get_index().crush
+            else:
+                index = CRUSHMapIndex(self.dump())
+            self._index = index
+        return index
 
-        return None
+    def get_rule(self, rule_name):
+        return self.get_index().rules_by_name.get(rule_name)
 
     def get_rule_by_id(self, rule_id):
-        for rule in self.dump()['rules']:
-            if rule['rule_id'] == rule_id:
-                return rule
-
-        return None
+        return self.get_index().rules_by_id.get(rule_id)
 
     def get_rule_root(self, rule_name):
-        rule = self.get_rule(rule_name)
-        if rule is None:
+        index = self.get_index()
+        if rule_name not in index.rules_by_name:
             return None
 
         try:
-            first_take = [s for s in rule['steps'] if s['op'] == 'take'][0]
-        except IndexError:
+            return index.rule_roots[rule_name]
+        except KeyError:
             self.log.warn("CRUSH rule '{0}' has no 'take' step".format(
                 rule_name))
             return None
-        else:
-            return first_take['item']
 
     def get_osds_under(self, root_id):
-        # TODO don't abuse dump like this
-        d = self.dump()
-        buckets = dict([(b['id'], b) for b in d['buckets']])
+        return list(self.get_index().get_osds_under(root_id))
 
-        osd_list = []
-
-        def accumulate(b):
-            for item in b['items']:
-                if item['id'] >= 0:
-                    osd_list.append(item['id'])
-                else:
-                    try:
-                        accumulate(buckets[item['id']])
-                    except KeyError:
-                        pass
-
-        accumulate(buckets[root_id])
+    def get_osd_host(self, osd_id):
+        """
+        :return: name of the host bucket holding an OSD, or None
+        """
+        return self.get_index().osd_host.get(osd_id)
 
-        return osd_list
+    def get_osd_roots(self, osd_id):
+        """
+        :return: set of ids of the root buckets above an OSD, including
+            device class shadow roots
+        """
+        return set(self.get_index().osd_roots.get(osd_id, ()))
 
     def device_class_counts(self):
-        result = defaultdict(int)
-        # TODO don't abuse dump like this
-        d = self.dump()
-        for device in d['devices']:
-            cls = device.get('class', None)
-            result[cls] += 1
-
-        return dict(result)
+        return dict(self.get_index().device_class_counts)
 
 
 class CLICommand(object):
@@ -492,6 +806,11 @@ class MgrModule(ceph_module.BaseMgrModule):
     MODULE_OPTIONS = []
     MODULE_OPTION_DEFAULTS = {}
 
+    # Set to True in modules that only read the results of ``get()``:
+    # versioned data (maps, PG stats) is then cached per map epoch / PG
+    # stat version and shared, read-only, between all callers.
+    DATA_CACHE = False
+
     # Priority definitions for perf counters
     PRIO_CRITICAL = 10
     PRIO_INTERESTING = 8
@@ -534,6 +853,11 @@ class MgrModule(ceph_module.BaseMgrModule):
 
         self._perf_schema_cache = None
 
+        self._data_cache = DataCache()
+        self._osdmap_index = None
+
+        self._profiler = None
+
         # Keep a librados instance for those that need it.
         self._rados = None
 
@@ -640,8 +964,125 @@ class MgrModule(ceph_module.BaseMgrModule):
         Note:
             All these structures have their own JSON representations: experiment
             or look at the C++ ``dump()`` methods to learn about them.
+
+        If the module sets ``DATA_CACHE = True``, data derived from the
+        OSDMap, PGMap and other versioned maps is returned from a cache
+        as long as the map has not changed: the result is then a
+        ``ReadOnlyDict``, shared with other callers, which must be
+        ``copy.deepcopy()``-ed before being modified.
+        """
+        if not self.DATA_CACHE:
+            return self._ceph_get(data_name)
+        # Probe the version before fetching: if the map moves on in
+        # between we cache newer data under an older version, which
+        # only costs a spurious miss on the next call.
+        return self._data_cache.get(
+            data_name, self._ceph_get_data_version(data_name),
+            lambda: self._ceph_get(data_name))
+
+    def get_data_version(self, data_name):
+        """
+        Return the map epoch and PG stat version that ``get(data_name)``
+        is currently built from, as a tuple ``(epoch, version)``, or None
+        if that data is not versioned.  Cheap compared to ``get``.  For
+        ``osd_metadata`` the version counts changes to daemon metadata.
+
+        :param str data_name: as for ``get``
+        """
+        return self._ceph_get_data_version(data_name)
+
+    def get_data_cache_stats(self):
+        """
+        Hit and miss counters of the ``get()`` data cache, per data name.
+
+        :return: dict of data name to dict with ``hits``, ``misses`` and
+            ``cached_version``
+        """
+        return self._data_cache.stats()
+
+    def get_osdmap_changes(self, since_epoch, until_epoch=0):
+        """
+        Describe what changed in the OSDMap after ``since_epoch``, from a
+        history the mgr keeps as new maps arrive, without dumping either
+        map.  The history covers the last ``mgr_osdmap_change_history``
+        epochs that had changes.
+
+        :param int since_epoch: epoch the caller last looked at
+        :param int until_epoch: newest epoch to include; 0 for the latest
+        :return: dict with ``from_epoch``, ``to_epoch`` and ``complete``,
+            ``osds``: a list of ``{'osd': id, 'old': ..., 'new': ...}``,
+            where ``old`` and ``new`` hold ``exists``, ``up``, ``in`` and
+            ``weight`` as in the ``osd_map`` dump, and ``pools_created``,
+            ``pools_modified`` and ``pools_removed``: lists of pool ids.
+            If ``complete`` is False the history does not reach back to
+            ``since_epoch`` and the caller must compare full maps instead.
         """
-        return self._ceph_get(data_name)
+        return self._ceph_get_osdmap_changes(since_epoch, until_epoch)
+
+    def get_pg_changes(self, since_version):
+        """
+        Describe the PGs whose state, up set or acting set changed after
+        PGMap version ``since_version`` (see ``get_data_version``), from
+        a history of the last ``mgr_pgmap_change_history`` versions.
+
+        :param int since_version: PGMap version the caller last looked at
+        :return: dict with ``from_version``, ``to_version`` and
+            ``complete``, ``pgs``: a list of ``{'pgid', 'state', 'up',
+            'acting'}`` with the current values, and ``pgs_removed``: a
+            list of pgids.  If ``complete`` is False the history does not
+            reach back to ``since_version`` and the caller must fall back
+            to ``get('pg_dump')``.
+        """
+        return self._ceph_get_pgmap_changes(since_version)
+
+    def get_pg_stats_columns(self, fields):
+        """
+        Fetch a subset of the per-PG statistics from ``pg_dump`` as one
+        contiguous column of int64 values per field, without building a
+        dict for every PG.  Row ``i`` of every column refers to the same
+        PG.
+
+        Scalar fields are ``pool``, ``ps``, ``state`` (a bitmask, see
+        ``get_pg_state_bits``), ``reported_epoch``, ``log_size``,
+        ``ondisk_log_size``, ``up_primary``, ``acting_primary`` and the
+        ``stat_sum`` counters ``num_bytes``, ``num_objects``,
+        ``num_object_clones``, ``num_object_copies``,
+        ``num_objects_missing_on_primary``, ``num_objects_degraded``,
+        ``num_objects_misplaced``, ``num_objects_unfound``, ``num_rd``,
+        ``num_rd_kb``, ``num_wr``, ``num_wr_kb``,
+        ``num_objects_recovered``, ``num_bytes_recovered``,
+        ``num_keys_recovered``, ``num_omap_bytes`` and ``num_omap_keys``.
+
+        ``up`` and ``acting`` are flattened: the OSDs of PG ``i`` are
+        ``col['up'][col['up_offsets'][i]:col['up_offsets'][i + 1]]``.
+
+        The columns are ``array.array`` objects, which support the buffer
+        protocol, so ``numpy.frombuffer(col, dtype=numpy.int64)`` gives a
+        NumPy view without copying.
+
+        :param list fields: field names
+        :return: dict of field name to ``array.array``
+        :raises ValueError: on an unknown field name
+        """
+        columns = {}
+        raw = self._ceph_get_pg_stats_columns(list(fields))
+        for name, buf in six.iteritems(raw):
+            column = array.array(PG_STATS_COLUMN_TYPECODE)
+            if six.PY3:
+                column.frombytes(buf)
+            else:
+                column.fromstring(buf)
+            columns[name] = column
+        return columns
+
+    def get_pg_state_bits(self):
+        """
+        Map each PG state name (e.g. ``active``, ``clean``) to its bit in
+        the ``state`` column of ``get_pg_stats_columns``.
+
+        :return: dict of state name to int
+        """
+        return self._ceph_get_pg_state_bits()
 
     def _stattype_to_str(self, stattype):
 
@@ -860,6 +1301,89 @@ class MgrModule(ceph_module.BaseMgrModule):
         """
         self._ceph_send_command(*args, **kwargs)
 
+    def send_commands(self, commands, max_in_flight=16, timeout=None,
+                      tag=''):
+        """
+        Send a batch of commands to daemons concurrently, and yield the
+        results as they complete.
+
+        At most ``max_in_flight`` commands are outstanding at any one
+        time; further commands are sent as earlier ones complete.  A
+        command that has not completed ``timeout`` seconds after it was
+        sent is reported with ``-ETIMEDOUT`` and any later reply to it is
+        discarded.  A command that cannot be sent at all (for example
+        because the daemon does not exist) is reported with the error
+        rather than raising.
+
+        Each command is a ``(svc_type, svc_id, command)`` tuple, where
+        ``command`` is a dict or a JSON-serialized string, as for
+        ``send_command``.  The tag is passed through to ``send_command``
+        so the ``notify()`` callback still sees each completion.
+
+        :param commands: an iterable of ``(svc_type, svc_id, command)``
+        :param int max_in_flight: upper bound on outstanding commands
+        :param float timeout: per-command timeout in seconds, or None to
+            wait indefinitely
+        :param str tag: tag passed to ``send_command``
+        :return: a generator of ``(request, r, outb, outs)`` tuples, where
+            ``request`` is the tuple from ``commands``
+        """
+        max_in_flight = max(1, int(max_in_flight))
+        done = queue.Queue()
+        in_flight = set()
+        pending = iter(commands)
+        exhausted = False
+
+        while True:
+            failed = []
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    request = next(pending)
+                except StopIteration:
+                    exhausted = True
+                    break
+                svc_type, svc_id, command = request
+                if not isinstance(command, six.string_types):
+                    command = json.dumps(command)
+                result = _BatchCommandResult(request, done, tag)
+                if timeout is not None:
+                    result.deadline = time.time() + timeout
+                try:
+                    self.send_command(result, svc_type, str(svc_id),
+                                      command, tag)
+                except ValueError as e:
+                    failed.append((request, -errno.EINVAL, '', str(e)))
+                    continue
+                in_flight.add(result)
+
+            for f in failed:
+                yield f
+
+            if not in_flight:
+                if exhausted:
+                    return
+                continue
+
+            wait = None
+            if timeout is not None:
+                wait = max(0, min(r.deadline for r in in_flight) -
+                           time.time())
+            try:
+                result = done.get(timeout=wait)
+            except queue.Empty:
+                now = time.time()
+                for result in [r for r in in_flight if r.deadline <= now]:
+                    in_flight.discard(result)
+                    yield (result.request, -errno.ETIMEDOUT, '',
+                           'timed out after {0}s'.format(timeout))
+                continue
+
+            if result not in in_flight:
+                # a late reply to a command we already timed out
+                continue
+            in_flight.discard(result)
+            yield result.request, result.r, result.outb, result.outs
+
     def set_health_checks(self, checks):
         """
         Set the module's current map of health checks.  Argument is a
@@ -884,6 +1408,26 @@ class MgrModule(ceph_module.BaseMgrModule):
         """
         self._ceph_set_health_checks(checks)
 
+    def _profiler_start(self, interval):
+        if self._profiler and self._profiler.stopped_at is None:
+            return 'profiler already running'
+        module_path = os.path.dirname(inspect.getfile(self.__class__))
+        self._profiler = StackSampler(module_path, interval)
+        self._profiler.start()
+        return 'profiler started'
+
+    def _profiler_stop(self):
+        if not self._profiler or self._profiler.stopped_at is not None:
+            return 'profiler not running'
+        self._profiler.stop()
+        self._profiler.join()
+        return 'profiler stopped'
+
+    def _profiler_stacks(self, count):
+        if not self._profiler:
+            return 'profiler has not been started'
+        return self._profiler.format(count)
+
     def _handle_command(self, inbuf, cmd):
         if cmd['prefix'] not in CLICommand.COMMANDS:
             return self.handle_command(inbuf, cmd)
@@ -1037,6 +1581,32 @@ class MgrModule(ceph_module.BaseMgrModule):
         """
         self._ceph_set_store(key, val)
 
+    def set_store_batch(self, changes=None, remove_prefixes=None,
+                        wait=True):
+        """
+        Apply several changes to this module's persistent key value
+        store in a single monitor transaction, instead of one round trip
+        per key.  Prefixes are removed first, then the changed keys are
+        set or removed.
+
+        :param dict changes: key to value, or to None to remove the key
+        :param list remove_prefixes: remove every key starting with
+            one of these prefixes
+        :param bool wait: if False, return as soon as the batch has been
+            sent; the result is available from the returned completion
+        :return: a ``CommandResult`` whose ``wait()`` gives the monitor's
+            ``(retval, outb, outs)``
+        """
+        changes = dict((str(k), None if v is None else str(v))
+                       for k, v in six.iteritems(changes or {}))
+        remove_prefixes = [str(p) for p in remove_prefixes or []]
+        completion = CommandResult('')
+        self._ceph_set_store_batch(changes, remove_prefixes, completion,
+                                   completion.tag)
+        if wait:
+            completion.wait()
+        return completion
+
     def get_store(self, key, default=None):
         """
         Get a value from this module's persistent key value store
@@ -1078,7 +1648,21 @@ class MgrModule(ceph_module.BaseMgrModule):
         OSDMap.
         :return: OSDMap
         """
-        return self._ceph_get_osdmap()
+        osdmap = self._ceph_get_osdmap()
+        index = self._osdmap_index
+        if index is not None and index.epoch == osdmap.get_epoch():
+            osdmap._index = index
+        else:
+            # Only maps fetched from the cluster share an index: maps
+            # derived with apply_incremental() can reuse an epoch number
+            # for different contents.
+            osdmap._publish_index = self._set_osdmap_index
+        return osdmap
+
+    def _set_osdmap_index(self, index):
+        current = self._osdmap_index
+        if current is None or current.epoch < index.epoch:
+            self._osdmap_index = index
 
     def get_latest(self, daemon_type, daemon_name, counter):
         data = self.get_latest_counter(
@@ -1096,6 +1680,30 @@ class MgrModule(ceph_module.BaseMgrModule):
         else:
             return 0, 0
 
+    def get_perf_counters_bulk(self, prio_limit=PRIO_USEFUL,
+                               services=("mds", "mon", "osd",
+                                         "rbd-mirror", "rgw")):
+        """
+        Fetch the schema and latest values of the perf counters of all
+        daemons of the given types in a single call, filtered by priority
+        equal to or greater than `prio_limit`.
+
+        The values are returned as one set of columns per counter path,
+        rather than one dict per daemon and counter.  Counters without
+        data points yet have a value (and count) of 0.
+
+        :return: a dict with ``daemons``, a list of daemon names (like
+            "osd.123"), and ``counters``, a dict mapping counter paths to
+            a list of column sets, one per schema the daemons report the
+            path with (usually just one, more when daemons of different
+            versions describe it differently).  Each has the schema
+            information (as from ``get_perf_schema``) plus the columns
+            ``daemons`` (indices into the top-level ``daemons`` list),
+            ``values`` (the raw latest values) and, for long running
+            averages, ``counts``.
+        """
+        return self._ceph_get_perf_counters_bulk(list(services), prio_limit)
+
     def get_all_perf_counters(self, prio_limit=PRIO_USEFUL,
                               services=("mds", "mon", "osd",
                                         "rbd-mirror", "rgw")):
@@ -1109,55 +1717,27 @@ class MgrModule(ceph_module.BaseMgrModule):
         info structure, which is the information from
         the schema, plus an additional "value" member with the latest
         value.
+
+        See ``get_perf_counters_bulk`` for a more compact representation.
         """
 
         result = defaultdict(dict)
 
-        for server in self.list_servers():
-            for service in server['services']:
-                if service['type'] not in services:
-                    continue
-
-                schema = self.get_perf_schema(service['type'], service['id'])
-                if not schema:
-                    self.log.warn("No perf counter schema for {0}.{1}".format(
-                        service['type'], service['id']
-                    ))
-                    continue
-
-                # Value is returned in a potentially-multi-service format,
-                # get just the service we're asking about
-                svc_full_name = "{0}.{1}".format(
-                    service['type'], service['id'])
-                schema = schema[svc_full_name]
-
-                # Populate latest values
-                for counter_path, counter_schema in schema.items():
-                    # self.log.debug("{0}: {1}".format(
-                    #     counter_path, json.dumps(counter_schema)
-                    # ))
-                    if counter_schema['priority'] < prio_limit:
-                        continue
-
+        bulk = self.get_perf_counters_bulk(prio_limit, services)
+        daemons = bulk['daemons']
+        for counter_path, columns in six.iteritems(bulk['counters']):
+            for column in columns:
+                counter_schema = dict(
+                    (k, v) for k, v in six.iteritems(column)
+                    if k not in ('daemons', 'values', 'counts'))
+                counts = column.get('counts')
+                for i, daemon in enumerate(column['daemons']):
                     counter_info = dict(counter_schema)
-
+                    counter_info['value'] = column['values'][i]
                     # Also populate count for the long running avgs
-                    if counter_schema['type'] & self.PERFCOUNTER_LONGRUNAVG:
-                        v, c = self.get_latest_avg(
-                            service['type'],
-                            service['id'],
-                            counter_path
-                        )
-                        counter_info['value'], counter_info['count'] = v, c
-                        result[svc_full_name][counter_path] = counter_info
-                    else:
-                        counter_info['value'] = self.get_latest(
-                            service['type'],
-                            service['id'],
-                            counter_path
-                        )
-
-                    result[svc_full_name][counter_path] = counter_info
+                    if counts is not None:
+                        counter_info['count'] = counts[i]
+                    result[daemons[daemon]][counter_path] = counter_info
 
         self.log.debug("returning {0} counter".format(len(result)))
 
@@ -1224,8 +1804,18 @@ class MgrModule(ceph_module.BaseMgrModule):
 
     def remote(self, module_name, method_name, *args, **kwargs):
         """
-        Invoke a method on another module.  All arguments, and the return
-        value from the other module must be serializable.
+        Invoke a method on another module.
+
+        Arguments and the return value are passed as Python objects, not
+        serialized: modules share one allocator and GIL, so a dict built
+        by the other module is handed to the caller as it is.  Methods
+        intended to be called this way should therefore return native
+        data (dicts, lists, strings and numbers) rather than a JSON
+        string for the caller to parse, and should return either a fresh
+        object or a read-only one (see ``freeze``) if they keep a
+        reference to it themselves.  Likewise, the caller should not
+        modify arguments after passing them.  Instances of classes
+        defined in one module should not be passed to another.
 
         Limitation: Do not import any modules within the called method.
         Otherwise you will get an error in Python 2::
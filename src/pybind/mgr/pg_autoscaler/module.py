@@ -70,6 +70,8 @@ class PgAutoscaler(MgrModule):
         },
     ]
 
+    DATA_CACHE = True
+
     def __init__(self, *args, **kwargs):
         super(PgAutoscaler, self).__init__(*args, **kwargs)
         self._shutdown = threading.Event()
@@ -8,6 +8,10 @@ import json
 
 ENCODING_VERSION = 1
 
+# PG stats columns consumed by PgRecoveryEvent.pg_update
+PG_STATS_FIELDS = ['pool', 'ps', 'state', 'up', 'acting', 'num_bytes',
+                   'num_bytes_recovered']
+
 # keep a global reference to the module so we can use it from Event methods
 _module = None
 
@@ -142,24 +146,30 @@ class PgRecoveryEvent(Event):
     def evacuating_osds(self):
         return self. _evacuate_osds
 
-    def pg_update(self, pg_dump, log):
+    def pg_update(self, pg_stats, active_clean, log):
+        """
+        :param pg_stats: columns of PG_STATS_FIELDS, as returned by
+            MgrModule.get_pg_stats_columns
+        :param active_clean: the active and clean PG state bits
+        """
         # FIXME: O(pg_num) in python
-        # FIXME: far more fields getting pythonized than we really care about
-        pg_to_state = dict([(p['pgid'], p) for p in pg_dump['pg_stats']])
+        pg_to_index = dict(
+            (pgid, i) for i, pgid in enumerate(zip(pg_stats['pool'],
+                                                   pg_stats['ps'])))
+        up = pg_stats['up']
+        up_offsets = pg_stats['up_offsets']
+        acting = pg_stats['acting']
+        acting_offsets = pg_stats['acting_offsets']
+        num_bytes = pg_stats['num_bytes']
+        num_bytes_recovered = pg_stats['num_bytes_recovered']
 
         if self._original_bytes_recovered is None:
             self._original_bytes_recovered = {}
-            missing_pgs = []
             for pg in self._pgs:
-                pg_str = str(pg)
-                if pg_str in pg_to_state:
+                i = pg_to_index.get((pg.pool_id, pg.ps))
+                if i is not None:
                     self._original_bytes_recovered[pg] = \
-                        pg_to_state[pg_str]['stat_sum']['num_bytes_recovered']
-                else:
-                    missing_pgs.append(pg)
-            if pg_dump.get('pg_ready', False):
-                for pg in missing_pgs:
-                    self._pgs.remove(pg)
+                        num_bytes_recovered[i]
 
         complete_accumulate = 0.0
 
@@ -173,31 +183,27 @@ class PgRecoveryEvent(Event):
 
         complete = set()
         for pg in self._pgs:
-            pg_str = str(pg)
-            try:
-                info = pg_to_state[pg_str]
-            except KeyError:
+            i = pg_to_index.get((pg.pool_id, pg.ps))
+            if i is None:
                 # The PG is gone!  Probably a pool was deleted. Drop it.
                 complete.add(pg)
                 continue
 
-            state = info['state']
-
-            states = state.split("+")
-
-            unmoved = bool(set(self._evacuate_osds) & (
-                set(info['up']) | set(info['acting'])))
+            pg_osds = set(up[up_offsets[i]:up_offsets[i + 1]]) | \
+                set(acting[acting_offsets[i]:acting_offsets[i + 1]])
+            unmoved = bool(set(self._evacuate_osds) & pg_osds)
 
-            if "active" in states and "clean" in states and not unmoved:
+            if pg_stats['state'][i] & active_clean == active_clean \
+                    and not unmoved:
                 complete.add(pg)
             else:
-                if info['stat_sum']['num_bytes'] == 0:
+                if num_bytes[i] == 0:
                     # Empty PGs are considered 0% done until they are
                     # in the correct state.
                     pass
                 else:
-                    recovered = info['stat_sum']['num_bytes_recovered']
-                    total_bytes = info['stat_sum']['num_bytes']
+                    recovered = num_bytes_recovered[i]
+                    total_bytes = num_bytes[i]
                     if total_bytes > 0:
                         ratio = float(recovered -
                                       self._original_bytes_recovered[pg]) / \
@@ -275,6 +281,8 @@ class Module(MgrModule):
         },
     ]
 
+    DATA_CACHE = True
+
     def __init__(self, *args, **kwargs):
         super(Module, self).__init__(*args, **kwargs)
 
@@ -360,7 +368,8 @@ class Module(MgrModule):
             which_pgs=affected_pgs,
             evacuate_osds=[osd_id]
         )
-        ev.pg_update(self.get("pg_dump"), self.log)
+        ev.pg_update(self.get_pg_stats_columns(PG_STATS_FIELDS),
+                     self._active_clean(), self.log)
         self._events[ev.id] = ev
 
     def _osd_in(self, osd_id):
@@ -371,27 +380,40 @@ class Module(MgrModule):
                 ))
                 self._complete(ev)
 
+    def _osd_in_changes(self, old_osdmap, new_osdmap):
+        """
+        :return: list of (osd_id, old 'in', new 'in') for OSDs present
+                 in both maps
+        """
+        changes = self.get_osdmap_changes(old_osdmap.get_epoch(),
+                                          new_osdmap.get_epoch())
+        if changes['complete']:
+            return [(c['osd'], c['old']['in'], c['new']['in'])
+                    for c in changes['osds']
+                    if c['old']['exists'] and c['new']['exists']]
+
+        # The mgr's change history doesn't go back far enough: compare
+        # the full maps.
+        old_osds = dict([(o['osd'], o) for o in old_osdmap.dump()['osds']])
+        return [(o['osd'], old_osds[o['osd']]['in'], o['in'])
+                for o in new_osdmap.dump()['osds'] if o['osd'] in old_osds]
+
     def _osdmap_changed(self, old_osdmap, new_osdmap):
-        old_dump = old_osdmap.dump()
-        new_dump = new_osdmap.dump()
-
-        old_osds = dict([(o['osd'], o) for o in old_dump['osds']])
-
-        for osd in new_dump['osds']:
-            osd_id = osd['osd']
-            new_weight = osd['in']
-            if osd_id in old_osds:
-                old_weight = old_osds[osd_id]['in']
-
-                if new_weight == 0.0 and old_weight > new_weight:
-                    self.log.warn("osd.{0} marked out".format(osd_id))
-                    self._osd_out(old_osdmap, old_dump, new_osdmap, osd_id)
-                elif new_weight >= 1.0 and old_weight == 0.0:
-                    # Only consider weight>=1.0 as "in" to avoid spawning
-                    # individual recovery events on every adjustment
-                    # in a gradual weight-in
-                    self.log.warn("osd.{0} marked in".format(osd_id))
-                    self._osd_in(osd_id)
+        old_dump = None
+
+        for osd_id, old_weight, new_weight in self._osd_in_changes(
+                old_osdmap, new_osdmap):
+            if new_weight == 0.0 and old_weight > new_weight:
+                self.log.warn("osd.{0} marked out".format(osd_id))
+                if old_dump is None:
+                    old_dump = old_osdmap.dump()
+                self._osd_out(old_osdmap, old_dump, new_osdmap, osd_id)
+            elif new_weight >= 1.0 and old_weight == 0.0:
+                # Only consider weight>=1.0 as "in" to avoid spawning
+                # individual recovery events on every adjustment
+                # in a gradual weight-in
+                self.log.warn("osd.{0} marked in".format(osd_id))
+                self._osd_in(osd_id)
 
     def notify(self, notify_type, notify_data):
         self._ready.wait()
@@ -405,12 +427,17 @@ class Module(MgrModule):
             ))
             self._osdmap_changed(old_osdmap, self._latest_osdmap)
         elif notify_type == "pg_summary":
-            data = self.get("pg_dump")
+            data = self.get_pg_stats_columns(PG_STATS_FIELDS)
+            active_clean = self._active_clean()
             for ev_id, ev in self._events.items():
                 if isinstance(ev, PgRecoveryEvent):
-                    ev.pg_update(data, self.log)
+                    ev.pg_update(data, active_clean, self.log)
                     self.maybe_complete(ev)
 
+    def _active_clean(self):
+        state_bits = self.get_pg_state_bits()
+        return state_bits['active'] | state_bits['clean']
+
     def maybe_complete(self, event):
         if event.progress >= 1.0:
             self._complete(event)
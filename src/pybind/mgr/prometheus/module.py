@@ -1,15 +1,21 @@
+import array
 import cherrypy
 from distutils.version import StrictVersion
+import heapq
 import json
 import errno
 import math
 import os
 import re
+import six
 import socket
 import threading
 import time
+import zlib
 from mgr_module import MgrModule, MgrStandbyModule, CommandResult, PG_STATES
+import rados
 from rbd import RBD
+from six.moves.urllib.request import Request, urlopen
 
 # Defaults for the Prometheus HTTP server.  Can also set in config-key
 # see https://github.com/prometheus/prometheus/wiki/Default-port-allocations
@@ -100,6 +106,116 @@ DISK_OCCUPATION = ('ceph_daemon', 'device', 'db_device',
 
 NUM_OBJECTS = ['degraded', 'misplaced', 'unfound']
 
+COLLECT_DURATION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Exposition formats
+FORMAT_TEXT = 'text'
+FORMAT_OPENMETRICS = 'openmetrics'
+
+CONTENT_TYPES = {
+    FORMAT_TEXT: 'text/plain; version=0.0.4; charset=utf-8',
+    FORMAT_OPENMETRICS:
+        'application/openmetrics-text; version=1.0.0; charset=utf-8',
+}
+
+# Size of the pieces /metrics responses are streamed in
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Endpoints are (section, shard, number of shards).  The '' section is
+# plain /metrics, which serves everything; the others serve a part:
+#   cluster: cluster-wide metrics, and perf counters of non-OSD daemons
+#   osd: perf counters of the OSDs whose id is shard modulo the number
+#        of shards, which must be one of the osd_shards option
+#   rbd: per-image RBD IO statistics
+ENDPOINT_ALL = ('', 0, 1)
+SECTIONS = ('cluster', 'osd', 'rbd')
+MAX_SHARDS = 1024
+
+# Endpoints other than ENDPOINT_ALL that have not been scraped for this
+# long stop being collected until they are scraped again.
+ENDPOINT_IDLE_TIMEOUT = 600
+
+# Per-image RBD counters are 64-bit integers
+RBD_COUNTER_TYPECODE = 'q' if six.PY3 else 'l'
+
+# An RBD namespace is relisted on a pool refresh only if its directory
+# object changed since the last listing.  Object mtimes have a one
+# second resolution, so a listing that close to the last change is not
+# trusted.
+RBD_DIRECTORY_MTIME_SLACK = 2
+
+
+def promethize(path):
+    ''' replace illegal metric name characters '''
+    result = path.replace('.', '_').replace(
+        '+', '_plus').replace('::', '_').replace(' ', '_')
+
+    # Hyphens usually turn into underscores, unless they are
+    # trailing
+    if result.endswith("-"):
+        result = result[0:-1] + "_minus"
+    else:
+        result = result.replace("-", "_")
+
+    return "ceph_{0}".format(result)
+
+
+def floatstr(value):
+    ''' represent as Go-compatible float '''
+    value = float(value)
+    if value - value == 0:
+        # finite
+        return repr(value)
+    if math.isnan(value):
+        return 'NaN'
+    return '+Inf' if value > 0 else '-Inf'
+
+
+def collapse_histogram(histogram, max_buckets):
+    """
+    Reduce a Ceph 2D perf histogram, as dumped by ``perf histogram
+    dump``, to Prometheus buckets along its first axis by summing over
+    the second one.  Adjacent buckets are merged so that there are at
+    most ``max_buckets`` finite buckets.  Latency axes, which Ceph
+    records in nanoseconds, are converted to seconds.
+
+    :return: (finite bucket bounds, counts per bucket with +Inf last)
+    """
+    axis = histogram['axes'][0]
+    unit = 1e9 if axis['name'].startswith('Latency') else 1
+    ranges = axis['ranges']
+    rows = [sum(row) for row in histogram['values']]
+    finite = len(ranges) - 1
+    group = max(1, -(-finite // max(1, max_buckets)))
+    bounds = []
+    counts = []
+    for i in range(0, finite, group):
+        last = min(i + group, finite) - 1
+        # Ceph buckets hold integers up to and including 'max'; the
+        # bound is rounded up to the minimum of the next bucket.
+        bounds.append((ranges[last]['max'] + 1) / unit)
+        counts.append(sum(rows[i:last + 1]))
+    counts.append(rows[finite])
+    return bounds, counts
+
+
+def gzip_compress(data):
+    # A gzip member, which unlike zlib.compress() output can be
+    # concatenated with others and still be a valid gzip stream.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decompress(data):
+    # Unlike zlib.decompress(), reads all concatenated gzip members.
+    out = []
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out.append(decompressor.decompress(data))
+        out.append(decompressor.flush())
+        data = decompressor.unused_data
+    return b''.join(out)
+
 
 class Metric(object):
     def __init__(self, mtype, name, desc, labels=None):
@@ -108,66 +224,301 @@ class Metric(object):
         self.desc = desc
         self.labelnames = labels    # tuple if present
         self.value = {}             # indexed by label values
+        self.expname = promethize(name)
+        # (prefix, value, line) per format and label values, where
+        # prefix is the rendered "\nname{labels} " and line the last
+        # rendered series.  Label sets mostly stay the same from one
+        # collection to the next, and many values too, so most lines are
+        # reused as is.
+        self.rendered = {}
+        # SeriesLimits, or None if every series is exported
+        self.limits = None
+        self.dropped = 0
 
     def clear(self):
         self.value = {}
+        self.dropped = 0
 
     def set(self, value, labelvalues=None):
         # labelvalues must be a tuple
         labelvalues = labelvalues or ('',)
+        if self.limits is not None and labelvalues not in self.value and \
+           not self.limits.admit(self, labelvalues):
+            self.dropped += 1
+            return
         self.value[labelvalues] = value
 
-    def str_expfmt(self):
-
-        def promethize(path):
-            ''' replace illegal metric name characters '''
-            result = path.replace('.', '_').replace(
-                '+', '_plus').replace('::', '_').replace(' ', '_')
-
-            # Hyphens usually turn into underscores, unless they are
-            # trailing
-            if result.endswith("-"):
-                result = result[0:-1] + "_minus"
-            else:
-                result = result.replace("-", "_")
-
-            return "ceph_{0}".format(result)
-
-        def floatstr(value):
-            ''' represent as Go-compatible float '''
-            if value == float('inf'):
-                return '+Inf'
-            if value == float('-inf'):
-                return '-Inf'
-            if math.isnan(value):
-                return 'NaN'
-            return repr(float(value))
-
-        name = promethize(self.name)
-        expfmt = '''
+    def header(self, fmt):
+        mtype = self.mtype
+        if fmt == FORMAT_OPENMETRICS and mtype == 'untyped':
+            mtype = 'unknown'
+        return '''
 # HELP {name} {desc}
 # TYPE {name} {mtype}'''.format(
-            name=name,
+            name=self.expname,
             desc=self.desc,
-            mtype=self.mtype,
+            mtype=mtype,
         )
 
+    def labels(self, labelvalues):
+        if not self.labelnames:
+            return []
+        return ['%s="%s"' % (k, v) for k, v in
+                zip(self.labelnames, labelvalues)]
+
+    def prefix(self, labelvalues, fmt):
+        name = self.expname
+        if fmt == FORMAT_OPENMETRICS and self.mtype == 'counter':
+            # OpenMetrics counter samples carry a _total suffix
+            name += '_total'
+        labels = self.labels(labelvalues)
+        if labels:
+            return '\n{0}{{{1}}} '.format(name, ','.join(labels))
+        return '\n{0} '.format(name)
+
+    def render(self, out, fmt=FORMAT_TEXT):
+        """
+        Append the exposition of this metric in format ``fmt`` to the
+        list ``out``.  Families denied by the series budget are left out.
+        """
+        if self.limits is not None and not self.limits.allowed:
+            return
+        append = out.append
+        append(self.header(fmt))
+        old = self.rendered.get(fmt, {})
+        # Rebuilding the cache from the current label sets drops the
+        # entries of series that have gone away.
+        rendered = {}
         for labelvalues, value in self.value.items():
-            if self.labelnames:
-                labels = zip(self.labelnames, labelvalues)
-                labels = ','.join('%s="%s"' % (k, v) for k, v in labels)
+            entry = old.get(labelvalues)
+            if entry is None:
+                prefix = self.prefix(labelvalues, fmt)
+            elif entry[1] == value:
+                rendered[labelvalues] = entry
+                append(entry[2])
+                continue
             else:
-                labels = ''
-            if labels:
-                fmtstr = '\n{name}{{{labels}}} {value}'
+                prefix = entry[0]
+            # floatstr() inlined for the common, finite case: this loop
+            # runs once per series per collection.
+            fvalue = float(value)
+            if fvalue - fvalue == 0:
+                line = prefix + repr(fvalue)
             else:
-                fmtstr = '\n{name} {value}'
-            expfmt += fmtstr.format(
-                name=name,
-                labels=labels,
-                value=floatstr(value),
-            )
-        return expfmt
+                line = prefix + floatstr(fvalue)
+            rendered[labelvalues] = (prefix, value, line)
+            append(line)
+        self.rendered[fmt] = rendered
+
+    def str_expfmt(self, fmt=FORMAT_TEXT):
+        out = []
+        self.render(out, fmt)
+        return ''.join(out)
+
+
+class HistogramMetric(Metric):
+    """
+    A Prometheus histogram.  Values are ``(counts, sum)`` pairs, where
+    ``counts`` holds the number of observations in each bucket (not
+    cumulative), with one more entry than ``buckets`` for ``+Inf``.
+    The ``_sum`` series is left out if ``sum`` is None.
+    """
+
+    def __init__(self, name, desc, buckets, labels=None):
+        super(HistogramMetric, self).__init__('histogram', name, desc, labels)
+        self.buckets = buckets
+        self.bounds = ['le="%s"' % repr(float(b)) for b in buckets] + \
+            ['le="+Inf"']
+
+    def observe(self, value, labelvalues=None):
+        labelvalues = labelvalues or ('',)
+        counts, total = self.value.get(
+            labelvalues, ([0] * (len(self.buckets) + 1), 0.0))
+        # copied, not updated in place, as scrapes may be rendering it
+        counts = list(counts)
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        counts[i] += 1
+        self.value[labelvalues] = (counts, total + value)
+
+    def prefix(self, labelvalues, fmt):
+        labels = self.labels(labelvalues)
+        suffix = '{%s}' % ','.join(labels) if labels else ''
+        return (['\n{0}_bucket{{{1}}} '.format(
+                    self.expname, ','.join(labels + [bound]))
+                 for bound in self.bounds],
+                '\n{0}_sum{1} '.format(self.expname, suffix),
+                '\n{0}_count{1} '.format(self.expname, suffix))
+
+    def render(self, out, fmt=FORMAT_TEXT):
+        if self.limits is not None and not self.limits.allowed:
+            return
+        out.append(self.header(fmt))
+        old = self.rendered.get(fmt, {})
+        prefixes = {}
+        for labelvalues, (counts, total) in self.value.items():
+            prefix = old.get(labelvalues)
+            if prefix is None:
+                prefix = self.prefix(labelvalues, fmt)
+            prefixes[labelvalues] = prefix
+            buckets, sum_prefix, count_prefix = prefix
+            cumulative = 0
+            for bucket, count in zip(buckets, counts):
+                cumulative += count
+                out.append(bucket)
+                out.append(str(cumulative))
+            if total is not None:
+                out.append(sum_prefix)
+                out.append(floatstr(total))
+            out.append(count_prefix)
+            out.append(str(cumulative))
+        self.rendered[fmt] = prefixes
+
+
+def anchored(regex):
+    # Rules match whole names and values, as in Prometheus relabeling
+    return re.compile('(?:%s)\\Z' % regex)
+
+
+class SeriesLimits(object):
+    """
+    The part of a SeriesBudget that applies to one metric family.
+    """
+
+    def __init__(self, allowed, label_rules, max_series):
+        self.allowed = allowed
+        self.label_rules = label_rules  # [(label index, regex)]
+        self.max_series = max_series
+
+    def admit(self, metric, labelvalues):
+        """
+        :return: whether a new series of ``metric`` may be added
+        """
+        if not self.allowed:
+            return False
+        if self.max_series and len(metric.value) >= self.max_series:
+            return False
+        for i, regex in self.label_rules:
+            if regex.match(str(labelvalues[i])):
+                return False
+        return True
+
+
+class SeriesBudget(object):
+    """
+    Limits on the series built on each collection, from the module
+    options:
+
+    - ``metrics_allow``: if set, only the metric families whose exported
+      name matches this regex are collected;
+    - ``metrics_deny``: metric families whose name matches this regex are
+      not collected;
+    - ``labels_deny``: space separated ``label=regex`` rules; series with
+      a label value matching a rule are not collected;
+    - ``max_series_per_metric``: at most this many series of a family are
+      collected, the first ones set in a collection.
+    """
+
+    def __init__(self, allow='', deny='', labels_deny='', max_series=0):
+        self.key = (allow, deny, labels_deny, max_series)
+        self.allow = anchored(allow) if allow else None
+        self.deny = anchored(deny) if deny else None
+        self.labels_deny = []
+        for rule in labels_deny.split():
+            label, _, regex = rule.partition('=')
+            self.labels_deny.append((label, anchored(regex)))
+        self.max_series = int(max_series)
+
+    def limits(self, metric):
+        """
+        :return: the SeriesLimits of ``metric``, or None if it has none
+        """
+        allowed = ((self.allow is None or self.allow.match(metric.expname))
+                   and not (self.deny and self.deny.match(metric.expname)))
+        label_rules = [(metric.labelnames.index(label), regex)
+                       for label, regex in self.labels_deny
+                       if metric.labelnames and label in metric.labelnames]
+        if allowed and not label_rules and not self.max_series:
+            return None
+        return SeriesLimits(allowed, label_rules, self.max_series)
+
+
+class MetricRegistry(dict):
+    """
+    A dict of metrics, which applies the module's series budget to the
+    metrics put in it.
+    """
+
+    def __init__(self, module):
+        super(MetricRegistry, self).__init__()
+        self.module = module
+
+    def __setitem__(self, key, metric):
+        metric.limits = self.module.budget.limits(metric)
+        super(MetricRegistry, self).__setitem__(key, metric)
+
+
+class Snapshot(object):
+    """
+    One complete collection, as served to scrapers: the encoded
+    exposition in each format that was rendered, and when and how long
+    it took to collect.  Compressed bodies are built on first request
+    and kept for the life of the snapshot.
+    """
+
+    def __init__(self, bodies, collect_time, duration):
+        self.bodies = bodies
+        self.collect_time = collect_time
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.compressed = {}
+
+    def age(self):
+        return time.time() - self.collect_time
+
+    def get_body(self, fmt, gzip=False):
+        if not gzip:
+            return self.bodies[fmt]
+        with self.lock:
+            if fmt not in self.compressed:
+                self.compressed[fmt] = gzip_compress(self.bodies[fmt])
+            return self.compressed[fmt]
+
+
+class RBDImageCounters(object):
+    """
+    Counters accumulated per RBD image, stored in one array per counter
+    column and indexed by a small integer handle allocated to each image.
+    Handles of removed images are reused.
+    """
+
+    def __init__(self, ncolumns):
+        self.columns = [array.array(RBD_COUNTER_TYPECODE)
+                        for _ in range(ncolumns)]
+        self.images = []  # handle -> label values, or None if free
+        self.free = []
+
+    def add(self, labels):
+        if self.free:
+            handle = self.free.pop()
+            for column in self.columns:
+                column[handle] = 0
+            self.images[handle] = labels
+        else:
+            handle = len(self.images)
+            for column in self.columns:
+                column.append(0)
+            self.images.append(labels)
+        return handle
+
+    def remove(self, handle):
+        self.images[handle] = None
+        self.free.append(handle)
+
+    def handles(self):
+        return [h for h, labels in enumerate(self.images)
+                if labels is not None]
 
 
 class Module(MgrModule):
@@ -185,19 +536,67 @@ class Module(MgrModule):
         {'name': 'scrape_interval'},
         {'name': 'rbd_stats_pools'},
         {'name': 'rbd_stats_pools_refresh_interval'},
+        {'name': 'rbd_stats_scrape_interval'},
+        {'name': 'rbd_stats_top_n'},
+        {'name': 'osd_histograms'},
+        {'name': 'osd_histogram_buckets'},
+        {'name': 'standby_cache'},
+        {'name': 'metrics_allow'},
+        {'name': 'metrics_deny'},
+        {'name': 'labels_deny'},
+        {'name': 'max_series_per_metric'},
+        {'name': 'perf_counters_priority'},
+        {'name': 'perf_counters_fast_priority'},
+        {'name': 'perf_counters_slow_interval'},
+        {'name': 'osd_shards'},
     ]
 
+    DATA_CACHE = True
+
     def __init__(self, *args, **kwargs):
         super(Module, self).__init__(*args, **kwargs)
+        self.budget = SeriesBudget()
         self.metrics = self._setup_static_metrics()
+        # Perf counter and RBD metrics are kept apart from the cluster
+        # wide ones above, so that each endpoint renders only its part.
+        self.perf_metrics = {}  # endpoint -> metrics
+        self.rbd_metrics = MetricRegistry(self)
+        # metric family -> series dropped by the budget in the last
+        # collection of the RBD statistics
+        self.rbd_dropped = {}
+        # Perf counters below perf_counters_fast_priority are only
+        # refreshed every perf_counters_slow_interval collections, and
+        # the metrics in perf_slow keep their values in between.
+        self.perf_slow = set()
+        self.perf_slow_age = 0  # collections since the last refresh
+        self.perf_tiers = None
+        self.rbd_bodies = {}  # format -> rendered rbd_metrics
+        self.rbd_collect_time = 0
+        # ((osd_map version, osd_metadata version), metadata values)
+        self.metadata_cache = None
         self.shutdown_event = threading.Event()
         self.collect_lock = threading.RLock()
-        self.collect_time = 0
+        # set to have the collector collect now, e.g. a new endpoint
+        self.collect_event = threading.Event()
         self.collect_timeout = 5.0
-        self.collect_cache = None
+        # The last complete exposition of each endpoint.  The collector
+        # thread replaces them as a whole, so request handlers never see
+        # a partial one.
+        self.snapshots = {}
+        # endpoint -> when it was last scraped
+        self.endpoints = {ENDPOINT_ALL: time.time()}
+        self.collect_duration = HistogramMetric(
+            'mgr_prometheus_collect_duration_seconds',
+            'Time taken to collect all metrics',
+            COLLECT_DURATION_BUCKETS
+        )
+        self.collector = None
+        # Formats to render on each collection.  OpenMetrics is added
+        # once a scraper asks for it.
+        self.formats = set([FORMAT_TEXT])
         self.rbd_stats = {
             'pools': {},
-            'pools_refresh_time': 0,
+            'pools_refreshed': {},  # pool name -> (namespaces, time)
             'counters_info': {
                 'write_ops': {'type': self.PERFCOUNTER_COUNTER,
                               'desc': 'RBD image writes count'},
@@ -213,10 +612,16 @@ class Module(MgrModule):
                                  'desc': 'RBD image reads latency (msec)'},
             },
         }
+        # (pool id, namespace, image id) -> handle in rbd_counters
+        self.rbd_handles = {}
+        # two columns (value, count) per counter, plus the ops count at
+        # the last collection, to rank images by activity
+        self.rbd_counters = RBDImageCounters(
+            2 * len(self.rbd_stats['counters_info']) + 1)
         _global_instance['plugin'] = self
 
     def _setup_static_metrics(self):
-        metrics = {}
+        metrics = MetricRegistry(self)
         metrics['health_status'] = Metric(
             'untyped',
             'health_status',
@@ -471,14 +876,32 @@ class Module(MgrModule):
         return ret
 
     def get_metadata_and_osd_status(self):
+        # The metadata series only change with the OSDMap or with daemon
+        # metadata, so build them once per version of both and replay the
+        # values on other collections.
+        version = (self.get_data_version('osd_map'),
+                   self.get_data_version('osd_metadata'))
+        if self.metadata_cache is None or self.metadata_cache[0] != version:
+            self.metadata_cache = (version,
+                                   self._get_metadata_and_osd_status())
+        for path, value, labels in self.metadata_cache[1]:
+            self.metrics[path].set(value, labels)
+
+    def _get_metadata_and_osd_status(self):
+        """
+        :return: list of (metric path, value, label values)
+        """
+        values = []
         osd_map = self.get('osd_map')
         osd_flags = osd_map['flags'].split(',')
         for flag in OSD_FLAGS:
-            self.metrics['osd_flag_{}'.format(flag)].set(
-                int(flag in osd_flags)
-            )
+            values.append(('osd_flag_{}'.format(flag),
+                           int(flag in osd_flags), None))
 
-        osd_devices = self.get('osd_map_crush')['devices']
+        osd_dev_classes = dict(
+            (d['id'], d.get('class', ''))
+            for d in self.get('osd_map_crush')['devices'])
+        all_osd_metadata = self.get('osd_metadata')
         servers = self.get_service_list()
         for osd in osd_map['osds']:
             # id can be used to link osd metrics and metadata
@@ -493,12 +916,7 @@ class Module(MgrModule):
                 )
                 continue
 
-            dev_class = None
-            for osd_device in osd_devices:
-                if osd_device['id'] == id_:
-                    dev_class = osd_device.get('class', '')
-                    break
-
+            dev_class = osd_dev_classes.get(id_)
             if dev_class is None:
                 self.log.info("OSD {0} is missing from CRUSH map, "
                               "skipping output".format(id_))
@@ -507,7 +925,7 @@ class Module(MgrModule):
             host_version = servers.get((str(id_), 'osd'), ('', ''))
 
             # collect disk occupation metadata
-            osd_metadata = self.get_metadata("osd", str(id_))
+            osd_metadata = all_osd_metadata.get(str(id_))
             if osd_metadata is None:
                 continue
 
@@ -515,7 +933,7 @@ class Module(MgrModule):
             f_iface = osd_metadata.get('front_iface', '')
             b_iface = osd_metadata.get('back_iface', '')
 
-            self.metrics['osd_metadata'].set(1, (
+            values.append(('osd_metadata', 1, (
                 b_iface,
                 'osd.{}'.format(id_),
                 c_addr,
@@ -525,14 +943,14 @@ class Module(MgrModule):
                 obj_store,
                 p_addr,
                 host_version[1]
-            ))
+            )))
 
             # collect osd status
             for state in OSD_STATUS:
                 status = osd[state]
-                self.metrics['osd_{}'.format(state)].set(status, (
+                values.append(('osd_{}'.format(state), status, (
                     'osd.{}'.format(id_),
-                ))
+                )))
 
             if obj_store == "filestore":
                 # collect filestore backend device
@@ -556,41 +974,44 @@ class Module(MgrModule):
             if osd_dev_node and osd_hostname:
                 self.log.debug("Got dev for osd {0}: {1}/{2}".format(
                     id_, osd_hostname, osd_dev_node))
-                self.metrics['disk_occupation'].set(1, (
+                values.append(('disk_occupation', 1, (
                     "osd.{0}".format(id_),
                     osd_dev_node,
                     osd_db_dev_node,
                     osd_wal_dev_node,
                     osd_hostname
-                ))
+                )))
             else:
                 self.log.info("Missing dev node metadata for osd {0}, skipping "
                               "occupation record for this osd".format(id_))
 
         for pool in osd_map['pools']:
-            self.metrics['pool_metadata'].set(
-                1, (pool['pool'], pool['pool_name']))
+            values.append(('pool_metadata', 1,
+                           (pool['pool'], pool['pool_name'])))
 
         # Populate other servers metadata
         for key, value in servers.items():
             service_id, service_type = key
             if service_type == 'rgw':
                 hostname, version = value
-                self.metrics['rgw_metadata'].set(
-                    1,
+                values.append((
+                    'rgw_metadata', 1,
                     ('{}.{}'.format(service_type, service_id),
                      hostname, version)
-                )
+                ))
             elif service_type == 'rbd-mirror':
                 mirror_metadata = self.get_metadata('rbd-mirror', service_id)
                 if mirror_metadata is None:
                     continue
                 mirror_metadata['ceph_daemon'] = '{}.{}'.format(service_type,
                                                                 service_id)
-                self.metrics['rbd_mirror_metadata'].set(
-                    1, (mirror_metadata.get(k, '')
-                        for k in RBD_MIRROR_METADATA)
-                )
+                values.append((
+                    'rbd_mirror_metadata', 1,
+                    tuple(mirror_metadata.get(k, '')
+                          for k in RBD_MIRROR_METADATA)
+                ))
+
+        return values
 
     def get_num_objects(self):
         pg_sum = self.get('pg_summary')['pg_stats_sum']['stat_sum']
@@ -630,23 +1051,25 @@ class Module(MgrModule):
                 continue
             pools[pool_name].add(s[1])
 
-        rbd_stats_pools = {}
+        # Forget pools that are no longer configured, and refresh the
+        # image lists of the others on their own schedules.
         for pool_id in list(self.rbd_stats['pools']):
-            name = self.rbd_stats['pools'][pool_id]['name']
-            if name not in pools:
-                del self.rbd_stats['pools'][pool_id]
-            else:
-                rbd_stats_pools[name] = \
-                    self.rbd_stats['pools'][pool_id]['ns_names']
-
-        pools_refreshed = False
-        if pools:
-            next_refresh = self.rbd_stats['pools_refresh_time'] + \
-                self.get_localized_module_option(
-                'rbd_stats_pools_refresh_interval', 300)
-            if rbd_stats_pools != pools or time.time() >= next_refresh:
-                self.refresh_rbd_stats_pools(pools)
-                pools_refreshed = True
+            if self.rbd_stats['pools'][pool_id]['name'] not in pools:
+                self.forget_rbd_stats_pool(pool_id)
+        refreshed = self.rbd_stats['pools_refreshed']
+        for pool_name in list(refreshed):
+            if pool_name not in pools:
+                del refreshed[pool_name]
+
+        refresh_interval = float(self.get_localized_module_option(
+            'rbd_stats_pools_refresh_interval', 300))
+        now = time.time()
+        for pool_name, ns_names in pools.items():
+            if pool_name not in refreshed or \
+               refreshed[pool_name][0] != ns_names or \
+               now >= refreshed[pool_name][1] + refresh_interval:
+                self.refresh_rbd_stats_pool(pool_name, ns_names)
+                refreshed[pool_name] = (ns_names, now)
 
         pool_ids = list(self.rbd_stats['pools'])
         pool_ids.sort()
@@ -696,148 +1119,247 @@ class Module(MgrModule):
             self.rbd_stats['query_id'] = query_id
 
         res = self.get_osd_perf_counters(self.rbd_stats['query_id'])
+        unknown = []
         for c in res['counters']:
-            # if the pool id is not found in the object name use id of the
-            # pool where the object is located
-            if c['k'][2][0]:
-                pool_id = int(c['k'][2][0])
-            else:
-                pool_id = int(c['k'][0][0])
-            if pool_id not in self.rbd_stats['pools'] and not pools_refreshed:
-                self.refresh_rbd_stats_pools(pools)
-                pools_refreshed = True
-            if pool_id not in self.rbd_stats['pools']:
-                continue
-            pool = self.rbd_stats['pools'][pool_id]
-            nspace_name = c['k'][1][0]
-            if nspace_name not in pool['images']:
-                continue
-            image_id = c['k'][2][1]
-            if image_id not in pool['images'][nspace_name] and \
-               not pools_refreshed:
-                self.refresh_rbd_stats_pools(pools)
-                pool = self.rbd_stats['pools'][pool_id]
-                pools_refreshed = True
-            if image_id not in pool['images'][nspace_name]:
-                continue
-            counters = pool['images'][nspace_name][image_id]['c']
-            for i in range(len(c['c'])):
-                counters[i][0] += c['c'][i][0]
-                counters[i][1] += c['c'][i][1]
+            if not self.add_rbd_counters(c):
+                unknown.append(c)
+
+        if unknown:
+            # Statistics of images we do not know yet: relist only the
+            # namespaces they were found in, and count them if they are
+            # there now.
+            for pool_id, nspace_name in set(self.rbd_counters_image(c)[:2]
+                                            for c in unknown):
+                self.refresh_rbd_stats_namespace(pool_id, nspace_name)
+            for c in unknown:
+                self.add_rbd_counters(c)
+
+        handles = self.rbd_counters.handles()
+        top_n = int(self.get_localized_module_option('rbd_stats_top_n', 0))
+        if top_n > 0 and len(handles) > top_n:
+            handles = self.busiest_rbd_images(handles, top_n)
+        self.rbd_counters.columns[-1] = self.rbd_ops()
 
         label_names = ("pool", "namespace", "image")
-        for pool_id, pool in self.rbd_stats['pools'].items():
-            pool_name = pool['name']
-            for nspace_name, images in pool['images'].items():
-                for image_id in images:
-                    image_name = images[image_id]['n']
-                    counters = images[image_id]['c']
-                    i = 0
-                    for key in counters_info:
-                        counter_info = counters_info[key]
-                        stattype = self._stattype_to_str(counter_info['type'])
-                        labels = (pool_name, nspace_name, image_name)
-                        if counter_info['type'] == self.PERFCOUNTER_COUNTER:
-                            path = 'rbd_' + key
-                            if path not in self.metrics:
-                                self.metrics[path] = Metric(
-                                    stattype,
-                                    path,
-                                    counter_info['desc'],
-                                    label_names,
-                                )
-                            self.metrics[path].set(counters[i][0], labels)
-                        elif counter_info['type'] == self.PERFCOUNTER_LONGRUNAVG:
-                            path = 'rbd_' + key + '_sum'
-                            if path not in self.metrics:
-                                self.metrics[path] = Metric(
-                                    stattype,
-                                    path,
-                                    counter_info['desc'] + ' Total',
-                                    label_names,
-                                )
-                            self.metrics[path].set(counters[i][0], labels)
-                            path = 'rbd_' + key + '_count'
-                            if path not in self.metrics:
-                                self.metrics[path] = Metric(
-                                    'counter',
-                                    path,
-                                    counter_info['desc'] + ' Count',
-                                    label_names,
-                                )
-                            self.metrics[path].set(counters[i][1], labels)
-                        i += 1
-
-    def refresh_rbd_stats_pools(self, pools):
-        self.log.debug('refreshing rbd pools %s' % (pools))
-
-        rbd = RBD()
-        counters_info = self.rbd_stats['counters_info']
-        for pool_name, cfg_ns_names in pools.items():
-            try:
-                pool_id = self.rados.pool_lookup(pool_name)
-                with self.rados.open_ioctx(pool_name) as ioctx:
-                    if pool_id not in self.rbd_stats['pools']:
-                        self.rbd_stats['pools'][pool_id] = {'images': {}}
-                    pool = self.rbd_stats['pools'][pool_id]
-                    pool['name'] = pool_name
-                    pool['ns_names'] = cfg_ns_names
-                    if cfg_ns_names:
-                        nspace_names = list(cfg_ns_names)
-                    else:
-                        nspace_names = [''] + rbd.namespace_list(ioctx)
-                    for nspace_name in pool['images']:
-                        if nspace_name not in nspace_names:
-                            del pool['images'][nspace_name]
-                    for nspace_name in nspace_names:
-                        if (nspace_name and
-                                not rbd.namespace_exists(ioctx, nspace_name)):
-                            self.log.debug('unknown namespace %s for pool %s' %
-                                           (nspace_name, pool_name))
-                            continue
-                        ioctx.set_namespace(nspace_name)
-                        if nspace_name not in pool['images']:
-                            pool['images'][nspace_name] = {}
-                        namespace = pool['images'][nspace_name]
-                        images = {}
-                        for image_meta in RBD().list2(ioctx):
-                            image = {'n': image_meta['name']}
-                            image_id = image_meta['id']
-                            if image_id in namespace:
-                                image['c'] = namespace[image_id]['c']
-                            else:
-                                image['c'] = [[0, 0] for x in counters_info]
-                            images[image_id] = image
-                        pool['images'][nspace_name] = images
-            except Exception as e:
-                self.log.error('failed listing pool %s: %s' % (pool_name, e))
-        self.rbd_stats['pools_refresh_time'] = time.time()
+        columns = self.rbd_counters.columns
+        images = self.rbd_counters.images
+        i = 0
+        for key in counters_info:
+            counter_info = counters_info[key]
+            stattype = self._stattype_to_str(counter_info['type'])
+            values, counts = columns[2 * i], columns[2 * i + 1]
+            i += 1
+            if counter_info['type'] == self.PERFCOUNTER_COUNTER:
+                path = 'rbd_' + key
+                if path not in self.rbd_metrics:
+                    self.rbd_metrics[path] = Metric(
+                        stattype,
+                        path,
+                        counter_info['desc'],
+                        label_names,
+                    )
+                metric = self.rbd_metrics[path]
+                for handle in handles:
+                    metric.set(values[handle], images[handle])
+            elif counter_info['type'] == self.PERFCOUNTER_LONGRUNAVG:
+                path = 'rbd_' + key + '_sum'
+                if path not in self.rbd_metrics:
+                    self.rbd_metrics[path] = Metric(
+                        stattype,
+                        path,
+                        counter_info['desc'] + ' Total',
+                        label_names,
+                    )
+                metric = self.rbd_metrics[path]
+                for handle in handles:
+                    metric.set(values[handle], images[handle])
+                path = 'rbd_' + key + '_count'
+                if path not in self.rbd_metrics:
+                    self.rbd_metrics[path] = Metric(
+                        'counter',
+                        path,
+                        counter_info['desc'] + ' Count',
+                        label_names,
+                    )
+                metric = self.rbd_metrics[path]
+                for handle in handles:
+                    metric.set(counts[handle], images[handle])
+
+    @staticmethod
+    def rbd_counters_image(c):
+        """
+        :return: (pool id, namespace, image id) of an RBD perf query row
+        """
+        k = c['k']
+        # if the pool id is not found in the object name use id of the
+        # pool where the object is located
+        if k[2][0]:
+            pool_id = int(k[2][0])
+        else:
+            pool_id = int(k[0][0])
+        return pool_id, k[1][0], k[2][1]
+
+    def add_rbd_counters(self, c):
+        """
+        Add the counters of an RBD perf query row to its image.
+
+        :return: False if the image is not known
+        """
+        handle = self.rbd_handles.get(self.rbd_counters_image(c))
+        if handle is None:
+            return False
+        columns = self.rbd_counters.columns
+        i = 0
+        for value, count in c['c']:
+            columns[i][handle] += value
+            columns[i + 1][handle] += count
+            i += 2
+        return True
+
+    def rbd_ops(self):
+        """
+        :return: array of the read and write ops of each image
+        """
+        columns = self.rbd_counters.columns
+        ops = array.array(RBD_COUNTER_TYPECODE,
+                          [0] * len(self.rbd_counters.images))
+        i = 0
+        for key in self.rbd_stats['counters_info']:
+            if key in ('read_ops', 'write_ops'):
+                for handle, value in enumerate(columns[2 * i]):
+                    ops[handle] += value
+            i += 1
+        return ops
+
+    def busiest_rbd_images(self, handles, n):
+        """
+        :return: the n of ``handles`` with the most ops since the last
+            collection
+        """
+        ops = self.rbd_ops()
+        last = self.rbd_counters.columns[-1]
+        return heapq.nlargest(n, handles,
+                              key=lambda h: ops[h] - last[h])
+
+    def forget_rbd_stats_pool(self, pool_id):
+        pool = self.rbd_stats['pools'].pop(pool_id)
+        for nspace_name in list(pool['namespaces']):
+            self.forget_rbd_stats_namespace(pool_id, pool, nspace_name)
+
+    def forget_rbd_stats_namespace(self, pool_id, pool, nspace_name):
+        namespace = pool['namespaces'].pop(nspace_name)
+        for image_id in namespace['images']:
+            handle = self.rbd_handles.pop((pool_id, nspace_name, image_id))
+            self.rbd_counters.remove(handle)
+
+    def refresh_rbd_stats_pool(self, pool_name, cfg_ns_names):
+        self.log.debug('refreshing rbd pool %s' % pool_name)
+
+        try:
+            pool_id = self.rados.pool_lookup(pool_name)
+            for other_id, other in list(self.rbd_stats['pools'].items()):
+                if other['name'] == pool_name and other_id != pool_id:
+                    # the pool was recreated under the same name
+                    self.forget_rbd_stats_pool(other_id)
+            with self.rados.open_ioctx(pool_name) as ioctx:
+                if pool_id not in self.rbd_stats['pools']:
+                    self.rbd_stats['pools'][pool_id] = {'namespaces': {}}
+                pool = self.rbd_stats['pools'][pool_id]
+                pool['name'] = pool_name
+                pool['ns_names'] = cfg_ns_names
+                if cfg_ns_names:
+                    nspace_names = list(cfg_ns_names)
+                else:
+                    nspace_names = [''] + RBD().namespace_list(ioctx)
+                for nspace_name in list(pool['namespaces']):
+                    if nspace_name not in nspace_names:
+                        self.forget_rbd_stats_namespace(pool_id, pool,
+                                                        nspace_name)
+                for nspace_name in nspace_names:
+                    if (nspace_name and
+                            not RBD().namespace_exists(ioctx, nspace_name)):
+                        self.log.debug('unknown namespace %s for pool %s' %
+                                       (nspace_name, pool_name))
+                        continue
+                    self._refresh_rbd_stats_namespace(pool_id, pool, ioctx,
+                                                      nspace_name)
+        except Exception as e:
+            self.log.error('failed listing pool %s: %s' % (pool_name, e))
+
+    def refresh_rbd_stats_namespace(self, pool_id, nspace_name):
+        pool = self.rbd_stats['pools'].get(pool_id)
+        if pool is None or nspace_name not in pool['namespaces']:
+            return
+        try:
+            with self.rados.open_ioctx(pool['name']) as ioctx:
+                self._refresh_rbd_stats_namespace(pool_id, pool, ioctx,
+                                                  nspace_name)
+        except Exception as e:
+            self.log.error('failed listing pool %s namespace %s: %s' %
+                           (pool['name'], nspace_name, e))
+
+    def _refresh_rbd_stats_namespace(self, pool_id, pool, ioctx, nspace_name):
+        ioctx.set_namespace(nspace_name)
+        namespace = pool['namespaces'].setdefault(
+            nspace_name, {'images': {}, 'mtime': None, 'listed': 0})
+
+        # Image creation, removal and renaming all update the directory
+        # object, so an unchanged directory means an unchanged list.
+        try:
+            mtime = time.mktime(ioctx.stat('rbd_directory')[1])
+        except rados.ObjectNotFound:
+            mtime = 0
+        if mtime == namespace['mtime'] and \
+           mtime < namespace['listed'] - RBD_DIRECTORY_MTIME_SLACK:
+            return
+        self.log.debug('listing rbd images in pool %s namespace %s' %
+                       (pool['name'], nspace_name))
+        listed = time.time()
+
+        images = {}
+        for image_meta in RBD().list2(ioctx):
+            images[image_meta['id']] = image_meta['name']
+
+        known = namespace['images']
+        for image_id in list(known):
+            if image_id not in images:
+                del known[image_id]
+                handle = self.rbd_handles.pop(
+                    (pool_id, nspace_name, image_id))
+                self.rbd_counters.remove(handle)
+        for image_id, image_name in images.items():
+            labels = (pool['name'], nspace_name, image_name)
+            if image_id in known:
+                # the name may have changed
+                self.rbd_counters.images[known[image_id]] = labels
+                continue
+            handle = self.rbd_counters.add(labels)
+            known[image_id] = handle
+            self.rbd_handles[(pool_id, nspace_name, image_id)] = handle
+        namespace['mtime'] = mtime
+        namespace['listed'] = listed
 
     def shutdown_rbd_stats(self):
         if 'query_id' in self.rbd_stats:
             self.remove_osd_perf_query(self.rbd_stats['query_id'])
             del self.rbd_stats['query_id']
             del self.rbd_stats['query']
-        self.rbd_stats['pools'].clear()
-
-    def collect(self):
-        # Clear the metrics before scraping
-        for k in self.metrics.keys():
-            self.metrics[k].clear()
-
-        self.get_health()
-        self.get_df()
-        self.get_pool_stats()
-        self.get_fs()
-        self.get_osd_stats()
-        self.get_quorum_status()
-        self.get_metadata_and_osd_status()
-        self.get_pg_status()
-        self.get_num_objects()
-
-        for daemon, counters in self.get_all_perf_counters().items():
+        for pool_id in list(self.rbd_stats['pools']):
+            self.forget_rbd_stats_pool(pool_id)
+        self.rbd_stats['pools_refreshed'].clear()
+
+    def set_perf_counters(self, metrics, perf_counters, include):
+        """
+        Set the values of the perf counters of the daemons for which
+        ``include(daemon)`` is true in ``metrics``, creating metrics as
+        needed.
+        """
+        for daemon, counters in perf_counters.items():
+            if not include(daemon):
+                continue
             for path, counter_info in counters.items():
-                # Skip histograms, they are represented by long running avgs
+                # Skip histograms, they are represented by long running
+                # avgs, and optionally exported by set_perf_histograms
                 stattype = self._stattype_to_str(counter_info['type'])
                 if not stattype or stattype == 'histogram':
                     self.log.debug('ignoring %s, type %s' % (path, stattype))
@@ -850,42 +1372,402 @@ class Module(MgrModule):
                 # Represent the long running avgs as sum/count pairs
                 if counter_info['type'] & self.PERFCOUNTER_LONGRUNAVG:
                     _path = path + '_sum'
-                    if _path not in self.metrics:
-                        self.metrics[_path] = Metric(
+                    if _path not in metrics:
+                        metrics[_path] = Metric(
                             stattype,
                             _path,
                             counter_info['description'] + ' Total',
                             ("ceph_daemon",),
                         )
-                    self.metrics[_path].set(value, (daemon,))
+                    metrics[_path].set(value, (daemon,))
 
                     _path = path + '_count'
-                    if _path not in self.metrics:
-                        self.metrics[_path] = Metric(
+                    if _path not in metrics:
+                        metrics[_path] = Metric(
                             'counter',
                             _path,
                             counter_info['description'] + ' Count',
                             ("ceph_daemon",),
                         )
-                    self.metrics[_path].set(counter_info['count'], (daemon,))
+                    metrics[_path].set(counter_info['count'], (daemon,))
                 else:
-                    if path not in self.metrics:
-                        self.metrics[path] = Metric(
+                    if path not in metrics:
+                        metrics[path] = Metric(
                             stattype,
                             path,
                             counter_info['description'],
                             ("ceph_daemon",),
                         )
-                    self.metrics[path].set(value, (daemon,))
-
-        self.get_rbd_stats()
+                    metrics[path].set(value, (daemon,))
+
+    def get_osd_histograms(self, endpoints):
+        """
+        Fetch the perf histograms listed in the ``osd_histograms`` option
+        from the up OSDs that belong to any of ``endpoints``.  They are not
+        part of the perf counters that daemons report to the mgr, so they
+        are asked for with ``perf histogram dump``.
+
+        :return: dict of daemon to dict of counter path to histogram dump
+        """
+        names_string = self.get_localized_module_option('osd_histograms', '')
+        names = [x for x in re.split(r'[\s,]+', names_string) if x]
+        includes = [self.endpoint_filter(endpoint) for endpoint in endpoints
+                    if endpoint[0] in ('', 'osd')]
+        if not names or not includes:
+            return {}
+
+        commands = []
+        for osd in self.get('osd_map')['osds']:
+            daemon = 'osd.{}'.format(osd['osd'])
+            if osd['up'] and any(include(daemon) for include in includes):
+                commands.append(('osd', str(osd['osd']), {
+                    'prefix': 'perf histogram dump',
+                    'logger': 'osd',
+                    'format': 'json',
+                }))
+
+        histograms = {}
+        for request, r, outb, outs in self.send_commands(
+                commands, timeout=self.collect_timeout):
+            daemon = 'osd.' + request[1]
+            if r != 0:
+                self.log.debug('failed to get histograms of %s: %s' %
+                               (daemon, outs))
+                continue
+            try:
+                dump = json.loads(outb)['osd']
+            except (ValueError, KeyError) as e:
+                self.log.debug('bad histogram dump from %s: %s' % (daemon, e))
+                continue
+            histograms[daemon] = dict(('osd.' + name, dump[name])
+                                      for name in names if name in dump)
+        return histograms
+
+    def set_perf_histograms(self, metrics, histograms, perf_counters,
+                            include):
+        """
+        Set the histograms from ``get_osd_histograms`` of the daemons for
+        which ``include(daemon)`` is true in ``metrics``.
+        """
+        max_buckets = int(self.get_localized_module_option(
+            'osd_histogram_buckets', 16))
+        for daemon, counters in histograms.items():
+            if not include(daemon):
+                continue
+            for path, histogram in counters.items():
+                try:
+                    bounds, counts = collapse_histogram(histogram,
+                                                        max_buckets)
+                except (KeyError, IndexError, TypeError) as e:
+                    self.log.debug('ignoring histogram %s of %s: %s' %
+                                   (path, daemon, e))
+                    continue
+                metric = metrics.get(path)
+                if metric is None or \
+                   (metric.buckets != bounds and not metric.value):
+                    desc = perf_counters.get(daemon, {}).get(
+                        path, {}).get('description', path)
+                    metric = metrics[path] = HistogramMetric(
+                        path, desc, bounds, ("ceph_daemon",))
+                elif metric.buckets != bounds:
+                    self.log.debug('ignoring histogram %s of %s: '
+                                   'different buckets' % (path, daemon))
+                    continue
+                # Ceph histograms have no sum of the observations
+                metric.set((counts, None), (daemon,))
+
+    def update_budget(self):
+        """
+        Rebuild the series budget from the module options, and apply it
+        to the existing metrics if it changed.
+
+        :return: whether the budget changed
+        """
+        try:
+            budget = SeriesBudget(
+                self.get_localized_module_option('metrics_allow', ''),
+                self.get_localized_module_option('metrics_deny', ''),
+                self.get_localized_module_option('labels_deny', ''),
+                self.get_localized_module_option('max_series_per_metric', 0))
+        except (re.error, ValueError) as e:
+            self.log.error('invalid series budget, keeping the last one: '
+                           '%s' % e)
+            return False
+        if budget.key == self.budget.key:
+            return False
+        self.budget = budget
+        for metrics in [self.metrics, self.rbd_metrics] + \
+                list(self.perf_metrics.values()):
+            for metric in metrics.values():
+                metric.limits = budget.limits(metric)
+        return True
+
+    @staticmethod
+    def slow_perf_metrics(perf_counters, fast_prio):
+        """
+        :return: the set of metric paths of the perf counters with a
+            priority below ``fast_prio``
+        """
+        slow = set()
+        for counters in perf_counters.values():
+            for path, counter_info in counters.items():
+                if counter_info['priority'] < fast_prio:
+                    slow.update((path, path + '_sum', path + '_count'))
+        return slow
+
+    @staticmethod
+    def count_dropped(registries):
+        """
+        :return: dict of metric name to the number of its series dropped
+            by the series budget in ``registries``
+        """
+        dropped = {}
+        for metrics in registries:
+            for metric in metrics.values():
+                if metric.dropped:
+                    dropped[metric.expname] = \
+                        dropped.get(metric.expname, 0) + metric.dropped
+        return dropped
+
+    @staticmethod
+    def series_dropped_metric(dropped):
+        """
+        :return: a metric of the ``count_dropped`` counts, or None if no
+            series were dropped
+        """
+        if not dropped:
+            return None
+        metric = Metric(
+            'gauge',
+            'mgr_prometheus_series_dropped',
+            'Series of a metric left out of the last collection by the '
+            'series budget',
+            ('metric',)
+        )
+        for name, count in dropped.items():
+            metric.set(count, (name,))
+        return metric
+
+    @staticmethod
+    def endpoint_filter(endpoint):
+        """
+        :return: whether the perf counters of a daemon belong to an
+            endpoint
+        """
+        section, shard, of = endpoint
+        if section == 'cluster':
+            return lambda daemon: not daemon.startswith('osd.')
+        if section == 'osd':
+            return lambda daemon: (daemon.startswith('osd.') and
+                                   int(daemon[4:]) % of == shard)
+        return lambda daemon: True
+
+    def collect(self, formats=(FORMAT_TEXT,), endpoints=(ENDPOINT_ALL,),
+                collect_rbd=True):
+        """
+        Collect the metrics served by ``endpoints``.  RBD statistics are
+        only refreshed if ``collect_rbd`` is set; otherwise the last ones
+        are reused and the rbd endpoint is left out.
+
+        :return: dict of endpoint to dict of format to exposition text
+        """
+        sections = set(endpoint[0] for endpoint in endpoints)
+        budget_changed = self.update_budget()
 
-        # Return formatted metrics and clear no longer used data
-        _metrics = [m.str_expfmt() for m in self.metrics.values()]
+        # Clear the metrics before scraping
         for k in self.metrics.keys():
             self.metrics[k].clear()
 
-        return ''.join(_metrics) + '\n'
+        if sections & set(['', 'cluster']):
+            self.get_health()
+            self.get_df()
+            self.get_pool_stats()
+            self.get_fs()
+            self.get_osd_stats()
+            self.get_quorum_status()
+            self.get_metadata_and_osd_status()
+            self.get_pg_status()
+            self.get_num_objects()
+
+        perf_counters = {}
+        refresh_slow = True
+        if sections & set(['', 'cluster', 'osd']):
+            prio = int(self.get_localized_module_option(
+                'perf_counters_priority', self.PRIO_USEFUL))
+            fast_prio = int(self.get_localized_module_option(
+                'perf_counters_fast_priority', self.PRIO_INTERESTING))
+            slow_interval = int(self.get_localized_module_option(
+                'perf_counters_slow_interval', 1))
+            tiers = (prio, fast_prio)
+            refresh_slow = (
+                self.perf_slow_age >= slow_interval or
+                tiers != self.perf_tiers or
+                budget_changed or
+                any(endpoint not in self.perf_metrics
+                    for endpoint in endpoints if endpoint[0] != 'rbd'))
+            if refresh_slow:
+                perf_counters = self.get_all_perf_counters(prio)
+                self.perf_slow = self.slow_perf_metrics(perf_counters,
+                                                        fast_prio)
+                self.perf_tiers = tiers
+                self.perf_slow_age = 1
+            else:
+                perf_counters = self.get_all_perf_counters(
+                    max(prio, fast_prio))
+                self.perf_slow_age += 1
+        histograms = self.get_osd_histograms(endpoints)
+
+        if collect_rbd and sections & set(['', 'rbd']):
+            self.get_rbd_stats()
+            self.rbd_bodies = {}
+            for fmt in formats:
+                _metrics = []
+                for metric in self.rbd_metrics.values():
+                    metric.render(_metrics, fmt)
+                self.rbd_bodies[fmt] = ''.join(_metrics)
+            self.rbd_dropped = self.count_dropped([self.rbd_metrics])
+            for metric in self.rbd_metrics.values():
+                metric.clear()
+            self.rbd_collect_time = time.time()
+
+        # Return formatted metrics and clear no longer used data
+        bodies = {}
+        for endpoint in endpoints:
+            section = endpoint[0]
+            if section == 'rbd':
+                if collect_rbd:
+                    dropped = self.series_dropped_metric(self.rbd_dropped)
+                    bodies[endpoint] = {}
+                    for fmt in formats:
+                        _metrics = [self.rbd_bodies.get(fmt, '')]
+                        if dropped:
+                            dropped.render(_metrics, fmt)
+                        _metrics.append('\n')
+                        bodies[endpoint][fmt] = ''.join(_metrics)
+                continue
+            metrics = self.perf_metrics.get(endpoint)
+            if metrics is None:
+                metrics = self.perf_metrics[endpoint] = MetricRegistry(self)
+            if refresh_slow:
+                for metric in metrics.values():
+                    metric.clear()
+            include = self.endpoint_filter(endpoint)
+            self.set_perf_counters(metrics, perf_counters, include)
+            self.set_perf_histograms(metrics, histograms, perf_counters,
+                                     include)
+            if section == 'osd':
+                dropped = self.count_dropped([metrics])
+            else:
+                dropped = self.count_dropped([self.metrics, metrics])
+            if section == '':
+                for name, count in self.rbd_dropped.items():
+                    dropped[name] = dropped.get(name, 0) + count
+            dropped = self.series_dropped_metric(dropped)
+            bodies[endpoint] = {}
+            for fmt in formats:
+                _metrics = []
+                if section in ('', 'cluster'):
+                    for metric in self.metrics.values():
+                        metric.render(_metrics, fmt)
+                for metric in metrics.values():
+                    metric.render(_metrics, fmt)
+                if section == '':
+                    _metrics.append(self.rbd_bodies.get(fmt, ''))
+                if dropped:
+                    dropped.render(_metrics, fmt)
+                _metrics.append('\n')
+                bodies[endpoint][fmt] = ''.join(_metrics)
+            for key, metric in metrics.items():
+                if key not in self.perf_slow:
+                    metric.clear()
+        for metric in self.metrics.values():
+            metric.clear()
+
+        return bodies
+
+    def osd_shard_counts(self):
+        """
+        :return: the numbers of shards /metrics/osd may be split in, from
+            the comma separated osd_shards option
+        """
+        counts = set()
+        for count in str(self.get_localized_module_option(
+                'osd_shards', '')).split(','):
+            if not count.strip():
+                continue
+            try:
+                count = int(count)
+            except ValueError:
+                self.log.error('invalid osd_shards count %r' % count)
+                continue
+            if 1 <= count <= MAX_SHARDS:
+                counts.add(count)
+            else:
+                self.log.error('osd_shards count %d is not between 1 and '
+                               '%d' % (count, MAX_SHARDS))
+        return counts
+
+    def update_snapshots(self, endpoints=None):
+        """
+        Collect the given endpoints, or all of those scraped recently.
+        """
+        if endpoints is None:
+            now = time.time()
+            endpoints = []
+            for endpoint, scraped in list(self.endpoints.items()):
+                if endpoint == ENDPOINT_ALL or \
+                        now - scraped < ENDPOINT_IDLE_TIMEOUT:
+                    endpoints.append(endpoint)
+                    continue
+                self.log.debug('no longer collecting endpoint %s' %
+                               (endpoint,))
+                self.endpoints.pop(endpoint, None)
+                self.snapshots.pop(endpoint, None)
+                self.perf_metrics.pop(endpoint, None)
+
+        rbd_interval = float(self.get_localized_module_option(
+            'rbd_stats_scrape_interval', self.collect_timeout))
+        with self.collect_lock:
+            start = time.time()
+            # also for an rbd endpoint that has nothing to serve yet
+            collect_rbd = start - self.rbd_collect_time >= rbd_interval or \
+                any(endpoint[0] == 'rbd' and endpoint not in self.snapshots
+                    for endpoint in endpoints)
+            bodies = self.collect(tuple(self.formats), endpoints, collect_rbd)
+            duration = time.time() - start
+            self.collect_duration.observe(duration)
+        for endpoint, endpoint_bodies in bodies.items():
+            for fmt, body in endpoint_bodies.items():
+                if fmt == FORMAT_OPENMETRICS:
+                    # no blank lines allowed: every line starts with '\n'
+                    body = body[1:]
+                if not isinstance(body, bytes):
+                    body = body.encode('utf-8')
+                endpoint_bodies[fmt] = body
+            self.snapshots[endpoint] = Snapshot(endpoint_bodies, start,
+                                                duration)
+        self.log.debug('collected metrics for %d endpoints in %.3fs' %
+                       (len(bodies), duration))
+
+    def run_collector(self):
+        # Collect on our own schedule so that scrapes only ever read the
+        # last snapshot, however long a collection takes on a large
+        # cluster.
+        while not self.shutdown_event.is_set():
+            start = time.time()
+            # an endpoint scraped from now on is collected in this cycle,
+            # or right after it
+            self.collect_event.clear()
+            try:
+                if self.have_mon_connection():
+                    self.update_snapshots()
+                self.collect_event.wait(
+                    max(0, self.collect_timeout - (time.time() - start)))
+            except Exception:
+                # keep collecting: a dead collector thread would leave
+                # every scrape with a stale snapshot
+                self.log.exception('failed to collect metrics')
+                self.shutdown_event.wait(5.0)
 
     def get_file_sd_config(self):
         servers = self.list_servers()
@@ -924,7 +1806,9 @@ class Module(MgrModule):
         return 0, json.dumps(ret), ""
 
     def self_test(self):
-        self.collect()
+        # not concurrently with the collector, which shares the metrics
+        with self.collect_lock:
+            self.collect()
         self.get_file_sd_config()
 
     def handle_command(self, inbuf, cmd):
@@ -955,35 +1839,93 @@ class Module(MgrModule):
 </html>'''
 
             @cherrypy.expose
-            def metrics(self):
+            def metrics(self, section=None, shard=None, of=None, **kwargs):
                 instance = global_instance()
-                # Lock the function execution
-                try:
-                    instance.collect_lock.acquire()
-                    return self._metrics(instance)
-                finally:
-                    instance.collect_lock.release()
+                endpoint = self._endpoint(section, shard, of)
+                instance.endpoints[endpoint] = time.time()
+                snapshot = instance.snapshots.get(endpoint)
+                if snapshot is None:
+                    if not instance.have_mon_connection():
+                        raise cherrypy.HTTPError(503, 'No MON connection')
+                    # The collector picks a newly requested endpoint up
+                    # now; scrapes never wait for a collection.
+                    instance.collect_event.set()
+                    raise cherrypy.HTTPError(503, 'No metrics collected yet')
+                headers = cherrypy.request.headers
+                fmt = FORMAT_TEXT
+                if 'application/openmetrics-text' in headers.get('Accept', ''):
+                    # Served from the next collection on; until then
+                    # fall back to the text format.
+                    instance.formats.add(FORMAT_OPENMETRICS)
+                    if FORMAT_OPENMETRICS in snapshot.bodies:
+                        fmt = FORMAT_OPENMETRICS
+                gzip = 'gzip' in headers.get('Accept-Encoding', '')
+
+                age = Metric(
+                    'gauge',
+                    'mgr_prometheus_snapshot_age_seconds',
+                    'Time since the metrics being served were collected'
+                )
+                age.set(snapshot.age())
+                tail = (age.str_expfmt(fmt) +
+                        instance.collect_duration.str_expfmt(fmt))[1:] + '\n'
+                if fmt == FORMAT_OPENMETRICS:
+                    tail += '# EOF\n'
+                tail = tail.encode('utf-8')
+                body = snapshot.get_body(fmt, gzip)
+                if gzip:
+                    # gzip members concatenate into one valid stream
+                    tail = gzip_compress(tail)
+                    cherrypy.response.headers['Content-Encoding'] = 'gzip'
+                    cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+
+                cherrypy.response.headers['Content-Type'] = CONTENT_TYPES[fmt]
+                cherrypy.response.headers['Content-Length'] = \
+                    str(len(body) + len(tail))
+                return self._stream(body, tail)
+            metrics._cp_config = {'response.stream': True}
 
             @staticmethod
-            def _metrics(instance):
-                # Return cached data if available and collected before the
-                # cache times out
-                if instance.collect_cache and time.time() - instance.collect_time < instance.collect_timeout:
-                    cherrypy.response.headers['Content-Type'] = 'text/plain'
-                    return instance.collect_cache
-
-                if instance.have_mon_connection():
-                    instance.collect_cache = None
-                    instance.collect_time = time.time()
-                    instance.collect_cache = instance.collect()
-                    cherrypy.response.headers['Content-Type'] = 'text/plain'
-                    return instance.collect_cache
-                else:
-                    raise cherrypy.HTTPError(503, 'No MON connection')
+            def _endpoint(section, shard, of):
+                if section is None:
+                    return ENDPOINT_ALL
+                if section not in SECTIONS:
+                    raise cherrypy.HTTPError(404)
+                if shard is None and of is None:
+                    return (section, 0, 1)
+                if section != 'osd':
+                    raise cherrypy.HTTPError(
+                        400, 'Only the osd metrics can be sharded')
+                try:
+                    shard, of = int(shard), int(of)
+                except (TypeError, ValueError):
+                    raise cherrypy.HTTPError(
+                        400, 'shard and of must both be integers')
+                # Only the shard counts the admin configured, so that
+                # clients cannot make us collect arbitrarily many
+                # endpoints.
+                counts = global_instance().osd_shard_counts()
+                if of not in counts:
+                    raise cherrypy.HTTPError(
+                        400, 'of must be one of osd_shards ({0})'.format(
+                            ','.join(str(c) for c in sorted(counts))))
+                if not 0 <= shard < of:
+                    raise cherrypy.HTTPError(
+                        400, 'need 0 <= shard < of')
+                return (section, shard, of)
 
-        # Make the cache timeout for collecting configurable
-        self.collect_timeout = self.get_localized_module_option(
-            'scrape_interval', 5.0)
+            @staticmethod
+            def _stream(*parts):
+                # Hand out the snapshot piece by piece instead of letting
+                # CherryPy build another copy of the whole body.
+                for part in parts:
+                    for i in range(0, len(part), STREAM_CHUNK_SIZE):
+                        yield part[i:i + STREAM_CHUNK_SIZE]
+
+        # Make the cache timeout for collecting configurable.  Options
+        # that have been set come back as strings.
+        self.collect_timeout = float(self.get_localized_module_option(
+            'scrape_interval', 5.0))
 
         server_addr = self.get_localized_module_option(
             'server_addr', DEFAULT_ADDR)
@@ -1007,11 +1949,15 @@ class Module(MgrModule):
             'engine.autoreload.on': False
         })
         cherrypy.tree.mount(Root(), "/")
+        self.collector = threading.Thread(target=self.run_collector)
+        self.collector.daemon = True
+        self.collector.start()
         self.log.info('Starting engine...')
         cherrypy.engine.start()
         self.log.info('Engine started.')
         # wait for the shutdown event
         self.shutdown_event.wait()
+        self.collector.join()
         self.shutdown_event.clear()
         cherrypy.engine.stop()
         self.log.info('Engine stopped.')
@@ -1020,12 +1966,64 @@ class Module(MgrModule):
     def shutdown(self):
         self.log.info('Stopping engine...')
         self.shutdown_event.set()
+        self.collect_event.set()
 
 
 class StandbyModule(MgrStandbyModule):
+    """
+    Serves the index page and, if the ``standby_cache`` option is set,
+    the last metrics fetched from the active mgr, so that scrapes of a
+    standby keep returning data across a failover.
+    """
+
     def __init__(self, *args, **kwargs):
         super(StandbyModule, self).__init__(*args, **kwargs)
         self.shutdown_event = threading.Event()
+        self.cache = None  # (plain body, gzipped body, fetch time)
+
+    def fetch_active_metrics(self):
+        """
+        Fetch the metrics served by the active mgr into ``self.cache``.
+        The last copy is kept if the active does not serve any, e.g.
+        while it is starting up.
+        """
+        active_uri = self.get_active_uri()
+        if not active_uri:
+            return
+        request = Request(active_uri + 'metrics',
+                          headers={'Accept-Encoding': 'gzip'})
+        try:
+            response = urlopen(request, timeout=5)
+            try:
+                body = response.read()
+                encoding = response.info().get('Content-Encoding')
+            finally:
+                response.close()
+        except Exception as e:
+            self.log.debug('failed to fetch metrics from %s: %s' %
+                           (active_uri, e))
+            return
+        if encoding == 'gzip':
+            gzipped, body = body, gzip_decompress(body)
+        else:
+            gzipped = gzip_compress(body)
+        self.cache = (body, gzipped, time.time())
+
+    def run_fetcher(self):
+        """
+        Fetch the active's metrics once per ``scrape_interval``, which
+        is also the back-off when the active does not answer, so that a
+        newly started active is not hammered by the standbys.
+        """
+        while not self.shutdown_event.is_set():
+            interval = float(self.get_localized_module_option(
+                'scrape_interval', 5.0))
+            if self.get_localized_module_option('standby_cache', '') \
+                    in ('true', 'True', '1'):
+                self.fetch_active_metrics()
+            else:
+                self.cache = None
+            self.shutdown_event.wait(interval)
 
     def serve(self):
         server_addr = self.get_localized_module_option('server_addr', '::')
@@ -1055,16 +2053,39 @@ class StandbyModule(MgrStandbyModule):
 </html>'''.format(active_uri)
 
             @cherrypy.expose
-            def metrics(self):
+            def metrics(self, section=None, **kwargs):
                 cherrypy.response.headers['Content-Type'] = 'text/plain'
-                return ''
+                cache = module.cache
+                # Only the complete /metrics is cached
+                if cache is None or section is not None:
+                    return ''
+                body, gzipped, fetch_time = cache
+
+                age = Metric(
+                    'gauge',
+                    'mgr_prometheus_standby_cache_age_seconds',
+                    'Time since the metrics being served by this standby '
+                    'were fetched from the active mgr'
+                )
+                age.set(time.time() - fetch_time)
+                tail = (age.str_expfmt()[1:] + '\n').encode('utf-8')
+                if 'gzip' in cherrypy.request.headers.get(
+                        'Accept-Encoding', ''):
+                    body, tail = gzipped, gzip_compress(tail)
+                    cherrypy.response.headers['Content-Encoding'] = 'gzip'
+                    cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+                return body + tail
 
         cherrypy.tree.mount(Root(), '/', {})
+        fetcher = threading.Thread(target=self.run_fetcher)
+        fetcher.daemon = True
+        fetcher.start()
         self.log.info('Starting engine...')
         cherrypy.engine.start()
         self.log.info('Engine started.')
         # Wait for shutdown event
         self.shutdown_event.wait()
+        fetcher.join()
         self.shutdown_event.clear()
         cherrypy.engine.stop()
         self.log.info('Engine stopped.')
@@ -1253,6 +1253,9 @@ class TestConfigKey(TestArgparse):
     def test_del(self):
         self.check_1_string_arg('config-key', 'del')
 
+    def test_batch(self):
+        self.check_no_arg('config-key', 'batch')
+
     def test_exists(self):
         self.check_1_string_arg('config-key', 'exists')
 